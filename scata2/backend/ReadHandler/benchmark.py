@@ -0,0 +1,244 @@
+# Benchmarks for the read handling code. Run as
+#
+#   python -m scata2.backend.ReadHandler.benchmark pair --reads 10000
+#   python -m scata2.backend.ReadHandler.benchmark parse --reads 100000
+#   python -m scata2.backend.ReadHandler.benchmark filter --reads 100000
+#
+# Synthetic reads are generated with a fixed seed, so runs are comparable.
+
+import argparse
+import random
+import time
+from io import StringIO
+
+from Bio.Seq import reverse_complement
+
+from .exceptions import ScataReadsError
+from .fastqparser import FastQPairQualSeq, Single, kmer_overlap, kmer_overlap_dict
+from .filterseq import filter_full
+from .qualseq import Qual, QualSeq, SeqRead
+
+
+def random_seq(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def mutate(rng, seq, error_rate):
+    return "".join(rng.choice("ACGT".replace(b, "")) if rng.random() < error_rate else b
+                   for b in seq)
+
+
+# Make a read pair from a random amplicon. Read 2 is sequenced from the
+# other end, i.e. it is the reverse complement of the end of the amplicon.
+
+def synthetic_pair(rng, amplicon_length=450, read_length=300, error_rate=0.005):
+    amplicon = random_seq(rng, amplicon_length)
+    r1 = mutate(rng, amplicon[:read_length], error_rate)
+    r2 = mutate(rng, reverse_complement(amplicon[-read_length:]), error_rate)
+    s1 = QualSeq(SeqRead("r1", "", r1),
+                 Qual("r1", [rng.randint(20, 40) for _ in r1]))
+    s2 = QualSeq(SeqRead("r2", "", r2),
+                 Qual("r2", [rng.randint(20, 40) for _ in r2]))
+    return s1, s2
+
+
+# FastQPairQualSeq with the reference dict engine
+
+class DictPairQualSeq(FastQPairQualSeq):
+
+    def overlap(self, s1, s2):
+        return kmer_overlap_dict(s1, reverse_complement(s2),
+                                 self.kmer, self.hsp, self.min)
+
+
+def time_overlap(func, pairs, kmer, hsp, min):
+    results = []
+    start = time.perf_counter()
+    for s1, s2 in pairs:
+        try:
+            results.append(func(s1, s2, kmer, hsp, min))
+        except ScataReadsError as e:
+            results.append(e.error)
+    return time.perf_counter() - start, results
+
+
+# Merge pairs with a FastQPairQualSeq class. Returns the time and the
+# merged sequence and qualities (or the error) of each pair.
+
+def time_merge(cls, pairs, kmer, hsp, min):
+    results = []
+    start = time.perf_counter()
+    for s1, s2 in pairs:
+        try:
+            merged = cls(s1, s2, kmer, hsp, min)
+            results.append((str(merged.get_seq().seq), list(merged.get_qual().quals)))
+        except ScataReadsError as e:
+            results.append(e.error)
+    return time.perf_counter() - start, results
+
+
+def synthetic_pairs(reads, seed):
+    rng = random.Random(seed)
+    return [synthetic_pair(rng) for _ in range(reads)]
+
+
+def bench_pair(reads, kmer, hsp, min, seed=1):
+    # Merging modifies read 2, so each engine gets its own (identical) pairs
+    pairs = synthetic_pairs(reads, seed)
+    seqs = [(str(s1.seq_record.seq), reverse_complement(s2.seq_record.seq))
+            for s1, s2 in pairs]
+
+    # Compile numba code before timing
+    kmer_overlap(*seqs[0], kmer, hsp, min)
+
+    t_dict, r_dict = time_overlap(kmer_overlap_dict, seqs, kmer, hsp, min)
+    t_array, r_array = time_overlap(kmer_overlap, seqs, kmer, hsp, min)
+    t_merge_dict, m_dict = time_merge(DictPairQualSeq, pairs, kmer, hsp, min)
+    t_merge_array, m_array = time_merge(FastQPairQualSeq, synthetic_pairs(reads, seed), kmer, hsp, min)
+
+    print("Read pairs:        {}".format(reads))
+    print("Merged:            {}".format(sum(1 for m in m_array if isinstance(m, tuple))))
+    print("kmer dict:         {:.3f}s ({:.0f} pairs/s)".format(t_dict, reads / t_dict))
+    print("kmer array:        {:.3f}s ({:.0f} pairs/s)".format(t_array, reads / t_array))
+    print("Speedup:           {:.1f}x".format(t_dict / t_array))
+    print("Merge dict:        {:.3f}s ({:.0f} pairs/s)".format(t_merge_dict, reads / t_merge_dict))
+    print("Merge array:       {:.3f}s ({:.0f} pairs/s)".format(t_merge_array, reads / t_merge_array))
+    print("Differing overlaps: {}".format(sum(1 for a, b in zip(r_dict, r_array) if a != b)))
+    print("Differing merges:   {}".format(sum(1 for a, b in zip(m_dict, m_array) if a != b)))
+
+
+def synthetic_fastq(rng, reads, read_length=300):
+    records = []
+    for i in range(reads):
+        seq = random_seq(rng, read_length)
+        qual = "".join(chr(33 + rng.randint(2, 40)) for _ in seq)
+        records.append("@read{} synthetic\n{}\n+\n{}\n".format(i, seq, qual))
+    return "".join(records)
+
+
+# Parse and decode qualities, as the quality filters do for every read
+
+def time_parse(fastq, file_format):
+    start = time.perf_counter()
+    n = 0
+    for qualseq in Single(StringIO(fastq), file_format):
+        qualseq.get_qual().quals
+        n += 1
+    return time.perf_counter() - start, n
+
+
+def bench_parse(reads, seed=1):
+    rng = random.Random(seed)
+    fastq = synthetic_fastq(rng, reads)
+
+    # "fastq-sanger" is the same format, but is parsed by Biopython
+    t_bio, n_bio = time_parse(fastq, "fastq-sanger")
+    t_fast, n_fast = time_parse(fastq, "fastq")
+
+    print("Reads:             {}".format(reads))
+    print("Biopython SeqIO:   {:.3f}s ({:.0f} reads/s)".format(t_bio, n_bio / t_bio))
+    print("Streaming parser:  {:.3f}s ({:.0f} reads/s)".format(t_fast, n_fast / t_fast))
+    print("Speedup:           {:.1f}x".format(t_bio / t_fast))
+
+
+# Illumina-like qualities: high at the start of the read, decaying and
+# getting noisier towards the end, with occasional low quality bases.
+
+def synthetic_quals(rng, read_length=300):
+    quals = []
+    for i in range(read_length):
+        q = int(rng.gauss(38 - 14 * i / read_length, 1 + 3 * i / read_length))
+        if rng.random() < 0.0005:
+            q = 2
+        quals.append(min(max(q, 2), 41))
+    return quals
+
+
+# The filter_full implementation before it was vectorised, for comparison
+
+def filter_full_list(qualseq, min_length, mean_min, min_qual):
+    seq_record = qualseq.get_seq()
+    qual = qualseq.get_qual()
+    if len(seq_record.seq) < min_length:
+        raise ScataReadsError("too_short", "Read too short")
+    if float(sum(qual.quals)) / len(qual.quals) < mean_min:
+        raise ScataReadsError("low_mean_quality", "Too low mean quality")
+    seq_list = list(map(lambda b, q: b if q >= min_qual else 'N',
+                        list(seq_record.seq), qual.quals))
+    if seq_list.count('N'):
+        raise ScataReadsError("low_min_quality", "Too low minimum quality")
+    seq_record.seq = "".join(seq_list)
+    return qualseq
+
+
+def time_filter(func, reads, mean_min, min_qual):
+    results = []
+    start = time.perf_counter()
+    for qualseq in reads:
+        try:
+            results.append(str(func(qualseq, 100, mean_min, min_qual).seq_record.seq))
+        except ScataReadsError as e:
+            results.append(e.error)
+    return time.perf_counter() - start, results
+
+
+def bench_filter(reads, mean_min, min_qual, seed=1):
+    rng = random.Random(seed)
+    fastq = []
+    for i in range(reads):
+        seq = random_seq(rng, 300)
+        qual = "".join(chr(33 + q) for q in synthetic_quals(rng))
+        fastq.append("@read{}\n{}\n+\n{}\n".format(i, seq, qual))
+    fastq = "".join(fastq)
+
+    # Both get freshly parsed reads with quality strings decoded
+    list_reads = list(Single(StringIO(fastq), "fastq-sanger"))
+    array_reads = list(Single(StringIO(fastq)))
+    for qualseq in array_reads:
+        qualseq.get_qual().quals
+
+    # Compile numba code before timing
+    time_filter(filter_full, array_reads[:1], mean_min, min_qual)
+
+    t_list, r_list = time_filter(filter_full_list, list_reads, mean_min, min_qual)
+    t_array, r_array = time_filter(filter_full, array_reads, mean_min, min_qual)
+
+    mismatches = sum(1 for a, b in zip(r_list, r_array) if a != b)
+    print("Reads:             {}".format(reads))
+    print("Accepted:          {}".format(sum(1 for r in r_array if len(r) == 300)))
+    print("List filter:       {:.3f}s ({:.0f} reads/s)".format(t_list, reads / t_list))
+    print("Array filter:      {:.3f}s ({:.0f} reads/s)".format(t_array, reads / t_array))
+    print("Speedup:           {:.1f}x".format(t_list / t_array))
+    print("Differing results: {}".format(mismatches))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read handling benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    pair = sub.add_parser("pair", help="Read pair merging")
+    pair.add_argument("--reads", type=int, default=10000)
+    pair.add_argument("--kmer", type=int, default=7)
+    # Defaults of Pair
+    pair.add_argument("--hsp", type=int, default=5)
+    pair.add_argument("--min", type=int, default=10)
+
+    parse = sub.add_parser("parse", help="FASTQ parsing throughput")
+    parse.add_argument("--reads", type=int, default=100000)
+
+    filter = sub.add_parser("filter", help="Full length quality filtering")
+    filter.add_argument("--reads", type=int, default=100000)
+    filter.add_argument("--mean-min", type=int, default=20)
+    filter.add_argument("--min-qual", type=int, default=10)
+
+    args = parser.parse_args()
+    if args.bench == "pair":
+        bench_pair(args.reads, args.kmer, args.hsp, args.min)
+    elif args.bench == "parse":
+        bench_parse(args.reads)
+    elif args.bench == "filter":
+        bench_filter(args.reads, args.mean_min, args.min_qual)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# Translation of sequences to NumPy arrays, shared by the detagger and the
+# read pair merger.
+#
+# Sequences are viewed as uint8 arrays with np.frombuffer() (no copy) and
+# translated with a 256 entry lookup table, so encoding a read is two
+# vectorised operations instead of a Python loop over the bases.
+
+import numpy as np
+
+base_A = 1
+base_C = 2
+base_G = 4
+base_T = 8
+trans_table = { 'A' : base_A,
+                'C' : base_C,
+                'G' : base_G,
+                'T' : base_T,
+                'R' : base_A | base_G,
+                'Y' : base_C | base_T,
+                'S' : base_G | base_C,
+                'W' : base_A | base_T,
+                'K' : base_G | base_T,
+                'M' : base_A | base_C,
+                'B' : base_C | base_G | base_T,
+                'D' : base_A | base_G | base_T,
+                'H' : base_A | base_C | base_T,
+                'V' : base_A | base_C | base_G,
+                'N' : base_A | base_C | base_T | base_G }
+
+complement_trans_table = { 'A' : base_T,
+                'C' : base_G,
+                'G' : base_C,
+                'T' : base_A,
+                'R' : base_T | base_C,
+                'Y' : base_G | base_A,
+                'S' : base_C | base_G,
+                'W' : base_T | base_A,
+                'K' : base_C | base_A,
+                'M' : base_T | base_G,
+                'B' : base_G | base_C | base_A,
+                'D' : base_T | base_C | base_A,
+                'H' : base_T | base_G | base_A,
+                'V' : base_T | base_G | base_C,
+                'N' : base_T | base_G | base_A | base_C }
+
+
+def make_table(translation, default=0):
+    table = np.full(256, default, dtype=np.uint8)
+    for b, v in translation.items():
+        table[ord(b.upper())] = v
+        table[ord(b.lower())] = v
+    return table
+
+
+# Bit mask encoding of reads, used for primer search. N (and anything
+# unknown) is 0 so it never matches a primer position.
+
+read_table = make_table({b: v for b, v in trans_table.items() if b != 'N'})
+read_complement_table = make_table({b: v for b, v in complement_trans_table.items() if b != 'N'})
+
+# Complement of a bit mask encoded base is the reversed bit order
+# (A <-> T, C <-> G)
+complement_codes = np.array([int("{:04b}".format(x)[::-1], 2) for x in range(16)],
+                            dtype=np.uint8)
+
+# Two bit encoding used for k-mers. Anything that is not A, C, G or T is 4.
+
+kmer_table = make_table({'A': 0, 'C': 1, 'G': 2, 'T': 3}, default=4)
+kmer_complement_table = make_table({'A': 3, 'C': 2, 'G': 1, 'T': 0}, default=4)
+
+
+# View a sequence (str, bytes or Bio.Seq) as an array of characters
+
+def seq_bytes(seq):
+    if isinstance(seq, str):
+        seq = seq.encode()
+    elif not isinstance(seq, (bytes, bytearray)):
+        seq = bytes(seq)
+    return np.frombuffer(seq, dtype=np.uint8)
+
+
+def encode_seq(seq, table=read_table):
+    return table[seq_bytes(seq)]
+
+
+# Encode the reverse complement of a sequence. The table must be the
+# complement table matching the forward encoding.
+
+def encode_seq_rc(seq, table=read_complement_table):
+    return table[seq_bytes(seq)[::-1]]
+
+
+# Pack reads into one zero padded matrix of encoded bases. Returns the
+# matrix and an array with the length of each read.
+
+def pack_reads(seqs, table=read_table):
+    lengths = np.fromiter((len(s) for s in seqs), dtype=np.int64, count=len(seqs))
+    width = int(lengths.max()) if len(seqs) else 0
+    reads = np.zeros((len(seqs), width), dtype=np.uint8)
+    reads[np.arange(width) < lengths[:, None]] = encode_seq("".join(seqs), table)
+    return reads, lengths
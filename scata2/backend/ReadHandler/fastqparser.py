@@ -1,28 +1,188 @@
 
 from Bio import SeqIO
-from Bio.Seq import Seq
+from Bio.Seq import reverse_complement
 import gzip
-from .qualseq import Qual, QualSeq
+from numba import njit
+import numpy as np
+from .qualseq import Qual, QualSeq, SeqRead
 from .exceptions import ScataReadsError, ScataFileError
+from .seqio import parse_fastq
+from .encoding import encode_seq, encode_seq_rc, kmer_table, kmer_complement_table
+
+
+# Overlap detection between read 1 and the reverse complement of read 2.
+#
+# Bases are packed two bits per base into integer k-mers (see
+# encoding.kmer_table). Anything that is not A, C, G or T has code 4 and is
+# recorded in a separate one bit per base mask, so k-mers containing e.g. N
+# only match identical k-mers, just as when comparing the k-mer strings.
+
+@njit
+def kmer_keys(codes, kmer):
+    n = max(len(codes) - kmer, 0)
+    keys = np.empty(n, dtype=np.int64)
+    if n == 0:
+        return keys
+    packed = 0
+    mask = 0
+    packed_bits = (1 << (2 * kmer)) - 1
+    mask_bits = (1 << kmer) - 1
+    # Same k-mer positions as range(len(seq) - kmer), i.e. the last
+    # k-mer of the sequence is not used.
+    for i in range(n + kmer - 1):
+        c = codes[i]
+        packed = (packed << 2) & packed_bits
+        mask = (mask << 1) & mask_bits
+        if c > 3:
+            mask |= 1
+        else:
+            packed |= c
+        if i >= kmer - 1:
+            keys[i - kmer + 1] = (packed << kmer) | mask
+    return keys
+
+
+# Returns (pos1, pos2), the splice point in read 1 and in the reverse
+# complement of read 2, or (-1, -1) if no or too short kmer runs were found
+# and (-2, -2) if the longest run only had ambiguous kmer matches.
+
+@njit
+def find_overlap(codes1, codes2, kmer, hsp, min):
+    keys1 = kmer_keys(codes1, kmer)
+    keys2 = kmer_keys(codes2, kmer)
+
+    # Stable sort keeps positions of repeated kmers in ascending order
+    order = np.argsort(keys2, kind="mergesort")
+    sorted2 = keys2[order]
+    lo = np.searchsorted(sorted2, keys1, side="left")
+    hi = np.searchsorted(sorted2, keys1, side="right")
+
+    # Identify the longest kmer run. Only runs terminated by a missing
+    # kmer are considered.
+    best_start = -1
+    best_len = 0
+    total = 0
+    run_start = -1
+    for y in range(len(keys1)):
+        if hi[y] > lo[y]:
+            if run_start < 0:
+                run_start = y
+        elif run_start >= 0:
+            run_len = y - run_start
+            if run_len > hsp:
+                total += run_len
+                if run_len > best_len:
+                    best_start = run_start
+                    best_len = run_len
+            run_start = -1
+
+    if best_len == 0 or total < min:
+        return -1, -1
+
+    # Remove ambigous start/end
+    start = best_start
+    end = best_start + best_len - 1
+    while start <= end and hi[start] - lo[start] > 1:
+        start += 1
+    while end >= start and hi[end] - lo[end] > 1:
+        end -= 1
+    if start > end:
+        return -2, -2
+
+    return end, order[lo[end]]
+
+
+# Find the splice point between read 1 and the reverse complement of read 2.
+# Sequences are given as forward read strings (or encoded arrays).
+
+def kmer_overlap(s1, s2, kmer, hsp, min):
+    if isinstance(s1, str):
+        s1 = encode_seq(s1, kmer_table)
+    if isinstance(s2, str):
+        s2 = encode_seq(s2, kmer_table)
+
+    pos1, pos2 = find_overlap(s1, s2, kmer, hsp, min)
+    if pos1 == -1:
+        raise ScataReadsError("pairing_failed", "Pairing failed, no kmer runs / runs too short found")
+    if pos1 == -2:
+        raise ScataReadsError("pairing_failed", "Pairing failed, no kmer run found")
+    return int(pos1), int(pos2)
+
+
+# Reference implementation of kmer_overlap() using a dict of kmer
+# strings. Kept for verification and benchmarking.
+
+def kmer_overlap_dict(s1, s2, kmer, hsp, min):
+    # Build kmer table of read 2
+    kmers2 = dict()
+    for i in range(len(s2) - kmer):
+        k = s2[i:i + kmer]
+        kmers2.update({k : (kmers2.get(k, []) + [i])})
+
+    # Identify read1 kmers in read2
+    kmer_pos = [[x[0], kmers2.get(x[1]), x[2]] for x in
+                 [(s1[y], s1[y : y + kmer], y) for y in range(len(s1) - kmer)]]
+
+    # Identify the longest kmer run
+    runs = [ ]
+    r = [ ]
+    for i in range(len(kmer_pos)):
+        if kmer_pos[i][1]:
+            r.append(kmer_pos[i])
+        else:
+            if len(r):
+                if len(r) > hsp:
+                    runs.append(r)
+            r=[]
+    runs.sort(key=lambda a: len(a), reverse=True)
+
+    if not len(runs) or sum([len(r) for r in runs]) < min:
+        raise ScataReadsError("pairing_failed", "Pairing failed, no kmer runs / runs too short found")
+    run = runs[0]
+
+    # Remove ambigous start/end
+    while len(run):
+        if len(run[0][1]) > 1:
+            run = run[1:]
+        else:
+            break
+    while len(run):
+        if len(run[-1][1]) > 1:
+            run = run[:-1]
+        else:
+            break
+    if not len(run):
+        raise ScataReadsError("pairing_failed", "Pairing failed, no kmer run found")
+
+    return run[-1][2], run[-1][1][0]
 
 
 
 class Single:
-    
-    def __init__(self, fastq_file):
-        # Try to open as gzipped file, if that fails, open as plain fasta
-        self.fastq = SeqIO.parse(fastq_file, "fastq")
+
+    # Standard (Sanger/Illumina 1.8+) FASTQ is read by the streaming parser,
+    # any other format name is passed on to Biopython.
+
+    def __init__(self, fastq_file, file_format="fastq"):
+        self.fast = file_format == "fastq"
+        if self.fast:
+            self.fastq = parse_fastq(fastq_file)
+        else:
+            self.fastq = SeqIO.parse(fastq_file, file_format)
         self.qual_present=True
-        
+
 
     def __iter__ (self):
         return self
 
     def __next__(self):
+        if self.fast:
+            id, title, seq, phred = next(self.fastq)
+            return QualSeq(SeqRead(id, title, seq), Qual(id, phred=phred))
+
         rec = next(self.fastq)
-        q = Qual(rec.id, rec.letter_annotations["phred_quality"])
-        rec.letter_annotations=dict()
-        return QualSeq(rec, q)
+        return QualSeq(SeqRead.from_record(rec),
+                       Qual(rec.id, rec.letter_annotations["phred_quality"]))
 
 class FastQPairQualSeq(QualSeq):
     def __init__(self, s1, s2, kmer, hsp, min):
@@ -43,77 +203,60 @@ class FastQPairQualSeq(QualSeq):
         if not self.s:
             self._pair()
         return self.quals
-    
+
+    # Reads and the filters access the merged read through the QualSeq
+    # attributes, so pairing is triggered on first access.
+
+    @property
+    def seq_record(self):
+        return self.get_seq()
+
+    @seq_record.setter
+    def seq_record(self, seq_record):
+        self.s = seq_record
+
+    @property
+    def qual(self):
+        return self.get_qual()
+
+    @qual.setter
+    def qual(self, qual):
+        self.quals = qual
+
+    # Splice point of read 1 and read 2 (forward strings), see
+    # kmer_overlap()
+
+    def overlap(self, s1, s2):
+        return kmer_overlap(encode_seq(s1, kmer_table),
+                            encode_seq_rc(s2, kmer_complement_table),
+                            self.kmer, self.hsp, self.min)
 
     def _pair(self):
-        s1 = str(self.s1.seq)
-        s2_rec = self.s2.reverse_complement()
-        s2 = str(s2_rec.seq)
-
-        # Build kmer table of read 2
-        kmers2 = dict()
-        for i in range(len(s2) - self.kmer):
-            k = s2[i:i + self.kmer]
-            kmers2.update({k : (kmers2.get(k, []) + [i])})
-            
-        # Identify read1 kmers in read2
-        kmer_pos = [[x[0], kmers2.get(x[1]), x[2]] for x in
-                     [(s1[y], s1[y : y + self.kmer], y) for y in range(len(s1) - self.kmer)]]
-
-        # Identify the longest kmer run
-        runs = [ ]
-        r = [ ]
-        for i in range(len(kmer_pos)):
-            if kmer_pos[i][1]:
-                r.append(kmer_pos[i])
-            else:
-                if len(r):
-                    if len(r) > self.hsp:
-                        runs.append(r)
-                r=[]
-        runs.sort(key=lambda a: len(a), reverse=True)
-        
-
-        if not len(runs) or sum([len(r) for r in runs]) < self.min:
-            raise ScataReadsError("pairing_failed", "Pairing failed, no kmer runs / runs too short found")
-        run = runs[0]
-
-        # Remove ambigous start/end
-        while len(run):
-            if len(run[0][1]) > 1:
-                run = run[1:]
-            else:
-                break
-        while len(run):
-            if len(run[-1][1]) > 1:
-                run = run[:-1]
-            else:
-                break
-        if not len(run):
-            raise ScataReadsError("pairing_failed", "Pairing failed, no kmer run found")
-        # Splice together new sequence
-        try:
-            new_seq = s1[:run[-1][2]] + s2[run[-1][1][0]:]
-            quals = self.s1.letter_annotations["phred_quality"][:run[-1][2]] + \
-                s2_rec.letter_annotations["phred_quality"][run[-1][1][0]:]
-        except IndexError:
-            print("IndexError")
-            print(run, runs)
-            raise ScataReadsError("pairing_failed", "Pairing failed, cpuld not splice")
-        self.s=self.s2
-        self.s.letter_annotations = dict()
-        self.s.seq = Seq(new_seq)
+        s1 = self.s1.seq_record.seq
+        s2 = self.s2.seq_record.seq
+
+        pos1, pos2 = self.overlap(s1, s2)
+
+        # Splice together new sequence. Position pos2 in the reverse
+        # complement of read 2 is position len(s2) - pos2 in read 2.
+        end2 = len(s2) - pos2
+        new_seq = s1[:pos1] + reverse_complement(s2[:end2])
+        quals = np.concatenate((np.asarray(self.s1.qual.quals)[:pos1],
+                                np.asarray(self.s2.qual.quals)[:end2][::-1]))
+
+        self.s=self.s2.seq_record
+        self.s.seq = new_seq
         self.quals = Qual(self.s.id, quals)
-                
+
 class Pair:
     
     def __init__(self, fastq_1, fastq_2,
-                 kmer=7, hsp=5, min=10):
+                 kmer=7, hsp=5, min=10, file_format="fastq"):
         self.kmer=kmer
         self.hsp = hsp
         self.min = min
-        self.fastq1 = SeqIO.parse(fastq_1, "fastq")
-        self.fastq2 = SeqIO.parse(fastq_2, "fastq")
+        self.fastq1 = Single(fastq_1, file_format)
+        self.fastq2 = Single(fastq_2, file_format)
         self.qual_present = True
 
 
@@ -1,99 +1,155 @@
-from Bio.Seq import Seq
+from Bio.Seq import reverse_complement
 from .exceptions import ScataReadsError
 from .qualseq import QualSeq
+from .encoding import trans_table, complement_trans_table, complement_codes, pack_reads, seq_bytes
 from numba import njit
 import numpy as np
 
 
+# Sum and minimum of the quality values in one pass
+
+@njit
+def qual_stats(quals):
+    total = 0
+    minimum = 255
+    for q in quals:
+        total += q
+        if q < minimum:
+            minimum = q
+    return total, minimum
+
+
+# Reject reads that are too short, have too low mean quality or any base
+# below min_qual. An N in the read counts as a low quality base. Reads that
+# pass are returned unchanged.
+
 def filter_full(qualseq, min_length, mean_min, min_qual):
     seq_record = qualseq.get_seq()
     qual = qualseq.get_qual()
+    seq = seq_record.seq
+    seq_len = len(seq)
 
-    if len(seq_record.seq) < min_length:
+    if seq_len < min_length:
         raise ScataReadsError("too_short", "Read too short")
-        
-    if float(sum(qual.quals)) / len(qual.quals) < mean_min:
+
+    quals = qual.quals
+    if not isinstance(quals, np.ndarray):
+        quals = np.asarray(quals, dtype=np.int64)
+    qual_len = len(quals)
+    total, minimum = qual_stats(quals)
+
+    if float(total) / qual_len < mean_min:
         raise ScataReadsError("low_mean_quality", "Too low mean quality")
-            
-    seq_list = list(seq_record.seq)
-            
-    seq_list = list(map(lambda b, q: b if q >= min_qual else 'N',
-                   seq_list, qual.quals))
-    
-    if seq_list.count('N'):
+
+    # Bases and qualities are paired up to the shorter of the two
+    if seq_len > qual_len:
+        seq = seq[:qual_len]
+    elif seq_len < qual_len:
+        _, minimum = qual_stats(quals[:seq_len])
+
+    if minimum < min_qual or "N" in seq:
         raise ScataReadsError("low_min_quality", "Too low minimum quality")
-    
-    seq_record.seq = Seq("".join(seq_list))
-    
-    qualseq.seq_record = seq_record
+
+    if seq_len > qual_len:
+        seq_record.seq = seq
 
     return qualseq
 
-# This code is broken. Leaving it to be fixed
-# if there is demand for it.
+# Longest region in quals[start:end] with mean quality >= mean_min, in
+# linear time. With prefix sums P of (quality - mean_min) the region i..j
+# is accepted if P[j] >= P[i]. Scanning the running minimum of P from the
+# left against the running maximum from the right finds the longest such
+# region in one pass. Returns (start, end), end == start if none is found.
 
+@njit
+def longest_mean_region(quals, start, end, mean_min, prefix, left_min, right_max):
+    n = end - start
+    prefix[0] = 0.0
+    for i in range(n):
+        prefix[i + 1] = prefix[i] + (quals[start + i] - mean_min)
+
+    left_min[0] = prefix[0]
+    for i in range(1, n + 1):
+        left_min[i] = min(left_min[i - 1], prefix[i])
+    right_max[n] = prefix[n]
+    for i in range(n - 1, -1, -1):
+        right_max[i] = max(right_max[i + 1], prefix[i])
+
+    best_start = 0
+    best_end = 0
+    i = 0
+    j = 0
+    while i <= n and j <= n:
+        if right_max[j] >= left_min[i]:
+            if j - i > best_end - best_start:
+                best_start = i
+                best_end = j
+            j += 1
+        else:
+            i += 1
+    return start + best_start, start + best_end
+
+
+# Find the high quality region of a read: the longest region with mean
+# quality >= mean_min, within a run of bases with quality >= min_qual and
+# no N. Returns (start, end, longest_run), where longest_run is the length
+# of the longest run of bases above min_qual.
+
+@njit
+def find_hqr(quals, is_n, mean_min, min_qual):
+    n = len(quals)
+    prefix = np.empty(n + 1, dtype=np.float64)
+    left_min = np.empty(n + 1, dtype=np.float64)
+    right_max = np.empty(n + 1, dtype=np.float64)
+
+    best_start = 0
+    best_end = 0
+    longest_run = 0
+    run_start = 0
+    for i in range(n + 1):
+        if i < n and quals[i] >= min_qual and not is_n[i]:
+            continue
+        if i - run_start > longest_run:
+            longest_run = i - run_start
+        # No region in a shorter run can beat the best one
+        if i - run_start > best_end - best_start:
+            start, end = longest_mean_region(quals, run_start, i, mean_min,
+                                             prefix, left_min, right_max)
+            if end - start > best_end - best_start:
+                best_start = start
+                best_end = end
+        run_start = i + 1
+    return best_start, best_end, longest_run
+
+
+# Trim a read to its high quality region (see find_hqr). Reads are
+# rejected if the region is shorter than min_length.
 
 def filter_hqr(qualseq, min_length, mean_min, min_qual):
     seq_record = qualseq.get_seq()
     qual = qualseq.get_qual()
-    if len(seq_record.seq) < min_length:
+    seq = seq_record.seq
+
+    if len(seq) < min_length:
         raise ScataReadsError("too_short", "Read too short")
 
-    # Get regions with quality above minimum
-                    
-    hqr = [ ]
-                    
-    t_start=-1
-    t_end=-1
-
-    for i in range(len(qual.quals)):
-        if t_start == -1: # Outside region
-            if qual.quals[i] >= min_qual:
-                t_start = i
-        else: # Inside region
-            if qual.quals[i] < min_qual:
-                t_end = i
-                hqr.append(dict(start = t_start,
-                                end = t_end,
-                                mean_quality = 0,
-                                length = 0))
-                t_start = -1
-                t_end = -1
-    if t_start != -1 and t_end == -1:
-        hqr.append(dict(start = t_start,
-                        end = len(qual.quals) - 1,
-                        mean_quality = 0,
-                        length = 0))
-    for r in hqr:
-        if r["end"] - r["start"] < min_length:
-            continue
-        while r["end"] > r["start"] and \
-                (sum(qual.quals[r["start"]:r["end"]]) / float(r["end"] - r["start"])) \
-                < mean_min:
-            if qual.quals[r["start"]] < qual.quals[r["end"]]:
-                r["start"] += 1
-            else:
-                r["end"] -= 1
-        if r["end"] > r["start"]:
-            r["mean_qual"] = (sum(qual.quals[r["start"]:r["end"]]) / float(r["end"] - r["start"]))
-            r["length"] = r["end"] - r["start"]
-
-    hqr = [a for a in hqr if a["length"] >= min_length and a["mean_qual"] >= mean_min]
-    
-    if not len(hqr):
-        raise ScataReadsError("low_mean_quality", "Too low mean quality")
+    quals = qual.quals
+    if not isinstance(quals, np.ndarray):
+        quals = np.asarray(quals, dtype=np.int64)
+    length = min(len(seq), len(quals))
+    quals = quals[:length]
+    is_n = seq_bytes(seq[:length]) == ord("N")
 
-    hqr.sort(key=lambda a: a["length"], reverse=True)
+    start, end, longest_run = find_hqr(quals, is_n, float(mean_min), min_qual)
 
-                    
-    if hqr[0]["end"] - hqr[0]["start"] < min_length:
+    if end - start < min_length:
+        if longest_run < min_length:
+            raise ScataReadsError("low_min_quality", "Too low minimum quality")
         raise ScataReadsError("low_mean_quality", "Too low mean quality")
-                    
-    seq_record.seq = seq_record.seq[hqr[0]["start"]:hqr[0]["end"]]
-    qual.quals = qual.quals[hqr[0]["start"]:hqr[0]["end"]]
 
-    qualseq.seq_record = seq_record
-    qualseq.qual = qual
+    seq_record.seq = seq[start:end]
+    qual.quals = quals[start:end]
+
     return qualseq
 
 
@@ -111,41 +167,16 @@ class DeTaggedSeq(QualSeq):
             len=len(self.seq_record.seq)
         )        
 
-base_A = 1
-base_C = 2
-base_G = 4
-base_T = 8
-trans_table = { 'A' : base_A,
-                'C' : base_C,
-                'G' : base_G,
-                'T' : base_T,
-                'R' : base_A | base_G,
-                'Y' : base_C | base_T,
-                'S' : base_G | base_C,
-                'W' : base_A | base_T,
-                'K' : base_G | base_T,
-                'M' : base_A | base_C,
-                'B' : base_C | base_G | base_T,
-                'D' : base_A | base_G | base_T,
-                'H' : base_A | base_C | base_T,
-                'V' : base_A | base_C | base_G,
-                'N' : base_A | base_C | base_T | base_G }
-
-complement_trans_table = { 'A' : base_T,
-                'C' : base_G,
-                'G' : base_C,
-                'T' : base_A,
-                'R' : base_T | base_C,
-                'Y' : base_G | base_A,
-                'S' : base_C | base_G,
-                'W' : base_T | base_A,
-                'K' : base_C | base_A,
-                'M' : base_T | base_G,
-                'B' : base_G | base_C | base_A,
-                'D' : base_T | base_C | base_A,
-                'H' : base_T | base_G | base_A,
-                'V' : base_T | base_G | base_C,
-                'N' : base_T | base_G | base_A | base_C }
+@njit
+def primer_matches(seq_ar, x, primer_ar, score):
+    mismatches = 0
+    for i in range(len(primer_ar)):
+        if primer_ar[i] & seq_ar[x + i] == 0:
+            mismatches += 1
+            if mismatches > score:
+                return False
+    return True
+
 
 # This function is type hinted to ensure proper numba optimisation
 
@@ -154,17 +185,50 @@ def find_primer_pos(seq_ar, primer_ar, score, reverse=False):
     p_len = len(primer_ar)
     if not reverse:
         for x in range(0, min(len(seq_ar), 20000) - p_len):
-            m = np.count_nonzero(np.bitwise_and(primer_ar, seq_ar[x:x + p_len]))
-            if p_len - m <= score:
+            if primer_matches(seq_ar, x, primer_ar, score):
                 return x
     else:
         for x in range(len(seq_ar) - p_len - 1, 0, -1):
-            m = np.count_nonzero(np.bitwise_and(primer_ar, seq_ar[x:x + p_len]))
-            if p_len - m <= score:
+            if primer_matches(seq_ar, x, primer_ar, score):
                 return x
     return -1
 
 
+# Find primer positions for a matrix of packed reads. Reads where the 5'
+# primer is not found are searched again as reverse complement. Returns
+# arrays with 5' and 3' primer positions (-1 if not found), in the
+# orientation given by the reversed array.
+
+@njit
+def find_primers(reads, lengths, p5_ar, p5s, p3_ar, p3s):
+    n = reads.shape[0]
+    p5_pos = np.full(n, -1, dtype=np.int64)
+    p3_pos = np.full(n, -1, dtype=np.int64)
+    reversed = np.zeros(n, dtype=np.bool_)
+    rev_buf = np.empty(reads.shape[1], dtype=np.uint8)
+
+    for i in range(n):
+        length = lengths[i]
+        seq_ar = reads[i, :length]
+        pos = 0
+        if len(p5_ar):
+            pos = find_primer_pos(seq_ar, p5_ar, p5s)
+            if pos < 0:
+                for j in range(length):
+                    rev_buf[j] = complement_codes[seq_ar[length - j - 1]]
+                seq_ar = rev_buf[:length]
+                reversed[i] = True
+                pos = find_primer_pos(seq_ar, p5_ar, p5s)
+            if pos < 0:
+                continue
+        p5_pos[i] = pos
+
+        if len(p3_ar):
+            p3_pos[i] = find_primer_pos(seq_ar, p3_ar, p3s, True)
+
+    return p5_pos, p3_pos, reversed
+
+
 class SeqDeTagger:
     # Translation of bases for primer identification.
     def __init__(self, amplicon, t5=None, t3=None, keep_primer=False):
@@ -178,104 +242,142 @@ class SeqDeTagger:
 
         # Translate primer sequence
         self.p5 = [trans_table[x] for x in p5.upper() if x in trans_table]
-        self.p5_ar = np.array(self.p5, dtype=int)
+        self.p5_ar = np.array(self.p5, dtype=np.uint8)
         self.p3 = [complement_trans_table[x] for x in p3.upper() if x in complement_trans_table]
         self.p3.reverse()
-        self.p3_ar = np.array(self.p3, dtype=int)
+        self.p3_ar = np.array(self.p3, dtype=np.uint8)
         self.p5len = float(len(self.p5))
         self.p3len = float(len(self.p3))
 
         print(int(self.p5s))
-    # Function to detag sequence and return a dict()
-    # with sequence and metadata
+
+    # Function to detag sequence and return a DeTaggedSeq
 
     def detag_seq(self, qualseq):
-    
+        result = self.detag_batch([qualseq])[0]
+        if isinstance(result, ScataReadsError):
+            raise result
+        return result
+
+    # Find 5' and 3' primer positions for a list of sequence strings
+
+    def find_primers(self, seqs):
+        reads, lengths = pack_reads(seqs)
+        return find_primers(reads, lengths,
+                            self.p5_ar, int(self.p5s),
+                            self.p3_ar, int(self.p3s))
+
+    # Detag a list of reads. Returns a list with a DeTaggedSeq, or the
+    # ScataReadsError describing why it was rejected, for each read.
+
+    def detag_batch(self, qualseqs):
+        results = [None] * len(qualseqs)
+        seqs = []
+        found = []
+        for i, qualseq in enumerate(qualseqs):
+            try:
+                seqs.append(qualseq.get_seq().seq.upper())
+                found.append(i)
+            except ScataReadsError as e:
+                results[i] = e
+
+        p5_pos, p3_pos, reversed = self.find_primers(seqs)
+
+        for j, i in enumerate(found):
+            try:
+                results[i] = self._detag(qualseqs[i], int(p5_pos[j]),
+                                         int(p3_pos[j]), bool(reversed[j]))
+            except ScataReadsError as e:
+                results[i] = e
+        return results
+
+    # Detag a list of sequence strings without quality data. Returns the
+    # amplicon sequence, or the ScataReadsError describing why it was
+    # rejected, for each read.
+
+    def detag_seqs(self, seqs):
+        p5_pos, p3_pos, reversed = self.find_primers([s.upper() for s in seqs])
+        results = []
+        for i, seq in enumerate(seqs):
+            if self.p5 and reversed[i]:
+                seq = reverse_complement(seq)
+            try:
+                tag, start, end = self._locate(seq, int(p5_pos[i]), int(p3_pos[i]))
+                results.append(seq[start:end])
+            except ScataReadsError as e:
+                results.append(e)
+        return results
+
+    def _detag(self, qualseq, p5_pos, p3_pos, reversed):
         result = DeTaggedSeq()
         seq_record = qualseq.get_seq()
         seq = seq_record.seq
-        seq_str = str(seq)
-        seq_ar = np.array([trans_table[x] if not x == 'N' else 0 for x in str(seq).upper() if x in trans_table],
-                            dtype=int)
-        
-        q=qualseq.get_qual()        
 
-        p5_pos = -1
-        accepted_t3 = set()
-        if self.p5:
-            p5_len = len(self.p5)
+        q=qualseq.get_qual()
 
-            p5_pos = find_primer_pos(seq_ar, self.p5_ar, int(self.p5s))
+        if self.p5 and reversed:
+            result.reversed = True
+            seq = reverse_complement(seq)
+            if q:
+                q.quals = q.quals[::-1]
 
-            if p5_pos < 0:
-                result.reversed = True
-                seq = seq.reverse_complement()
-                if q:
-                    q.quals.reverse()
-                seq_str = str(seq)
-                seq_ar = np.array([trans_table[x] if not x == 'N' else 0 for x in str(seq).upper() if x in trans_table],
-                                  dtype=int)
+        result.tag, start, end = self._locate(seq, p5_pos, p3_pos)
 
-                p5_pos = find_primer_pos(seq_ar, self.p5_ar, int(self.p5s))
+        seq_record.seq = seq[start:end]
+        result.seq_record = seq_record
+        if q:
+            q.quals = q.quals[start:end]
+            result.qual = q
 
+        return result
+
+    # Find tag and amplicon of a read, in the orientation the primers were
+    # found in. Returns (tag, start, end) of the amplicon, end is None if
+    # there is no 3' primer.
+
+    def _locate(self, seq_str, p5_pos, p3_pos):
+        accepted_t3 = set()
+        p5_len = len(self.p5)
+        if self.p5:
             if p5_pos < 0:
                 raise ScataReadsError("no_primer5", "No 5' primer found")
-            
         else:
             p5_pos=0
-        
+
         if self.t5:
             tag_len = len(next(iter(self.t5)))
             tag_seq = seq_str[(p5_pos - tag_len):p5_pos]
             try:
-                result.tag = self.t5[tag_seq]['name']
+                tag = self.t5[tag_seq]['name']
                 accepted_t3 = self.t5[tag_seq]['mates']
             except KeyError:
                 raise ScataReadsError("no_tag5", "No 5' tag found")
         else:
-            result.tag = ""
-        
+            tag = ""
+
         if not self.keep_primer:
             p5_pos += p5_len
 
-        p3_pos = -1
-
-        if self.p3:
-            p3_len = len(self.p3)
-
-            p3_pos = find_primer_pos(seq_ar, self.p3_ar, int(self.p3s), True)
-            if p3_pos < 0:
-                raise ScataReadsError("no_primer3", "No 3' primer found")
-    
-            if self.t3:
-                tag_len = len(next(iter(self.t3)))
-                tag_seq = seq_str[(p3_pos + len(self.p3)):(p3_pos + len(self.p3) + tag_len)]
-                tag_seq = str(Seq(tag_seq).reverse_complement())
-                try:
-                    if len(accepted_t3) and self.t3[tag_seq]['name'] not in accepted_t3:
-                        raise ScataReadsError("chimeric_tag", "Chimeric tags")                    
-                    result.tag += ("_" + self.t3[tag_seq]['name'])
-                except KeyError:
-                    raise ScataReadsError("no_tag3", "No 3' tag found")
-            else:
-                result.tag += ""
-
-                if self.keep_primer:
-                    p3_pos += p3_len
-
-            seq_record.seq = seq[p5_pos:p3_pos]
-            result.seq_record = seq_record
-            if q:
-                q.quals = q.quals[p5_pos:p3_pos]
-                result.qual = q
+        if not self.p3:
+            return tag, p5_pos, None
 
-        else:
-            seq_record.seq = seq[p5_pos:]
-            result.seq_record = seq_record
-            if q:
-                q.quals = q.quals[p5_pos:]
-                result.qual = q
+        p3_len = len(self.p3)
 
-            
-        return result
+        if p3_pos < 0:
+            raise ScataReadsError("no_primer3", "No 3' primer found")
+
+        if self.t3:
+            tag_len = len(next(iter(self.t3)))
+            tag_seq = seq_str[(p3_pos + len(self.p3)):(p3_pos + len(self.p3) + tag_len)]
+            tag_seq = reverse_complement(tag_seq)
+            try:
+                if len(accepted_t3) and self.t3[tag_seq]['name'] not in accepted_t3:
+                    raise ScataReadsError("chimeric_tag", "Chimeric tags")
+                tag += ("_" + self.t3[tag_seq]['name'])
+            except KeyError:
+                raise ScataReadsError("no_tag3", "No 3' tag found")
+        else:
+            if self.keep_primer:
+                p3_pos += p3_len
 
+        return tag, p5_pos, p3_pos
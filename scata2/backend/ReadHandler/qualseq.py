@@ -1,3 +1,22 @@
+import numpy as np
+
+
+# Id, title and sequence string of a read. Used instead of a Biopython
+# SeqRecord, which is costly to build for every read of a dataset. The
+# filters replace seq with trimmed or reverse complemented strings.
+
+class SeqRead:
+    __slots__ = ("id", "description", "seq")
+
+    def __init__(self, id, description, seq):
+        self.id = id
+        self.description = description
+        self.seq = seq
+
+    @classmethod
+    def from_record(cls, seq_record):
+        return cls(seq_record.id, seq_record.description, str(seq_record.seq))
+
 
 class QualSeq:
     def __init__(self, seq_record, qual=None):
@@ -15,11 +34,26 @@ class QualSeq:
 
 
 
+# Quality values of a read. Either given as a list/array of values, or as
+# the raw FASTQ quality string (phred), which is decoded to a uint8 array
+# on first access.
+
 class Qual:
-    def __init__ (self, name, qual):
+    def __init__ (self, name, qual=None, phred=None, offset=33):
         self.name = name
-        self.quals = qual
-    
+        self._quals = qual
+        self.phred = phred
+        self.offset = offset
+
+    @property
+    def quals(self):
+        if self._quals is None and self.phred is not None:
+            self._quals = np.frombuffer(self.phred, dtype=np.uint8) - np.uint8(self.offset)
+        return self._quals
+
+    @quals.setter
+    def quals(self, quals):
+        self._quals = quals
 
     def __getitem__ (self, item):
         return int(self.quals[item])
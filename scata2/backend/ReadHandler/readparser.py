@@ -1,8 +1,10 @@
 # Parser to read and quality-filter Read results
 
+import gzip
+from collections import deque
 from Bio import SeqIO
-from Bio.Seq import Seq
-from .qualseq import QualSeq, QualFile
+from .qualseq import QualSeq, QualFile, SeqRead
+from .seqio import parse_fasta
 from .filterseq import filter_full, filter_hqr, SeqDeTagger
 from .fastqparser import Single, Pair
 from .exceptions import ScataFileError, ScataReadsError
@@ -11,7 +13,7 @@ from .exceptions import ScataFileError, ScataReadsError
 
 
 class RawReads:
-    def __init__(self, fasta, qual_file=None):
+    def __init__(self, fasta, qual_file=None, file_format="fasta"):
         self.qual_present = True
         if qual_file:
             try:
@@ -20,13 +22,21 @@ class RawReads:
                 ScataFileError("bad_qualfile", "Bad .qual file")
         else:
             self.qual_present = False
-        self.fasta = SeqIO.parse(fasta, "fasta")
+        self.fast = file_format == "fasta"
+        if self.fast:
+            self.fasta = parse_fasta(fasta)
+        else:
+            self.fasta = SeqIO.parse(fasta, file_format)
 
     def __iter__ (self):
         return self
 
     def __next__(self):
-        seq_record = next(self.fasta)
+        if self.fast:
+            id, title, seq, _ = next(self.fasta)
+            seq_record = SeqRead(id, title, seq)
+        else:
+            seq_record = SeqRead.from_record(next(self.fasta))
         qual = None
         if self.qual_present:
             qual = next(self.qual)
@@ -50,7 +60,9 @@ class Reads:
                  amplicon=None,
                  kmer=7, hsp=5, hsp_min=10,
                  keep_primer=True,
-                 ignore_tags = False):
+                 ignore_tags = False,
+                 batch_size=1000,
+                 fastq_format="fastq"):
         self.mean_min = int(mean_min)
         self.min_qual = int(min_qual)
         self.stats = dict(count = 0,
@@ -59,6 +71,8 @@ class Reads:
                           low_mean = 0,
                           low_min_quality = 0)
         self.filtering = filtering
+        self.batch_size = batch_size
+        self.queue = deque()
 
         if amplicon:
             self.min_length = amplicon.min_length
@@ -83,10 +97,11 @@ class Reads:
 
 
         if file_type == "fastq":
-            self.rawreads = Single(file1)
-        elif file_type == "fastq":
+            self.rawreads = Single(file1, fastq_format)
+        elif file_type == "fastp":
             self.rawreads = Pair(file1, file2,
-                                 kmer=kmer, hsp=hsp, min=hsp_min)
+                                 kmer=kmer, hsp=hsp, min=hsp_min,
+                                 file_format=fastq_format)
         elif file_type == "fasta":
             self.rawreads = RawReads(file1)
         else:
@@ -96,49 +111,105 @@ class Reads:
         return self
 
     def __next__ (self):
-
-        qualseq = next(self.rawreads)
-        
+        if not self.queue:
+            self._fill()
+        if not self.queue:
+            raise StopIteration
+
+        read = self.queue.popleft()
+        if isinstance(read, Exception):
+            raise read
+        return read
+
+    # Read and filter the next batch of reads. Reads are first passed
+    # through the per read filter, reads to be detagged are then detagged
+    # together and finally passed through the post detag filter. Results,
+    # and exceptions for rejected reads, are queued in read order.
+
+    def _fill(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                qualseq = next(self.rawreads)
+            except StopIteration:
+                break
+            except (ScataFileError, gzip.BadGzipFile) as e:
+                batch.append(e)
+                break
+            try:
+                batch.append(self._pre_detag(qualseq))
+            except (ScataReadsError, ScataFileError) as e:
+                batch.append(e)
+
+        to_detag = [i for i, r in enumerate(batch) if isinstance(r, DetagPending)]
+        if to_detag:
+            detagged = self.detagger.detag_batch([batch[i].qualseq for i in to_detag])
+            for i, ds in zip(to_detag, detagged):
+                if isinstance(ds, ScataReadsError):
+                    batch[i] = ds
+                    continue
+                try:
+                    batch[i] = self._post_detag(ds)
+                except ScataReadsError as e:
+                    batch[i] = e
+
+        self.queue.extend(batch)
+
+    # Filtering before detagging. Returns the final read, or a DetagPending
+    # for reads that should be detagged.
+
+    def _pre_detag(self, qualseq):
         if self.filtering == "fs":
             if self.detagger:
-                ds = self.detagger.detag_seq(qualseq)
-                if len(ds) < self.min_length:
-                    raise ScataReadsError("too_short", "Read too short")
-                return ds
-            else:
-                if len(qualseq) < self.min_length:
-                    raise ScataReadsError("too_short", "Read too short")
-                return qualseq
+                return DetagPending(qualseq)
+            if len(qualseq) < self.min_length:
+                raise ScataReadsError("too_short", "Read too short")
+            return qualseq
+
+        if self.filtering == "amp":
+            if not self.detagger:
+                raise ScataFileError("no_amplicon", "Amplicon extraction requires a defined amplicon")
+            return DetagPending(qualseq)
 
         if not qualseq.qual:
             raise ScataFileError("missing_qual", "Selected filtering method requires quality data")
-        
-        qs = None
+
         if self.filtering == "fsq":
             qs = filter_full(qualseq, self.min_length,
-                               self.mean_min, self.min_qual)
+                             self.mean_min, self.min_qual)
             if self.detagger:
-                ds = self.detagger.detag_seq(qs)
-                if len(ds) < self.min_length:
-                    raise ScataReadsError("too_short", "Read too short")
-                return ds
-            else:
-                if len(qs) < self.min_length:
-                    raise ScataReadsError("too_short", "Read too short")
-                return qs
+                return DetagPending(qs)
+            if len(qs) < self.min_length:
+                raise ScataReadsError("too_short", "Read too short")
+            return qs
 
         elif self.filtering == "hqr":
-            qs = filter_hqr(qualseq, self.min_length, 
-                                  self.mean_min, self.min_qual)
+            qs = filter_hqr(qualseq, self.min_length,
+                            self.mean_min, self.min_qual)
             if self.detagger:
-                return self.detagger.detag_seq(qs)
-            else:
-                return qs
+                return DetagPending(qs)
+            return qs
+
         elif self.filtering == "ampq":
             if not self.detagger:
                 raise ScataFileError("no_amplicon", "Amplicon quality reuires a defined amplicon")
-            detagged = self.detagger.detag_seq(qualseq)
-            return filter_full(detagged, self.min_length,
-                               self.mean_min, self.min_qual)        
+            return DetagPending(qualseq)
+
+        raise ScataFileError("bad_filtering", "Unknown filtering method")
+
+    # Filtering after detagging
+
+    def _post_detag(self, ds):
+        if self.filtering in ("fs", "fsq", "hqr", "amp"):
+            if len(ds) < self.min_length:
+                raise ScataReadsError("too_short", "Read too short")
+            return ds
+        elif self.filtering == "ampq":
+            return filter_full(ds, self.min_length,
+                               self.mean_min, self.min_qual)
+        return ds
 
 
+class DetagPending:
+    def __init__(self, qualseq):
+        self.qualseq = qualseq
@@ -0,0 +1,60 @@
+# Lightweight streaming FASTQ/FASTA parsers.
+#
+# The parsers yield plain (id, title, seq, qual) tuples, with the quality
+# string left undecoded, instead of building a SeqRecord with a list of
+# per-base qualities for every read. Qualities are decoded on demand by
+# Qual (see qualseq.py). Wrapped (multi-line) records are supported.
+# Biopython's SeqIO is still used for formats not handled here.
+
+from .exceptions import ScataFileError
+
+
+def parse_fastq(handle):
+    lines = iter(handle)
+    for title in lines:
+        if title[0] != "@":
+            if not title.strip():
+                continue
+            raise ScataFileError("bad_format", "FASTQ record does not start with @")
+
+        seq = next(lines, "").rstrip()
+        line = next(lines, "")
+        while line and line[0] != "+":
+            seq += line.rstrip()
+            line = next(lines, "")
+        if not line:
+            raise ScataFileError("bad_format", "Truncated FASTQ record")
+
+        qual = next(lines, "").rstrip()
+        while len(qual) < len(seq):
+            line = next(lines, "")
+            if not line:
+                break
+            qual += line.rstrip()
+
+        title = title[1:].rstrip()
+        id = title.split(None, 1)[0] if title else ""
+        if len(qual) != len(seq):
+            raise ScataFileError("length_mismatch",
+                                 "Length of sequence and quality mismatch: " + id)
+        yield id, title, seq, qual.encode()
+
+
+def parse_fasta(handle):
+    title = None
+    seq = []
+    for line in handle:
+        if line[0] == ">":
+            if title is not None:
+                yield fasta_record(title, seq)
+            title = line[1:].rstrip()
+            seq = []
+        elif title is not None:
+            seq.append(line.strip())
+    if title is not None:
+        yield fasta_record(title, seq)
+
+
+def fasta_record(title, seq):
+    id = title.split(None, 1)[0] if title else ""
+    return id, title, "".join(seq).replace(" ", ""), None
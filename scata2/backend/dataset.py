@@ -1,53 +1,138 @@
 import gzip
+import io
 import pickle
 from io import BytesIO
 import time
+from django.conf import settings
 from django.core.files import File
-from scata2.models import ScataDataset, ScataErrorType
+from scata2.models import ScataDataset, ScataDatasetShard, ScataErrorType
 from scata2.backend.ReadHandler import Reads, ScataReadsError, ScataFileError
 from scata2.backend.dataset_stats import dataset_stats
+from scata2.backend.seqstore import save_seqstore
 import django_q.tasks as q2
 
 
 def check_dataset(pk):
     dataset = ScataDataset.objects.get(pk=pk)
 
-    # Dictionary with all reads, with id as key
-    #
-    # {"read_id" : "read sequence"}
-    #
-    seqs = dict()
-
-    # Dictionary of mappings between tag and readIDs
-    #
-    #  {"tag_id":{"seq_ids":{ .. }, "cnt": NN, "rev": NN}
-    #
-    tags = dict()
+    start_time = time.process_time()
 
     try:
+        if settings.DATASET_SHARD_SIZE and split_shards(dataset, start_time):
+            # Finished by merge_shards() when the last shard is done
+            return
+
         file1 = gzip.open(dataset.file1.file.open(mode="rb"), mode="rt")
         if dataset.file2:
             file2 = gzip.open(dataset.file2.file.open(mode="rb"), mode="rt")
         else:
             file2 = None
+
+        def progress(total_reads, good_reads):
+            dataset.refresh_from_db()
+            if dataset.deleted:
+                return False
+            dataset.progress = ("Filtering, {t} reads done. {g} reads " +
+                                "accepted").format(g=good_reads,
+                                                   t=total_reads)
+            dataset.save()
+            return True
+
+        result = filter_reads(open_reads(dataset, file1, file2), progress)
+    except ScataFileError as e:
+        fail_dataset(dataset, "Failed: " + e.message)
+        return
     except gzip.BadGzipFile:
-        dataset.validated = True
-        dataset.is_valid = False
-        dataset.progress = "Failed: not a gzipped file"
-        dataset.save()
+        fail_dataset(dataset, "Failed: not a gzipped file/broken gzip file")
         return
 
-    reads = Reads(file1=file1,
-                  file2=file2,
-                  file_type=dataset.file_types,
-                  filtering=dataset.filter_method,
-                  mean_min=dataset.mean_qual, min_qual=dataset.min_qual,
-                  amplicon=dataset.amplicon,
-                  kmer=dataset.kmer_size,
-                  hsp=dataset.kmer_shared,
-                  hsp_min=dataset.kmer_hsp_count)
+    finish_dataset(dataset, result, time.process_time() - start_time)
 
-    start_time = time.process_time()
+
+# Save the filtering result of a dataset, result is None if the dataset
+# was deleted while filtering.
+
+def finish_dataset(dataset, result, process_time):
+    pk = dataset.pk
+    if result is None:
+        print("Dataset {} deleted".format(dataset.pk))
+        return
+
+    seqs, tags, filter_results, total_reads, good_reads, rev_reads = result
+
+    dataset.refresh_from_db()
+    if dataset.deleted:
+        print("Dataset {} deleted".format(dataset.pk))
+        return
+    dataset.progress = "Finalising, {g}/{t} good reads".format(g=good_reads,
+                                                               t=total_reads)
+    dataset.save()
+
+    # Save data to file
+    save_seqstore(dataset, seqs, tags)
+
+    dataset.seq_count = good_reads
+    dataset.seq_total = total_reads
+    dataset.seq_rev = rev_reads
+    dataset.tag_count = len(tags)
+    dataset.process_time = process_time
+    dataset.validated = True
+    if good_reads > 0:
+        dataset.is_valid = True
+    dataset.progress = "Ready, {g}/{t} good reads".format(g=good_reads,
+                                                          t=total_reads)
+    dataset.save()
+
+    for e in filter_results.items():
+        err = ScataErrorType()
+        err.error = e[0]
+        err.message = e[1]['msg']
+        err.count = e[1]['cnt']
+        err.dataset = dataset
+        err.save()
+
+    q2.async_task(dataset_stats, pk,
+                  task_name="dataset stats pk={id}".format(id=pk))
+
+
+def fail_dataset(dataset, message):
+    dataset.validated = True
+    dataset.is_valid = False
+    dataset.progress = message
+    dataset.save()
+
+
+def open_reads(dataset, file1, file2):
+    return Reads(file1=file1,
+                 file2=file2,
+                 file_type=dataset.file_types,
+                 filtering=dataset.filter_method,
+                 mean_min=dataset.mean_qual, min_qual=dataset.min_qual,
+                 amplicon=dataset.amplicon,
+                 kmer=dataset.kmer_size,
+                 hsp=dataset.kmer_shared,
+                 hsp_min=dataset.kmer_hsp_count)
+
+
+# Run all reads through filtering and detagging. progress(total, good) is
+# called every 10000 reads, filtering is aborted (returning None) if it
+# returns False. ScataFileError and gzip errors are passed on to the caller.
+#
+# Returns (seqs, tags, filter_results, total_reads, good_reads, rev_reads)
+
+def filter_reads(reads, progress=None):
+
+    # Dictionary with all reads, with id as key
+    #
+    # {"read_id" : "read sequence"}
+    #
+    seqs = dict()
+
+    # Dictionary of mappings between tag and readIDs
+    #
+    #  {"tag_id":{"seq_ids":{ .. }, "cnt": NN, "rev": NN}
+    #
+    tags = dict()
 
     total_reads = 0
     good_reads = 0
@@ -56,17 +141,11 @@ def check_dataset(pk):
     filter_results = dict()
     while True:
         try:
-            total_reads += 1
-            if total_reads % 10000 == 0:
-                dataset.refresh_from_db()
-                if dataset.deleted:
-                    print("Dataset {} deleted".format(dataset.pk))
-                    return
-                dataset.progress = ("Filtering, {t} reads done. {g} reads " +
-                                    "accepted").format(g=good_reads,
-                                                       t=total_reads)
-                dataset.save()
+            if progress and total_reads % 10000 == 0 and total_reads:
+                if not progress(total_reads, good_reads):
+                    return None
             read = next(reads)
+            total_reads += 1
 
             if read.tag in tags:
                 tags[read.tag]["cnt"] += 1
@@ -85,68 +164,286 @@ def check_dataset(pk):
                 rev_reads += 1
 
         except ScataReadsError as e:
+            total_reads += 1
             if e.error in filter_results:
                 filter_results[e.error]["cnt"] += 1
             else:
                 filter_results[e.error] = {"msg": e.message,
                                            "cnt": 1}
-        except ScataFileError as e:
-            dataset.validated = True
-            dataset.is_valid = False
-            dataset.progress = "Failed: " + e.message
-            dataset.save()
-            return
-        except gzip.BadGzipFile:
-            dataset.validated = True
-            dataset.is_valid = False
-            dataset.progress = "Failed: not a gzipped file/broken gzip file"
-            dataset.save()
-            return
         except StopIteration:
             break
 
-    dataset.refresh_from_db()
-    if dataset.deleted:
-        print("Dataset {} deleted".format(dataset.pk))
-        return
-    dataset.progress = "Finalising, {g}/{t} good reads".format(g=good_reads,
-                                                               t=total_reads)
+    return seqs, tags, filter_results, total_reads, good_reads, rev_reads
+
+
+# Sharded filtering. Datasets with more than DATASET_SHARD_SIZE reads are
+# split into record-aligned ranges of that many reads, which are filtered
+# as separate tasks reading their range of the dataset files. Each shard
+# task reports to check_dataset_shard_done() from its hook, and the last
+# one starts merge_shards(), so no worker waits for the others.
+#
+# Returns True if shard tasks were started, False if the dataset is to be
+# filtered unsharded.
+
+def split_shards(dataset, start_time):
+    dataset.progress = "Counting reads"
     dataset.save()
 
-    # Save data to files
-    with BytesIO() as tag_file:
-        with gzip.open(tag_file, mode="wb") as gz:
-            pickle.dump(tags, gz)
-        tag_file.seek(0)
-        name = "tags_{id}".format(id=pk)
-        dataset.tags.save(name, File(tag_file, name=name))
-
-    with BytesIO() as seq_file:
-        with gzip.open(seq_file, "wb") as gz:
-            pickle.dump(seqs, gz)
-        seq_file.seek(0)
-        name = "seqs_{id}".format(id=pk)
-        dataset.sequences.save(name, File(seq_file, name=name))
+    ScataDatasetShard.objects.filter(dataset=dataset).delete()
+    shard_size = settings.DATASET_SHARD_SIZE
+    with gzip.open(dataset.file1.file.open(mode="rb")) as f:
+        offsets1, count = shard_offsets(f, dataset.file_types, shard_size)
+    if dataset.file2:
+        with gzip.open(dataset.file2.file.open(mode="rb")) as f:
+            offsets2, count2 = shard_offsets(f, dataset.file_types, shard_size)
+        # Files with different read counts fail in the parser
+        if count2 != count:
+            return False
+    else:
+        offsets2 = [0] * len(offsets1)
+    if count <= shard_size:
+        return False
 
-    dataset.seq_count = good_reads
-    dataset.seq_total = total_reads
-    dataset.seq_rev = rev_reads
-    dataset.tag_count = len(tags)
+    shards = []
+    for num in range(len(offsets1) - 1):
+        shard = ScataDatasetShard()
+        shard.dataset = dataset
+        shard.num = num
+        shard.start1, shard.end1 = offsets1[num], offsets1[num + 1]
+        shard.start2, shard.end2 = offsets2[num], offsets2[num + 1]
+        shard.save()
+        shards.append(shard)
+
+    dataset.progress = "Filtering, 0/{n} shards".format(n=len(shards))
     dataset.process_time = time.process_time() - start_time
-    dataset.validated = True
-    if good_reads > 0:
-        dataset.is_valid = True
-    dataset.progress = "Ready, {g}/{t} good reads".format(g=good_reads,
-                                                          t=total_reads)
     dataset.save()
+    task_group = "scata_dataset_{}".format(dataset.pk)
+    for shard in shards:
+        q2.async_task(check_dataset_shard, shard.pk,
+                      group=task_group,
+                      hook="scata2.backend.dataset.check_dataset_shard_done",
+                      task_name="dataset shard pk={} {}/{}".format(dataset.pk,
+                                                                   shard.num + 1,
+                                                                   len(shards)))
+    return True
 
-    for e in filter_results.items():
-        err = ScataErrorType()
-        err.error = e[0]
-        err.message = e[1]['msg']
-        err.count = e[1]['cnt']
-        err.dataset = dataset
-        err.save()
 
-    q2.async_task(dataset_stats, pk,
-                  task_name="dataset stats pk={id}".format(id=pk))
+# django-q hook of the shard tasks. A shard task that failed without
+# recording an error is marked as failed.
+
+def check_dataset_shard_done(task):
+    shard = ScataDatasetShard.objects.filter(pk=task.args[0]).select_related("dataset").first()
+    if shard is None:
+        return
+    dataset = shard.dataset
+    if dataset.deleted:
+        return
+    if not task.success and not shard.done and not shard.error:
+        shard.error = "Filtering of shard {} failed".format(shard.num + 1)
+        shard.save(update_fields=["error"])
+
+    shards = ScataDatasetShard.objects.filter(dataset=dataset)
+    done = shards.filter(done=True).count() + shards.exclude(error="").count()
+    counts = shards.values_list("total_reads", "good_reads")
+    if done < len(counts):
+        ScataDataset.objects.filter(pk=dataset.pk).update(
+            progress=("Filtering, {t} reads done. {g} reads " +
+                      "accepted ({d}/{n} shards)").format(t=sum(c[0] for c in counts),
+                                                          g=sum(c[1] for c in counts),
+                                                          d=done, n=len(counts)))
+        return
+
+    # Only the first hook to see all shards done starts the merge
+    if ScataDataset.objects.filter(pk=dataset.pk).exclude(progress="Merging shards"). \
+            update(progress="Merging shards") == 0:
+        return
+    q2.async_task(merge_shards, dataset.pk,
+                  task_name="dataset merge pk={}".format(dataset.pk))
+
+
+def merge_shards(pk):
+    dataset = ScataDataset.objects.get(pk=pk)
+    q2.delete_group("scata_dataset_{}".format(pk))
+    start_time = time.process_time()
+    try:
+        result, shard_time = merge_shard_results(dataset)
+    except ScataFileError as e:
+        fail_dataset(dataset, "Failed: " + e.message)
+        return
+    finish_dataset(dataset, result,
+                   dataset.process_time + shard_time + time.process_time() - start_time)
+
+
+# Merge the results of the shards of a dataset, None if the dataset was
+# deleted. Returns the result and the process time of the shard tasks.
+
+def merge_shard_results(dataset):
+    dataset.refresh_from_db()
+    if dataset.deleted:
+        return None, 0.0
+
+    # Merge shard results
+    seqs = dict()
+    tags = dict()
+    filter_results = dict()
+    total_reads = 0
+    good_reads = 0
+    rev_reads = 0
+    process_time = 0.0
+
+    for shard in ScataDatasetShard.objects.filter(dataset=dataset).order_by("num"):
+        if shard.error:
+            raise ScataFileError(shard.error, shard.error)
+        if not shard.done:
+            dataset.refresh_from_db()
+            if dataset.deleted:
+                return None, 0.0
+            raise ScataFileError("shard_failed", "Filtering of shard {} failed".format(shard.num + 1))
+
+        with shard.result.open(mode="rb") as f:
+            with gzip.open(f, mode="rb") as gz:
+                s_seqs, s_tags, s_filter_results, s_total, s_good, s_rev = pickle.load(gz)
+
+        seqs.update(s_seqs)
+        for tag, tag_data in s_tags.items():
+            if tag in tags:
+                tags[tag]["cnt"] += tag_data["cnt"]
+                tags[tag]["rev"] += tag_data["rev"]
+                tags[tag]["seq_ids"] |= tag_data["seq_ids"]
+            else:
+                tags[tag] = tag_data
+        for error, error_data in s_filter_results.items():
+            if error in filter_results:
+                filter_results[error]["cnt"] += error_data["cnt"]
+            else:
+                filter_results[error] = error_data
+        total_reads += s_total
+        good_reads += s_good
+        rev_reads += s_rev
+        process_time += shard.process_time
+
+    ScataDatasetShard.objects.filter(dataset=dataset).delete()
+
+    return (seqs, tags, filter_results, total_reads, good_reads, rev_reads), process_time
+
+
+# Filter one shard, saving the result with the shard
+
+def check_dataset_shard(pk):
+    shard = ScataDatasetShard.objects.get(pk=pk)
+    dataset = shard.dataset
+
+    def progress(total_reads, good_reads):
+        dataset.refresh_from_db()
+        if dataset.deleted:
+            return False
+        shard.total_reads = total_reads
+        shard.good_reads = good_reads
+        shard.save(update_fields=["total_reads", "good_reads"])
+        return True
+
+    start_time = time.process_time()
+    file1 = open_range(dataset.file1.file, shard.start1, shard.end1)
+    file2 = open_range(dataset.file2.file, shard.start2, shard.end2) if dataset.file2 else None
+
+    try:
+        result = filter_reads(open_reads(dataset, file1, file2), progress)
+    except ScataFileError as e:
+        shard.error = e.message[:100]
+        shard.save()
+        return
+    except gzip.BadGzipFile:
+        shard.error = "not a gzipped file/broken gzip file"
+        shard.save()
+        return
+
+    if result is None:
+        return
+
+    with BytesIO() as result_file:
+        with gzip.open(result_file, "wb") as gz:
+            pickle.dump(result, gz)
+        result_file.seek(0)
+        name = "d{}/result{}".format(dataset.pk, shard.num)
+        shard.result.save(name, File(result_file, name=name), save=False)
+
+    shard.total_reads = result[3]
+    shard.good_reads = result[4]
+    shard.process_time = time.process_time() - start_time
+    shard.done = True
+    shard.save()
+
+
+# Byte offsets, in the uncompressed binary file, of the first record of
+# every shard of shard_size records followed by the end of the file, and
+# the number of records. FASTQ records are found as by parse_fastq(), so
+# wrapped records are kept whole. FASTA (and .qual) records start with '>'.
+
+def shard_offsets(file, file_type, shard_size):
+    fastq = file_type in ("fastq", "fastp")
+    record_start = b"@" if fastq else b">"
+    offsets = []
+    count = 0
+    pos = 0
+    lines = iter(file)
+    for line in lines:
+        if line[:1] != record_start:
+            pos += len(line)
+            continue
+        if count % shard_size == 0:
+            offsets.append(pos)
+        count += 1
+        pos += len(line)
+        if not fastq:
+            continue
+
+        # Sequence lines up to the '+' line, then quality lines up to the
+        # length of the sequence
+        line = next(lines, b"")
+        pos += len(line)
+        seq_length = len(line.rstrip())
+        line = next(lines, b"")
+        while line and line[:1] != b"+":
+            pos += len(line)
+            seq_length += len(line.rstrip())
+            line = next(lines, b"")
+        pos += len(line)
+
+        line = next(lines, b"")
+        pos += len(line)
+        qual_length = len(line.rstrip())
+        while qual_length < seq_length:
+            line = next(lines, b"")
+            if not line:
+                break
+            pos += len(line)
+            qual_length += len(line.rstrip())
+    offsets.append(pos)
+    return offsets, count
+
+
+# Binary file reading the range start to end of file
+
+class FileRange(io.RawIOBase):
+
+    def __init__(self, file, start, end):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.file.read(min(len(b), self.remaining))
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+# Open the range start to end of a gzipped FileField file as text. Offsets
+# are in the uncompressed file.
+
+def open_range(field_file, start, end):
+    gz = gzip.open(field_file.open(mode="rb"))
+    return io.TextIOWrapper(io.BufferedReader(FileRange(gz, start, end)))
@@ -1,6 +1,5 @@
-import gzip,pickle
-
 from scata2.models import ScataDataset, ScataTagStat
+from scata2.backend.seqstore import open_seqstore
 
 from sklearn.feature_extraction import FeatureHasher
 from sklearn import preprocessing
@@ -19,38 +18,16 @@ def dataset_stats(pk):
     if dataset.deleted:
         print("Dataset {} deleted".format(dataset.pk))
         return
-    # Dictionary with all reads, with id as key
-    #
-    # {"read_id" : "read sequence"}
-    #
-    seqs = dict()
-
-    with dataset.sequences.file.open(mode="rb") as f:
-        with gzip.open(f, mode="rb") as gz:
-            seqs = pickle.load(gz)
-
-
-
-    # Dictionary of mappings between tag and readIDs
-    # 
-    #  {"tag_id":{"read_id":[ .. ], "cnt": NN, "rev": NN}
-    #
-    tags = dict()
-
-    with dataset.tags.file.open(mode="rb") as f:
-        with gzip.open(f, mode="rb") as gz:
-            tags = pickle.load(gz)
-
-    # Make static list of tags (to ensure order is stable)
+    # Reads and tags of the dataset, see backend/seqstore.py
+    store = open_seqstore(dataset)
 
-    tag_list = tags.keys()
     tag_objects = [] 
 
     kmer_list = []
     pca_objects = []
 
     # Calculate stats per tag
-    for t in tag_list:
+    for t, (tag_name, reads) in enumerate(store.tag_reads()):
         dataset.refresh_from_db()
         if dataset.deleted:
             print("Dataset {} deleted".format(dataset.pk))
@@ -58,8 +35,8 @@ def dataset_stats(pk):
 
         tag = ScataTagStat()
         tag.dataset=dataset
-        tag.count = tags[t]['cnt']
-        tag.reversed = tags[t]['rev']
+        tag.count = store.tag_cnt[t]
+        tag.reversed = store.tag_rev[t]
 
         # Scan all sequences in tag and calculate
         # min/max/mean length
@@ -70,10 +47,10 @@ def dataset_stats(pk):
         gcs = []
         kmers = dict()
 
-        for s in tags[t]['seq_ids']:
-            seq = str(seqs[s])
+        for s in reads:
+            seq = store.get_seq(s)
             if len(seq) == 0:
-                print("Seq is empty {}".format(s))
+                print("Seq is empty {}".format(store.get_id(s)))
                 continue
             lens.append(len(seq))
             gc = 0
@@ -87,7 +64,7 @@ def dataset_stats(pk):
             gcs.append(gc / len(seq))
 
 
-        tag.tag = t
+        tag.tag = tag_name
         tag.min_len = min(lens)
         tag.max_len = max(lens)
         tag.mean_len = sum(lens) / len(lens)
@@ -1,6 +1,3 @@
-from datetime import datetime
-from zoneinfo import ZoneInfo
-
 from scata2.models import ScataJob
 from scata2.methods import methods as clustering_methods
 
@@ -12,7 +9,6 @@ def run_job(pk):
         return
     model = clustering_methods[job.method]['model']
     model.run_job(job=job.pk)
-    job.completed = True
-    job.completed_date = datetime.now(ZoneInfo("Europe/Stockholm"))
-    job.status = "Completed"
-    job.save()
+    # Asynchronous methods complete the job from their last task
+    if not model.asynchronous:
+        job.complete()
@@ -0,0 +1,281 @@
+import gzip
+import json
+import os
+import pickle
+import struct
+import tempfile
+from itertools import islice
+
+import numpy as np
+from Bio.Seq import Seq
+from django.conf import settings
+from django.core.files import File
+
+
+# Columnar storage of the filtered reads of a dataset.
+#
+# Replaces the gzipped {read_id: Seq} and tag pickles, which had to be
+# loaded completely into memory to read a single sequence. The store is
+# one uncompressed file that can be memory mapped:
+#
+#   magic        b"SCATASQ1"
+#   header_len   uint64, little endian
+#   header       JSON: read count, tag names and counts, and the dtype,
+#                shape and file offset of each array
+#   arrays       each aligned to ALIGN bytes
+#
+# Arrays:
+#
+#   seq_data     uint8, all sequences concatenated
+#   seq_offsets  int64, n + 1, sequence i is seq_data[o[i]:o[i+1]]
+#   id_data      uint8, all read ids concatenated
+#   id_offsets   int64, n + 1
+#   tag_index    int32, n, index in the tag list of the tag of each read
+#
+# Reads are stored in filtering order.
+
+MAGIC = b"SCATASQ1"
+ALIGN = 64
+
+
+def concat_strings(strings):
+    data = [s.encode() for s in strings]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(d) for d in data], out=offsets[1:])
+    return np.frombuffer(b"".join(data), dtype=np.uint8), offsets
+
+
+# A uint8 array of concatenated strings that is written in batches, so
+# the concatenation is never held in memory. strings must be a collection
+# (e.g. dict keys or values) as it is iterated twice, once for the offsets
+# and once when written.
+
+class StringColumn:
+    batch_size = 10000
+
+    def __init__(self, strings):
+        self.strings = strings
+        self.offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(s.encode()) for s in strings),
+                              dtype=np.int64, count=len(strings)),
+                  out=self.offsets[1:])
+        self.dtype = np.dtype(np.uint8)
+        self.nbytes = int(self.offsets[-1])
+        self.shape = (self.nbytes,)
+
+    def write(self, f):
+        strings = iter(self.strings)
+        for _ in range(0, len(self.strings), self.batch_size):
+            f.write("".join(islice(strings, self.batch_size)).encode())
+
+
+def split_strings(data, offsets):
+    raw = data[offsets[0]:offsets[-1]].tobytes()
+    bounds = (offsets - offsets[0]).tolist()
+    return [raw[bounds[i]:bounds[i + 1]].decode() for i in range(len(bounds) - 1)]
+
+
+# Write a header dictionary and named arrays in the layout above. Other
+# array files (see scata/clusterstore.py) use the same layout with their
+# own magic.
+
+def write_arrays(f, magic, header, arrays):
+    header = dict(header, arrays={})
+
+    # Offsets depend on the header length, so lay out the arrays after a
+    # header padded to ALIGN, recalculating until the size is stable.
+    header_size = ALIGN
+    while True:
+        offset = header_size
+        for name, a in arrays.items():
+            header["arrays"][name] = {"dtype": a.dtype.str,
+                                      "shape": list(a.shape),
+                                      "offset": offset}
+            offset += -(-a.nbytes // ALIGN) * ALIGN
+        encoded = json.dumps(header).encode()
+        needed = -(-(len(magic) + 8 + len(encoded)) // ALIGN) * ALIGN
+        if needed <= header_size:
+            break
+        header_size = needed
+
+    f.write(magic)
+    f.write(struct.pack("<Q", len(encoded)))
+    f.write(encoded)
+    f.write(b"\0" * (header_size - len(magic) - 8 - len(encoded)))
+    for name, a in arrays.items():
+        if isinstance(a, StringColumn):
+            a.write(f)
+        else:
+            f.write(memoryview(np.ascontiguousarray(a)).cast("B"))
+        f.write(b"\0" * (-a.nbytes % ALIGN))
+
+
+# Header and arrays (views of buffer) of a file written by write_arrays()
+
+def read_arrays(buffer, magic):
+    raw = np.frombuffer(buffer, dtype=np.uint8) \
+        if not isinstance(buffer, np.ndarray) else buffer
+    if bytes(raw[:len(magic)]) != magic:
+        raise ValueError("Not a {} file".format(magic.decode()))
+    header_len = struct.unpack("<Q", bytes(raw[len(magic):len(magic) + 8]))[0]
+    start = len(magic) + 8
+    header = json.loads(bytes(raw[start:start + header_len]))
+
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        size = int(np.prod(spec["shape"])) * dtype.itemsize
+        a = raw[spec["offset"]:spec["offset"] + size].view(dtype)
+        arrays[name] = a.reshape(spec["shape"])
+    return header, arrays
+
+
+# Contents of a FileField for read_arrays(). Memory mapped if the storage
+# has local files, otherwise read into memory.
+
+def open_buffer(field_file):
+    try:
+        path = field_file.path
+    except NotImplementedError:
+        with field_file.open(mode="rb") as f:
+            return f.read()
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+
+# Write a store to a binary file object. ids and seqs are collections of
+# strings, see StringColumn.
+
+def write_seqstore(f, ids, seqs, tag_index, tag_names, tag_cnt, tag_rev):
+    seq_data = StringColumn(seqs)
+    id_data = StringColumn(ids)
+    arrays = {"seq_data": seq_data,
+              "seq_offsets": seq_data.offsets,
+              "id_data": id_data,
+              "id_offsets": id_data.offsets,
+              "tag_index": np.asarray(tag_index, dtype=np.int32)}
+
+    header = {"count": len(seqs),
+              "tags": list(tag_names),
+              "tag_cnt": [int(x) for x in tag_cnt],
+              "tag_rev": [int(x) for x in tag_rev]}
+
+    write_arrays(f, MAGIC, header, arrays)
+
+
+# Build a store from the seqs and tags dictionaries produced by filtering
+# (see filter_reads in dataset.py)
+
+def build_seqstore(f, seqs, tags):
+    tag_names = list(tags.keys())
+    read_tags = dict()
+    for i, tag in enumerate(tag_names):
+        for seq_id in tags[tag]["seq_ids"]:
+            read_tags[seq_id] = i
+
+    write_seqstore(f,
+                   seqs.keys(),
+                   seqs.values(),
+                   [read_tags.get(seq_id, -1) for seq_id in seqs.keys()],
+                   tag_names,
+                   [tags[t]["cnt"] for t in tag_names],
+                   [tags[t]["rev"] for t in tag_names])
+
+
+class SeqStore:
+
+    def __init__(self, buffer):
+        header, arrays = read_arrays(buffer, MAGIC)
+        self.count = header["count"]
+        self.tag_names = header["tags"]
+        self.tag_cnt = header["tag_cnt"]
+        self.tag_rev = header["tag_rev"]
+        for name, a in arrays.items():
+            setattr(self, name, a)
+
+    # Open a store saved in a FileField
+
+    @classmethod
+    def open(cls, field_file):
+        return cls(open_buffer(field_file))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def seq_lengths(self):
+        return np.diff(self.seq_offsets)
+
+    def get_seq(self, i):
+        return self.seq_data[self.seq_offsets[i]:self.seq_offsets[i + 1]].tobytes().decode()
+
+    def get_id(self, i):
+        return self.id_data[self.id_offsets[i]:self.id_offsets[i + 1]].tobytes().decode()
+
+    # Reads start:end as lists of read ids and sequence strings
+
+    def get_batch(self, start, end):
+        return (split_strings(self.id_data, self.id_offsets[start:end + 1]),
+                split_strings(self.seq_data, self.seq_offsets[start:end + 1]))
+
+    # (read_id, Seq) for all reads, as the legacy sequence pickle
+
+    def items(self):
+        for i in range(self.count):
+            yield self.get_id(i), Seq(self.get_seq(i))
+
+    # Indices of the reads of each tag, as (tag name, indices)
+
+    def tag_reads(self):
+        order = np.argsort(self.tag_index, kind="stable")
+        bounds = np.searchsorted(self.tag_index[order],
+                                 np.arange(len(self.tag_names) + 1))
+        for t, name in enumerate(self.tag_names):
+            yield name, order[bounds[t]:bounds[t + 1]]
+
+    # Tag dictionary as the legacy tag pickle
+    #
+    #  {"tag_id":{"seq_ids":{ .. }, "cnt": NN, "rev": NN}
+
+    def tags(self):
+        return {name: {"cnt": self.tag_cnt[t],
+                       "rev": self.tag_rev[t],
+                       "seq_ids": {self.get_id(i) for i in reads}}
+                for t, (name, reads) in enumerate(self.tag_reads())}
+
+
+# Write the store to a scratch file, which the storage then copies in
+# chunks, instead of building it in memory.
+
+def save_seqstore(dataset, seqs, tags):
+    os.makedirs(settings.SCRATCH_DIR, exist_ok=True)
+    with tempfile.TemporaryFile(dir=settings.SCRATCH_DIR) as store_file:
+        build_seqstore(store_file, seqs, tags)
+        store_file.seek(0)
+        name = "seqstore_{id}".format(id=dataset.pk)
+        dataset.seqstore.save(name, File(store_file, name=name))
+
+
+# Convert the legacy sequence and tag pickles of a dataset to a store. The
+# pickled sequences are Seq objects, which are replaced by strings in
+# place.
+
+def convert_dataset(dataset):
+    with dataset.sequences.file.open(mode="rb") as f:
+        with gzip.open(f, mode="rb") as gz:
+            seqs = pickle.load(gz)
+    with dataset.tags.file.open(mode="rb") as f:
+        with gzip.open(f, mode="rb") as gz:
+            tags = pickle.load(gz)
+    for seq_id, seq in seqs.items():
+        seqs[seq_id] = str(seq)
+    save_seqstore(dataset, seqs, tags)
+
+
+# Open the store of a dataset. Datasets filtered before stores were
+# introduced are converted by the convert_seqstores management command.
+
+def open_seqstore(dataset):
+    if not dataset.seqstore:
+        raise RuntimeError(("Dataset {} has no sequence store, run the " +
+                            "convert_seqstores command").format(dataset.pk))
+    return SeqStore.open(dataset.seqstore)
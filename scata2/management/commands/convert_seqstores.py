@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from scata2.models import ScataDataset
+from scata2.backend.seqstore import convert_dataset
+
+
+# Convert the sequence and tag pickles of datasets filtered before the
+# sequence store was introduced. Jobs can only use converted datasets.
+
+class Command(BaseCommand):
+    help = "Convert legacy dataset sequence pickles to sequence stores"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--delete-legacy", action="store_true",
+                            help="Delete the sequence and tag pickles " +
+                                 "after conversion")
+
+    def handle(self, *args, **options):
+        datasets = ScataDataset.objects.filter(deleted=False,
+                                               is_valid=True)
+        for dataset in datasets:
+            if not dataset.seqstore:
+                if not dataset.sequences or not dataset.tags:
+                    continue
+                convert_dataset(dataset)
+                self.stdout.write("Converted {}".format(dataset))
+
+            if options["delete_legacy"] and dataset.sequences:
+                dataset.sequences.delete(save=False)
+                dataset.tags.delete(save=False)
+                dataset.save()
@@ -14,37 +14,70 @@ from sklearn.cluster import AgglomerativeClustering
 
 from scata2.storages import get_work_storage
 from scata2.backend.ReadHandler.filterseq import SeqDeTagger
-from scata2.backend.ReadHandler.qualseq import QualSeq
 from scata2.backend.ReadHandler.exceptions import ScataReadsError
+from scata2.backend.seqstore import open_seqstore
 
 
 # Helper function to open dataset
 def open_dataset(dataset):
-    with dataset.sequences.file.open(mode="rb") as f:
-        with gzip.open(f, mode="rb") as gz:
-            return iter(pickle.load(gz).items())
+    return open_seqstore(dataset).items()
 
 def open_tags(dataset):
-    with dataset.tags.file.open(mode="rb") as f:
+    return open_seqstore(dataset).tags()
+
+def open_refset(refset):
+    with refset.sequences.file.open(mode="rb") as f:
         with gzip.open(f, mode="rb") as gz:
-            return pickle.load(gz)
+            return iter(pickle.load(gz).items())
+
+# Iterator over the reads of all datasets of a job, yielding (id, seq)
+# tuples. Reads are read from the dataset sequence stores in batches of at
+# most batch_size reads and max_batch_bytes bytes of sequence, so memory
+# use is bounded regardless of dataset size. If an amplicon is given, reads
+# are detagged a batch at a time, and rejected reads are counted in errors.
+#
+# All state is kept per instance. split() gives one independent iterator
+# per dataset, which can be consumed in separate threads or processes.
+# Their error counts are added back with merge_errors().
 
 class SeqIterator():
-    total_cnt = 0
-    error_cnt = 0
-    current_dataset = None
-    amplicon = None
-    detagger = None
-    datasets = None
-    errors = dict()
 
-    def __init__(self, datasets, amplicon=None):
-        for dataset in datasets.all():
-            self.total_cnt += dataset.seq_count
-        self.datasets = iter(datasets.all())
+    def __init__(self, datasets, amplicon=None, batch_size=10000,
+                 max_batch_bytes=64 * 1024 * 1024):
+        if hasattr(datasets, "all"):
+            datasets = datasets.all()
+        self.datasets = list(datasets)
+        self.total_cnt = sum(dataset.seq_count for dataset in self.datasets)
+        self.error_cnt = 0
+        self.errors = dict()
+        self.current_batch = None
+        self.amplicon = amplicon
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.detagger = None
         if amplicon is not None:
             self.detagger = SeqDeTagger(amplicon)
 
+    # One iterator per dataset, with the same settings
+
+    def split(self):
+        return [SeqIterator([dataset], self.amplicon,
+                            batch_size=self.batch_size,
+                            max_batch_bytes=self.max_batch_bytes)
+                for dataset in self.datasets]
+
+    # Add error counts of other iterators (from split()) to this one
+
+    def merge_errors(self, iterators):
+        for iterator in iterators:
+            self.error_cnt += iterator.error_cnt
+            for error, data in iterator.errors.items():
+                if error not in self.errors:
+                    self.errors[error] = dict(cnt = data['cnt'],
+                                              msg = data['msg'])
+                else:
+                    self.errors[error]['cnt'] += data['cnt']
+
     def __iter__(self):
         return self
 
@@ -52,42 +85,63 @@ class SeqIterator():
         return self.total_cnt
 
     def __next__(self):
-        if self.current_dataset is None:
-            self.current_dataset = open_dataset(next(self.datasets))
-
-        if self.detagger is None:
-            try:
-                return next(self.current_dataset)
-            except StopIteration:
-                self.current_dataset = open_dataset(next(self.datasets))
-                return next(self.current_dataset)
-        else:
-            while True:
-                try:
-                    seq_tuple = next(self.current_dataset)
-                except StopIteration:
-                    self.current_dataset = open_dataset(next(self.datasets))
-                    seq_tuple = next(self.current_dataset)
-
-                try:
-                    seq = self.detagger.detag_seq(QualSeq(SeqRecord(seq_tuple[1]))).seq_record.seq
-                    return (seq_tuple[0], seq)
-                except ScataReadsError as e:
-                    self.error_cnt += 1
-                    if e.error not in self.errors:
-                        self.errors[e.error] = dict( cnt = 1,
-                                                     msg = e.message)
-                    else:
-                        self.errors[e.error]['cnt'] += 1
+        if self.current_batch is None:
+            self.current_batch = self._iter_reads()
+        return next(self.current_batch)
+
+    def _iter_reads(self):
+        for ids, seqs in self.iter_batches(self.batch_size):
+            yield from zip(ids, seqs)
+
+    # Iterate over reads as (ids, seqs) batches of at most n reads
+
+    def iter_batches(self, n):
+        for dataset in self.datasets:
+            store = open_seqstore(dataset)
+            start = 0
+            while start < len(store):
+                end = self._batch_end(store, start, n)
+                ids, seqs = store.get_batch(start, end)
+                start = end
+                if self.detagger is not None:
+                    ids, seqs = self._detag(ids, seqs)
+                    if not ids:
+                        continue
+                yield ids, seqs
+
+    # End of a batch starting at start, limited by n and max_batch_bytes
+    # (at least one read)
+
+    def _batch_end(self, store, start, n):
+        end = min(start + n, len(store))
+        offsets = store.seq_offsets
+        limit = int(np.searchsorted(offsets[start:end + 1],
+                                    offsets[start] + self.max_batch_bytes,
+                                    side="right")) - 1
+        return start + max(1, min(limit, end - start))
+
+    def _detag(self, ids, seqs):
+        detagged_ids = []
+        detagged_seqs = []
+        for id, result in zip(ids, self.detagger.detag_seqs(seqs)):
+            if isinstance(result, ScataReadsError):
+                self.error_cnt += 1
+                if result.error not in self.errors:
+                    self.errors[result.error] = dict( cnt = 1,
+                                                      msg = result.message)
+                else:
+                    self.errors[result.error]['cnt'] += 1
+            else:
+                detagged_ids.append(id)
+                detagged_seqs.append(result)
+        return detagged_ids, detagged_seqs
 
 
 class RefIterator():
-    total_cnt = 0
-    current_refset = None
-    refsets = None
-
 
     def __init__(self, refsets):
+        self.total_cnt = 0
+        self.current_refset = None
         for refset in refsets.all():
             self.total_cnt += refset.seq_count
         self.refsets = iter(refsets.all())
@@ -100,12 +154,12 @@ class RefIterator():
 
     def __next__(self):
         if self.current_refset is None:
-            self.current_refset = open_dataset(next(self.refsets))
+            self.current_refset = open_refset(next(self.refsets))
 
         try:
             return next(self.current_refset)
         except StopIteration:
-            self.current_refset = open_dataset(next(self.refsets))
+            self.current_refset = open_refset(next(self.refsets))
             return next(self.current_refset)
 
 
@@ -115,6 +169,13 @@ class ScataMethod(models.Model):
 
     seqs = None
 
+    # Whether datasets can be added to a finished job
+    incremental = False
+
+    # Whether cluster() returns before the job is done. The method then
+    # completes the job itself (ScataJob.complete()).
+    asynchronous = False
+
     def get_seq_iterator(self):
         return SeqIterator(self.job.datasets, self.job.amplicon)
 
@@ -347,6 +408,33 @@ class ScataSequenceChunk(models.Model):
         if len(self.sequences) > self.chunk_size:
             raise(ChunkFullException())
 
+    # Add an already dereplicated sequence with the ids of all its reads
+
+    def add_unique(self, sequence, ids):
+        assert(len(sequence) == self.length)
+        self.num_sequences += len(ids)
+        self.sequences[str(sequence)] = ids
+        self.num_uniques = len(self.sequences)
+
+    # Add reads to a sequence already in the chunk
+
+    def add_reads(self, sequence, ids):
+        self._load()
+        self.sequences[str(sequence)] = self.sequences[str(sequence)] + list(ids)
+        self.num_sequences += len(ids)
+
+    # Remove the reads with ids above n, added by an interrupted run
+
+    def drop_reads_after(self, n):
+        self._load()
+        sequences = {seq: [id for id in ids if int(id) <= n] for seq, ids in self.sequences.items()}
+        dropped = self.num_sequences - sum(len(ids) for ids in sequences.values())
+        if dropped == 0:
+            return
+        self.sequences = sequences
+        self.num_sequences -= dropped
+        self.file.delete(save=False)
+        self.save()
 
     def save(self, **kwargs):
         with BytesIO() as seq_file:
@@ -375,6 +463,12 @@ class ScataSequenceChunk(models.Model):
         self._load()
         return self.sequences[list(self.sequences.keys())[item]]
 
+    # Read ids of each unique sequence, in the order of get_uniseqs()
+
+    def get_seq_ids(self):
+        self._load()
+        return list(self.sequences.values())
+
 
 class ScataOTU(models.Model):
     job = models.ForeignKey("scata2.ScataJob", on_delete=models.CASCADE)
@@ -422,26 +516,13 @@ class ScataTag(models.Model):
     name = models.CharField("Name", max_length=200, null=False, blank=False, editable=False,
                             default="")
 
+# Reads of a tag in a cluster. The reads themselves are kept by the
+# method, see ScataScataMethod.tag_cluster_reads().
 class ScataTagCluster(models.Model):
     cluster = models.ForeignKey(ScataCluster, on_delete=models.CASCADE)
     tag = models.ForeignKey(ScataTag, on_delete=models.CASCADE)
     size = models.IntegerField("Cluster size", null=False, blank=False, editable=False,
                                default=0)
-    sequences = models.FileField("Cluster sequences", upload_to = "scata/methods/scata/tag/",
-                                 storage=get_work_storage, null=True, blank=True)
-
-    seq_list = []
-
-
-    def save(self, **kwargs):
-        super().save(**kwargs)
-        with BytesIO() as seq_file:
-            with gzip.open(seq_file, "wb") as gz:
-                pickle.dump(self.sequences, gz)
-            seq_file.seek(0)
-            name = "j{}/c{}_t{}".format(self.cluster.job.pk, self.cluster.pk, self.pk)
-            self.file = File(seq_file, name=name)
-            super().save(**kwargs)
 
 
 
@@ -0,0 +1,382 @@
+import numpy as np
+from numba import njit
+
+from scata2.backend.seqstore import concat_strings
+from scata2.methods.scata.vsearch import usearch_global, vsearch_threads
+
+
+# Alignment backends for cluster_chunk.
+#
+# An aligner is created from a ScataScataMethod and yields the hits between
+# a list of query and a list of target SeqRecords as dictionaries with
+# query, target, qilo, qihi, tilo, tihi (0 based, terminal gaps excluded),
+# qcov, tcov (0 - 1), pairs, pv, opens and exts (internal gaps only), i.e.
+# the vsearch userfields used for the clustering distance. A query is
+# always reported as a hit to a target with the same id.
+#
+# exhaustive is True for an aligner that reports every pair within the
+# thresholds, so that a pair without a hit is known not to match.
+
+
+class VsearchAligner:
+
+    # The search of each query stops after --maxrejects rejected targets
+    exhaustive = False
+
+    fields = {"query": str,
+              "target": str,
+              "id0": float,
+              "qilo": lambda a: int(a) - 1,
+              "qihi": lambda a: int(a) - 1,
+              "tilo": lambda a: int(a) - 1,
+              "tihi": lambda a: int(a) - 1,
+              "ql": int,
+              "tl": int,
+              "tcov": lambda a: float(a) / 100.0,
+              "qcov": lambda a: float(a) / 100.0,
+              "mism": int,
+              "opens": int,
+              "exts": int,
+              "pairs": int,
+              "pv": int,
+              "alnlen": int, }
+
+    def __init__(self, method):
+        self.method = method
+
+    def hits(self, query_records, target_records):
+        method = self.method
+        result = usearch_global(query_records, target_records,
+                                ["--mismatch", "{}".format(method.mismatch_pen * -1),
+                                 "--gapopen", "{}I/{}E".format(method.open_pen,
+                                                               method.open_pen * method.endgap_pen),
+                                 "--gapext", "{}I/{}E".format(method.extend_pen,
+                                                              method.extend_pen * method.endgap_pen),
+                                 "--strand", "plus",
+                                 "--maxaccepts", "0",
+                                 "--maxrejects", "100",
+                                 "--id", "{}".format(min_identity(method.distance)),
+                                 "--userfields", "+".join(self.fields.keys()),
+                                 ],
+                                threads=vsearch_threads())
+
+        for line in result:
+            yield {a[0]: self.fields[a[0]](a[1]) for a in zip(self.fields.keys(), line.split("\t"))}
+
+
+# Identity required for a hit, the --id given to vsearch
+
+def min_identity(distance):
+    return 1.0 - float(distance) - 0.01
+
+
+# In process alignment.
+#
+# Pairs are pre-filtered on shared k-mers and aligned with a banded global
+# (Gotoh) aligner scored as vsearch: MATCH_SCORE for a match, the mismatch
+# penalty for a mismatch and open + length * extension for a gap, with
+# the end gap scaled penalties for terminal gaps. Hits need the identity
+# (matches / alignment length, terminal gaps excluded) of vsearch --id.
+#
+# Both the filter and the band are derived from the identity and the
+# minimum alignment coverage, so no pair that could be accepted is left
+# out. With s the shorter sequence, at most g = (1 - id) / id * len(s)
+# internal columns are not matches, and at most u = (1 - coverage) * len
+# bases of each sequence are in terminal gaps. Each internal column that
+# is not a match destroys at most KMER_SIZE k-mers of either sequence,
+# while its terminal gaps destroy at most u. The same numbers bound how
+# far the alignment can leave the diagonal.
+
+KMER_SIZE = 8
+MATCH_SCORE = 2
+NEG_SCORE = -(1 << 30)
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate(b"ACGT"):
+    BASE_CODES[base] = i
+    BASE_CODES[base + 32] = i
+
+
+def encode(records):
+    data, offsets = concat_strings(str(r.seq) for r in records)
+    return BASE_CODES[data], offsets
+
+
+# Sorted distinct k-mers of a sequence, k-mers with other bases than ACGT
+# are left out.
+
+@njit
+def seq_kmers(seq, k):
+    kmers = np.empty(max(0, len(seq) - k + 1), dtype=np.int64)
+    n = 0
+    kmer = 0
+    valid = 0
+    mask = (1 << (2 * k)) - 1
+    for i in range(len(seq)):
+        if seq[i] > 3:
+            valid = 0
+            continue
+        kmer = ((kmer << 2) | seq[i]) & mask
+        valid += 1
+        if valid >= k:
+            kmers[n] = kmer
+            n += 1
+    return np.unique(kmers[:n])
+
+
+# Banded global alignment of q and t, cells with lo <= j - i <= hi.
+# Returns (qilo, qihi, tilo, tihi, pairs, pv, opens, exts), with pairs 0
+# if nothing is aligned.
+
+@njit
+def align(q, t, lo, hi, match, mismatch, gap_open, gap_ext, end_open, end_ext):
+    lq = len(q)
+    lt = len(t)
+    w = hi - lo + 1
+    H = np.full((lq + 1, w), NEG_SCORE, dtype=np.int32)
+    E = np.full((lq + 1, w), NEG_SCORE, dtype=np.int32)
+    F = np.full((lq + 1, w), NEG_SCORE, dtype=np.int32)
+    # bits 0-1: source of H (0 diagonal, 1 E, 2 F), bit 2: E extended,
+    # bit 3: F extended
+    trace = np.zeros((lq + 1, w), dtype=np.uint8)
+    H[0, -lo] = 0
+
+    for i in range(lq + 1):
+        j_min = max(0, i + lo)
+        j_max = min(lt, i + hi)
+        for j in range(j_min, j_max + 1):
+            if i == 0 and j == 0:
+                continue
+            c = j - i - lo
+            bits = 0
+
+            # Gap in q, from (i, j - 1)
+            if j > j_min:
+                if i == 0 or i == lq:
+                    go, ge = end_open, end_ext
+                else:
+                    go, ge = gap_open, gap_ext
+                e_open = H[i, c - 1] - go - ge
+                e_ext = E[i, c - 1] - ge
+                if e_ext > e_open:
+                    E[i, c] = e_ext
+                    bits |= 4
+                else:
+                    E[i, c] = e_open
+
+            # Gap in t, from (i - 1, j)
+            if i > 0 and c + 1 < w:
+                if j == 0 or j == lt:
+                    go, ge = end_open, end_ext
+                else:
+                    go, ge = gap_open, gap_ext
+                f_open = H[i - 1, c + 1] - go - ge
+                f_ext = F[i - 1, c + 1] - ge
+                if f_ext > f_open:
+                    F[i, c] = f_ext
+                    bits |= 8
+                else:
+                    F[i, c] = f_open
+
+            best = NEG_SCORE
+            if i > 0 and j > 0:
+                if q[i - 1] == t[j - 1] and q[i - 1] < 4:
+                    best = H[i - 1, c] + match
+                else:
+                    best = H[i - 1, c] - mismatch
+            if E[i, c] > best:
+                best = E[i, c]
+                bits |= 1
+            if F[i, c] > best:
+                best = F[i, c]
+                bits = (bits & 12) | 2
+            H[i, c] = best
+            trace[i, c] = bits
+
+    # Trace back, ops 0 pair, 1 gap in q, 2 gap in t (reversed)
+    ops = np.empty(lq + lt, dtype=np.uint8)
+    n = 0
+    i = lq
+    j = lt
+    state = 0
+    while i > 0 or j > 0:
+        bits = trace[i, j - i - lo]
+        if state == 0:
+            state = bits & 3
+            if state == 0:
+                ops[n] = 0
+                i -= 1
+                j -= 1
+                n += 1
+        elif state == 1:
+            ops[n] = 1
+            n += 1
+            j -= 1
+            state = 1 if bits & 4 else 0
+        else:
+            ops[n] = 2
+            n += 1
+            i -= 1
+            state = 2 if bits & 8 else 0
+
+    qilo = qihi = tilo = tihi = -1
+    pairs = pv = opens = exts = 0
+    qpos = 0
+    tpos = 0
+    last_op = 0
+    gap_cols = 0
+    gap_opens = 0
+    for x in range(n - 1, -1, -1):
+        op = ops[x]
+        if op == 0:
+            if pairs == 0:
+                qilo = qpos
+                tilo = tpos
+            else:
+                # Gaps between pairs are internal
+                opens += gap_opens
+                exts += gap_cols - gap_opens
+            gap_cols = 0
+            gap_opens = 0
+            pairs += 1
+            if q[qpos] == t[tpos] and q[qpos] < 4:
+                pv += 1
+            qihi = qpos
+            tihi = tpos
+            qpos += 1
+            tpos += 1
+        else:
+            if op != last_op:
+                gap_opens += 1
+            gap_cols += 1
+            if op == 1:
+                tpos += 1
+            else:
+                qpos += 1
+        last_op = op
+
+    return qilo, qihi, tilo, tihi, pairs, pv, opens, exts
+
+
+# Limits for an acceptable alignment of sequences q and t of length lq
+# and lt, with q_distinct and t_distinct distinct k-mers. Returns the band
+# (lo, hi) of diagonals j - i the alignment can use, which must include
+# lt - lq, and the number of k-mers they must share.
+
+@njit
+def alignment_bounds(lq, lt, q_distinct, t_distinct, id_min, min_alignment):
+    gaps = int((1.0 - id_min) / id_min * min(lq, lt) + 1e-9)
+    q_unaligned = int((1.0 - min_alignment) * lq + 1e-9)
+    t_unaligned = int((1.0 - min_alignment) * lt + 1e-9)
+    min_shared = max(q_distinct - q_unaligned, t_distinct - t_unaligned) - KMER_SIZE * gaps
+    return -(q_unaligned + gaps), t_unaligned + gaps, min_shared
+
+
+# Align one query to all targets passing the k-mer filter. counts is a
+# zeroed array with one element per target, used for the shared k-mer
+# counts. skip is a target not to align (the query itself) or -1.
+# Returns rows of (target, qilo, qihi, tilo, tihi, pairs, pv, opens, exts).
+
+@njit
+def search_query(q, q_kmers, t_data, t_offsets, t_distinct, post_offsets, post_data,
+                 counts, skip, id_min, min_alignment, match, mismatch, gap_open, gap_ext,
+                 end_open, end_ext):
+    for kmer in q_kmers:
+        for p in range(post_offsets[kmer], post_offsets[kmer + 1]):
+            counts[post_data[p]] += 1
+
+    n_targets = len(t_offsets) - 1
+    hits = np.empty((n_targets, 9), dtype=np.int64)
+    n = 0
+    lq = len(q)
+    for t in range(n_targets):
+        shared = counts[t]
+        counts[t] = 0
+        if t == skip:
+            continue
+        lt = t_offsets[t + 1] - t_offsets[t]
+        lo, hi, min_shared = alignment_bounds(lq, lt, len(q_kmers), t_distinct[t],
+                                              id_min, min_alignment)
+        if shared < min_shared or lt - lq < lo or lt - lq > hi:
+            continue
+
+        qilo, qihi, tilo, tihi, pairs, pv, opens, exts = \
+            align(q, t_data[t_offsets[t]:t_offsets[t + 1]], lo, hi,
+                  match, mismatch, gap_open, gap_ext, end_open, end_ext)
+        if pairs == 0 or pv < id_min * (pairs + opens + exts) - 1e-9:
+            continue
+        hits[n, 0] = t
+        hits[n, 1] = qilo
+        hits[n, 2] = qihi
+        hits[n, 3] = tilo
+        hits[n, 4] = tihi
+        hits[n, 5] = pairs
+        hits[n, 6] = pv
+        hits[n, 7] = opens
+        hits[n, 8] = exts
+        n += 1
+    return hits[:n]
+
+
+class BandedAligner:
+
+    exhaustive = True
+
+    def __init__(self, method):
+        self.method = method
+
+    def hits(self, query_records, target_records):
+        method = self.method
+        t_data, t_offsets = encode(target_records)
+        t_kmers = [seq_kmers(t_data[t_offsets[t]:t_offsets[t + 1]], KMER_SIZE)
+                   for t in range(len(target_records))]
+        t_distinct = np.array([len(k) for k in t_kmers], dtype=np.int64)
+
+        # Inverted index, targets of each k-mer
+        kmers = np.concatenate(t_kmers) if t_kmers else np.zeros(0, dtype=np.int64)
+        targets = np.repeat(np.arange(len(target_records), dtype=np.int64), t_distinct)
+        order = np.argsort(kmers, kind="stable")
+        post_data = targets[order]
+        post_offsets = np.searchsorted(kmers[order],
+                                       np.arange(4 ** KMER_SIZE + 1, dtype=np.int64))
+
+        target_pos = {r.id: t for t, r in enumerate(target_records)}
+        counts = np.zeros(len(target_records), dtype=np.int64)
+        id_min = min_identity(method.distance)
+
+        q_data, q_offsets = encode(query_records)
+        for i, record in enumerate(query_records):
+            q = q_data[q_offsets[i]:q_offsets[i + 1]]
+            skip = target_pos.get(record.id, -1)
+            if skip >= 0:
+                yield {"query": record.id, "target": record.id}
+
+            hits = search_query(q, seq_kmers(q, KMER_SIZE), t_data, t_offsets, t_distinct,
+                                post_offsets, post_data, counts, skip,
+                                id_min, method.min_alignment,
+                                MATCH_SCORE, method.mismatch_pen,
+                                method.open_pen, method.extend_pen,
+                                method.open_pen * method.endgap_pen,
+                                method.extend_pen * method.endgap_pen)
+            lq = len(q)
+            for t, qilo, qihi, tilo, tihi, pairs, pv, opens, exts in hits.tolist():
+                lt = t_offsets[t + 1] - t_offsets[t]
+                yield {"query": record.id,
+                       "target": target_records[t].id,
+                       "qilo": qilo,
+                       "qihi": qihi,
+                       "tilo": tilo,
+                       "tihi": tihi,
+                       "qcov": (qihi - qilo + 1) / float(lq),
+                       "tcov": (tihi - tilo + 1) / float(lt),
+                       "pairs": pairs,
+                       "pv": pv,
+                       "opens": opens,
+                       "exts": exts}
+
+
+aligners = {"vsearch": {"class": VsearchAligner,
+                        "description": "vsearch"},
+            "banded": {"class": BandedAligner,
+                       "description": "Built in banded aligner (no vsearch)"},
+            }
@@ -0,0 +1,157 @@
+import numpy as np
+
+from scata2.backend.seqstore import write_arrays, read_arrays, open_buffer, concat_strings
+
+
+# Cluster membership and read tags of a job, written once by cluster() and
+# memory mapped by the summarise_cluster tasks. Same layout as the
+# sequence store (see backend/seqstore.py) with its own magic.
+#
+# Arrays:
+#
+#   read_tag           int32, reads + 1, tag index of each read id (read
+#                      ids start at 1), -1 for reads without a tag
+#   tag_pks            int64, ScataTag pk of each tag index
+#   genotype_offsets   int64, genotypes + 1, reads of genotype g are
+#                      genotype_reads[o[g]:o[g+1]]
+#   genotype_reads     int64, read ids
+#   cluster_offsets    int64, clusters + 1, genotypes of cluster c are
+#                      cluster_genotypes[o[c]:o[c+1]]
+#   cluster_genotypes  int64, genotype ids (see GenotypeIndex)
+#   cluster_cells      int64, clusters + 1, the (cluster, tag) cells of
+#                      cluster c are cells cluster_cells[c]:cluster_cells[c+1]
+#   cell_tags          int32, cells, tag index of each cell, ascending
+#                      within a cluster
+#   cell_offsets       int64, cells + 1, reads of cell i are
+#                      cell_reads[o[i]:o[i+1]]
+#   cell_reads         int64, read ids by cluster and tag
+#   name_data          uint8, read names by id concatenated
+#   name_offsets       int64, reads + 2
+#
+# The cells replace the per ScataTagCluster read files, the reads of a
+# cell or a cluster are found in time linear in their number.
+
+MAGIC = b"SCATACL1"
+
+
+def csr(lists):
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(a) for a in lists], out=offsets[1:])
+    data = np.concatenate([np.asarray(a, dtype=np.int64) for a in lists]) if lists \
+        else np.zeros(0, dtype=np.int64)
+    return offsets, data
+
+
+# Positions in the data array of CSR rows, concatenated
+
+def row_positions(offsets, rows):
+    starts = offsets[rows]
+    sizes = offsets[rows + 1] - starts
+    ends = np.cumsum(sizes)
+    return np.arange(ends[-1] if len(ends) else 0, dtype=np.int64) + \
+        np.repeat(starts - (ends - sizes), sizes)
+
+
+# Write a store to a binary file object. genotype_reads and clusters are
+# lists of read ids per genotype and genotype ids per cluster, read_names
+# the names by read id (index 0 unused).
+
+def write_clusterstore(f, read_tag, tag_pks, genotype_reads, clusters, read_names):
+    read_tag = np.asarray(read_tag, dtype=np.int32)
+    genotype_offsets, genotype_data = csr(genotype_reads)
+    cluster_offsets, cluster_data = csr(clusters)
+
+    # Cluster and tag of every read, sorted into cells
+    genotype_clusters = np.repeat(np.arange(len(clusters), dtype=np.int64), np.diff(cluster_offsets))
+    read_clusters = np.repeat(genotype_clusters, np.diff(genotype_offsets)[cluster_data])
+    cell_reads = genotype_data[row_positions(genotype_offsets, cluster_data)]
+    read_tags = read_tag[cell_reads]
+    order = np.lexsort((read_tags, read_clusters))
+    cell_reads = cell_reads[order]
+    read_tags = read_tags[order]
+    read_clusters = read_clusters[order]
+
+    new_cell = np.ones(len(cell_reads), dtype=bool)
+    new_cell[1:] = (read_clusters[1:] != read_clusters[:-1]) | (read_tags[1:] != read_tags[:-1])
+    starts = np.flatnonzero(new_cell)
+    cell_offsets = np.append(starts, len(cell_reads)).astype(np.int64)
+    cluster_cells = np.searchsorted(read_clusters[starts], np.arange(len(clusters) + 1))
+
+    name_data, name_offsets = concat_strings(read_names)
+    arrays = {"read_tag": read_tag,
+              "tag_pks": np.asarray(tag_pks, dtype=np.int64),
+              "genotype_offsets": genotype_offsets,
+              "genotype_reads": genotype_data,
+              "cluster_offsets": cluster_offsets,
+              "cluster_genotypes": cluster_data,
+              "cluster_cells": cluster_cells.astype(np.int64),
+              "cell_tags": read_tags[starts].astype(np.int32),
+              "cell_offsets": cell_offsets,
+              "cell_reads": cell_reads,
+              "name_data": name_data,
+              "name_offsets": name_offsets}
+    write_arrays(f, MAGIC, {"clusters": len(clusters)}, arrays)
+
+
+class ClusterStore:
+
+    def __init__(self, buffer):
+        header, arrays = read_arrays(buffer, MAGIC)
+        self.count = header["clusters"]
+        for name, a in arrays.items():
+            setattr(self, name, a)
+
+    # Open a store saved in a FileField
+
+    @classmethod
+    def open(cls, field_file):
+        return cls(open_buffer(field_file))
+
+    def __len__(self):
+        return self.count
+
+    def genotypes(self, c):
+        return self.cluster_genotypes[self.cluster_offsets[c]:self.cluster_offsets[c + 1]]
+
+    # Number of reads of each genotype of cluster c
+
+    def genotype_sizes(self, c):
+        genotypes = self.genotypes(c)
+        return self.genotype_offsets[genotypes + 1] - self.genotype_offsets[genotypes]
+
+    # Read ids of cluster c, genotype by genotype
+
+    def reads(self, c):
+        return self.genotype_reads[row_positions(self.genotype_offsets, self.genotypes(c))]
+
+    # Number of reads of cluster c by tag index
+
+    def tag_counts(self, c):
+        tags = self.read_tag[self.reads(c)]
+        if len(tags) > 0 and tags.min() < 0:
+            raise KeyError("Read id {} not found in tags".format(self.reads(c)[np.argmin(tags)]))
+        return np.bincount(tags, minlength=len(self.tag_pks))
+
+    # Read ids of cluster c, by tag index
+
+    def cluster_reads(self, c):
+        return self.cell_reads[self.cell_offsets[self.cluster_cells[c]]:
+                               self.cell_offsets[self.cluster_cells[c + 1]]]
+
+    # Read ids of cluster c with tag index t
+
+    def tag_cluster_reads(self, c, t):
+        start = self.cluster_cells[c]
+        end = self.cluster_cells[c + 1]
+        i = start + int(np.searchsorted(self.cell_tags[start:end], t))
+        if i == end or self.cell_tags[i] != t:
+            return self.cell_reads[0:0]
+        return self.cell_reads[self.cell_offsets[i]:self.cell_offsets[i + 1]]
+
+    # Index of the tag with ScataTag pk
+
+    def tag_index(self, pk):
+        return int(np.flatnonzero(self.tag_pks == pk)[0])
+
+    def read_name(self, id):
+        return self.name_data[self.name_offsets[id]:self.name_offsets[id + 1]].tobytes().decode()
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+from django.conf import settings
+
+
+# Global dereplication of all reads of a job, before they are split into
+# length bucketed chunks.
+#
+# Sequences are indexed by a 128 bit BLAKE2 digest. Each unique sequence is
+# stored once, with the ids of all reads having it. When the estimated
+# memory use passes max_memory, the index is spilled to partition files on
+# disk (by the first byte of the digest) and cleared. Each partition is
+# then dereplicated separately when the uniques are read, so a sequence
+# spilled more than once is still reported once.
+
+# Rough per entry memory use (dict slot, tuple, list, digest, id string)
+UNIQUE_OVERHEAD = 300
+ID_OVERHEAD = 60
+
+
+# Digest identifying a sequence
+
+def sequence_digest(seq):
+    return hashlib.blake2b(seq.encode(), digest_size=16).digest()
+
+
+class Dereplicator:
+
+    def __init__(self, max_memory=None, partitions=64, spill_dir=None):
+        self.max_memory = max_memory if max_memory else settings.DEREP_MAX_MEMORY
+        self.partitions = partitions
+        self.spill_dir = spill_dir if spill_dir else settings.SCRATCH_DIR
+        self.index = dict()
+        self.memory = 0
+        self.total = 0
+        self.num_uniques = 0
+        self.spill_path = None
+        self.spill_files = None
+
+    def add(self, id, seq):
+        self.total += 1
+        digest = sequence_digest(seq)
+        entry = self.index.get(digest)
+        if entry is None:
+            self.index[digest] = (seq, [id])
+            self.memory += len(seq) + UNIQUE_OVERHEAD
+        else:
+            if entry[0] != seq:
+                raise RuntimeError("Sequence digest collision")
+            entry[1].append(id)
+            self.memory += ID_OVERHEAD
+
+        if self.memory > self.max_memory:
+            self._spill()
+
+    # Number of reads collapsed into another read with the same sequence.
+    # Complete when uniques() has been consumed.
+
+    @property
+    def duplicates(self):
+        return self.total - self.num_uniques
+
+    # Unique sequences as (seq, ids) tuples
+
+    def uniques(self):
+        self.num_uniques = 0
+        if self.spill_files is None:
+            for seq, ids in self.index.values():
+                self.num_uniques += 1
+                yield seq, ids
+            return
+
+        self._spill()
+        for f in self.spill_files:
+            f.close()
+
+        try:
+            for p in range(self.partitions):
+                index = dict()
+                with open(self._partition_file(p), "rb") as f:
+                    while True:
+                        try:
+                            digest, seq, ids = pickle.load(f)
+                        except EOFError:
+                            break
+                        if digest in index:
+                            index[digest][1].extend(ids)
+                        else:
+                            index[digest] = (seq, ids)
+                for seq, ids in index.values():
+                    self.num_uniques += 1
+                    yield seq, ids
+        finally:
+            self._cleanup()
+
+    def _partition_file(self, p):
+        return os.path.join(self.spill_path, "p{}".format(p))
+
+    def _spill(self):
+        if self.spill_files is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.spill_path = tempfile.mkdtemp(prefix="derep_", dir=self.spill_dir)
+            self.spill_files = [open(self._partition_file(p), "wb")
+                                for p in range(self.partitions)]
+
+        for digest, (seq, ids) in self.index.items():
+            pickle.dump((digest, seq, ids), self.spill_files[digest[0] % self.partitions],
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        self.index = dict()
+        self.memory = 0
+
+    def _cleanup(self):
+        for p in range(self.partitions):
+            try:
+                os.remove(self._partition_file(p))
+            except OSError:
+                pass
+        try:
+            os.rmdir(self.spill_path)
+        except OSError:
+            pass
@@ -0,0 +1,115 @@
+import numpy as np
+from numba import njit
+
+from scata2.methods.scata.aligners import KMER_SIZE, alignment_bounds, encode, seq_kmers
+
+
+# Exact k-mer index over all genotypes of a job, used to find the pairs
+# of genotypes that can be within the clustering distance before any
+# alignment is done.
+#
+# Genotypes are numbered as in GenotypeIndex (chunks by pk). For each
+# genotype the distinct k-mers are kept, with an inverted index from k-mer
+# to genotypes. A pair is a candidate if it shares enough k-mers for an
+# alignment passing the identity and coverage limits (see aligners.py).
+# Genotypes too short or ambiguous to need any shared k-mer are paired
+# with all genotypes of compatible length.
+
+
+@njit
+def find_candidates(lengths, distinct, post_offsets, post_data, kmer_offsets, kmers,
+                    id_min, min_alignment):
+    n = len(lengths)
+    counts = np.zeros(n, dtype=np.int64)
+    touched = np.empty(n, dtype=np.int64)
+    by_length = np.argsort(lengths, kind="mergesort")
+    sorted_lengths = lengths[by_length]
+    a = []
+    b = []
+    for i in range(n):
+        nt = 0
+        for x in range(kmer_offsets[i], kmer_offsets[i + 1]):
+            kmer = kmers[x]
+            for p in range(post_offsets[kmer], post_offsets[kmer + 1]):
+                j = post_data[p]
+                if j <= i:
+                    continue
+                if counts[j] == 0:
+                    touched[nt] = j
+                    nt += 1
+                counts[j] += 1
+
+        for x in range(nt):
+            j = touched[x]
+            shared = counts[j]
+            counts[j] = 0
+            lo, hi, min_shared = alignment_bounds(lengths[i], lengths[j], distinct[i],
+                                                  distinct[j], id_min, min_alignment)
+            d = lengths[j] - lengths[i]
+            if shared >= min_shared and lo <= d <= hi:
+                a.append(i)
+                b.append(j)
+
+        # Pairs that need no shared k-mer. The gaps allowed for a pair are
+        # at most those of lengths[i], and -lo is the gaps plus the
+        # unaligned part of genotype i, so only genotypes with length
+        # within lengths[i] + lo and (lengths[i] - lo) / min_alignment
+        # can be paired.
+        lo, hi, min_shared = alignment_bounds(lengths[i], lengths[i], distinct[i],
+                                              distinct[i], id_min, min_alignment)
+        if min_shared > 0:
+            continue
+        first = np.searchsorted(sorted_lengths, lengths[i] + lo)
+        last = n
+        if min_alignment > 0:
+            last = np.searchsorted(sorted_lengths, (lengths[i] - lo) / min_alignment,
+                                   side="right")
+        for x in range(first, last):
+            j = by_length[x]
+            if j == i:
+                continue
+            lo, hi, min_shared = alignment_bounds(lengths[i], lengths[j], distinct[i],
+                                                  distinct[j], id_min, min_alignment)
+            d = lengths[j] - lengths[i]
+            if min_shared <= 0 and lo <= d <= hi:
+                a.append(min(i, j))
+                b.append(max(i, j))
+
+    return np.array(a, dtype=np.int64), np.array(b, dtype=np.int64)
+
+
+class KmerIndex:
+
+    def __init__(self, chunks):
+        lengths = []
+        genotype_kmers = []
+        for chunk in sorted(chunks, key=lambda c: c.pk):
+            records = chunk.get_uniseqs()
+            data, offsets = encode(records)
+            for i in range(len(records)):
+                lengths.append(offsets[i + 1] - offsets[i])
+                genotype_kmers.append(seq_kmers(data[offsets[i]:offsets[i + 1]], KMER_SIZE))
+
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.distinct = np.array([len(k) for k in genotype_kmers], dtype=np.int64)
+        self.kmer_offsets = np.zeros(len(genotype_kmers) + 1, dtype=np.int64)
+        np.cumsum(self.distinct, out=self.kmer_offsets[1:])
+        self.kmers = np.concatenate(genotype_kmers) if genotype_kmers \
+            else np.zeros(0, dtype=np.int64)
+
+        genotypes = np.repeat(np.arange(len(genotype_kmers), dtype=np.int64), self.distinct)
+        order = np.argsort(self.kmers, kind="stable")
+        self.post_data = genotypes[order]
+        self.post_offsets = np.searchsorted(self.kmers[order],
+                                            np.arange(4 ** KMER_SIZE + 1, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    # Candidate pairs as arrays (a, b), a < b, each pair once
+
+    def candidates(self, id_min, min_alignment):
+        a, b = find_candidates(self.lengths, self.distinct, self.post_offsets, self.post_data,
+                               self.kmer_offsets, self.kmers, id_min, min_alignment)
+        pairs = np.unique(a * len(self) + b)
+        return pairs // len(self), pairs % len(self)
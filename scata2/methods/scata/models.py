@@ -1,23 +1,42 @@
 import gzip
-import os
+import hashlib
 import pickle
 import random
-import subprocess
 from io import BytesIO
-from time import sleep
 
-from django.core.files import File
-from django.db import models
 from django.conf import settings
-from Bio import SeqIO
+from django.core.files import File
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+import numpy as np
 
 from scata2.storages import get_work_storage
-from scata2.methods.models import ScataMethod, ScataSequenceChunk, ChunkFullException, open_tags, ScataTagCluster
+from scata2.methods.models import ScataMethod, ScataSequenceChunk, open_tags, ScataTagCluster, \
+                                  SeqIterator
+from scata2.methods.scata.derep import Dereplicator, sequence_digest
+from scata2.methods.scata.scheduler import schedule, task_pairs, partition
+from scata2.methods.scata.unionfind import GenotypeIndex, UnionFind, components
+from scata2.methods.scata.aligners import aligners, min_identity
+from scata2.methods.scata.kmerindex import KmerIndex
+from scata2.methods.scata.clusterstore import ClusterStore, write_clusterstore
 from scata2.methods.models import ScataTag, ScataCluster
 from django.forms import ModelForm
 from django.core.validators import MinValueValidator, MaxValueValidator
 import django_q.tasks as q2
+from django_q.conf import Conf
+
+
+
+# SeqRecords of genotypes by id (see GenotypeIndex), in the order of ids.
+# Each chunk is loaded once.
 
+def genotype_records(index, ids):
+    ids = np.asarray(ids, dtype=np.int64)
+    k = np.searchsorted(index.bases, ids, side="right") - 1
+    chunks = ScataSequenceChunk.objects.in_bulk(index.pks[np.unique(k)].tolist())
+    uniseqs = {pk: chunk.get_uniseqs() for pk, chunk in chunks.items()}
+    return [uniseqs[int(index.pks[c])][int(i - index.bases[c])] for i, c in zip(ids, k)]
 
 
 class ScataScataMethod(ScataMethod):
@@ -30,6 +49,9 @@ class ScataScataMethod(ScataMethod):
     id2name = models.FileField("Tags", null=True, blank=True,
                             upload_to="scata/methods/scata/id2name/",
                             storage=get_work_storage)
+    cluster_store = models.FileField("Cluster store", null=True, blank=True,
+                                     upload_to="scata/methods/scata/clusterstore/",
+                                     storage=get_work_storage)
     distance = models.FloatField("Clustering distance 0.001 < x < 0.10",
                                  null=False, blank=False, default=0.015,
                                  validators=[MinValueValidator(0.001,
@@ -85,6 +107,12 @@ class ScataScataMethod(ScataMethod):
                                 null=False, blank=False, default=0,
                                 validators=[MinValueValidator(0, "Min 0"),
                                             MaxValueValidator(100, "Max 100")])
+    clustered_datasets = models.ManyToManyField("scata2.ScataDataset", blank=True,
+                                                editable=False, related_name="+")
+    aligner = models.CharField("Aligner", blank=False, null=False,
+                               default="vsearch", max_length=10,
+                               choices={k: v['description'] for k, v in
+                                        aligners.items()})
 
 
     # Metrics
@@ -92,25 +120,76 @@ class ScataScataMethod(ScataMethod):
                                      default=0, null=False, blank=False)
     num_genotypes = models.IntegerField("Number of genotypes", editable=False,
                                         default=0, null=False, blank=False)
+    num_duplicates = models.IntegerField("Number of duplicate reads collapsed", editable=False,
+                                         default=0, null=False, blank=False)
     num_clusters = models.IntegerField("Number of clusters", editable=False,
                                        default=0, null=False, blank=False)
     num_singletons = models.IntegerField("Number of global singleton sequences", editable=False,
                                          default=0, null=False, blank=False)
 
+    # Pipeline state, see cluster()
+    stage = models.CharField("Stage", max_length=20, default="", editable=False)
+    stage_tasks = models.IntegerField("Tasks of the stage", default=0, editable=False)
+    stage_plan = models.FileField("Stage plan", null=True, blank=True,
+                                  upload_to="scata/methods/scata/plan/",
+                                  storage=get_work_storage)
+    checkpoint = models.JSONField("Checkpoint", default=dict, editable=False)
+    new_genotypes = models.FileField("New genotypes", null=True, blank=True,
+                                     upload_to="scata/methods/scata/newgenotypes/",
+                                     storage=get_work_storage)
 
-    # Clustering method
-    def cluster(self):
-        print("SCATA Clustering {}".format(self))
-        self.job.status = "Preparing"
-        self.job.save()
 
-        seq_iter = self.get_seq_iterator()
+    # Datasets can be added to a finished job, see cluster()
+    incremental = True
+
+    # cluster() only starts the cluster_chunk tasks, see start_stage()
+    asynchronous = True
 
+    def get_aligner(self):
+        return aligners[self.aligner]["class"](self)
 
+    # Clustering method. A run goes through the stages dedup, align,
+    # merge, summarise and finalise, and a job that was interrupted
+    # continues from the stage it was in: dedup, merge and finalise
+    # restart cleanly, align and summarise only run the tasks that have
+    # not finished.
+    def cluster(self):
+        print("SCATA Clustering {} (stage {})".format(self, self.stage or "new"))
+        if self.stage in ("", "dedup"):
+            self.dedup()
+        elif self.stage in self.next_stages:
+            self.run_tasks(self.stage)
+        else:
+            getattr(self, self.stage)()
+
+    # Dereplicate the reads of the run into chunks of genotypes
+
+    def dedup(self):
+        self.job.status = "Preparing"
+        self.job.save()
 
-        id2name = {}
+        # A job that has been clustered before is extended with the reads
+        # of the datasets added since (see JobAddDatasetsView), reusing the
+        # genotypes, subclusters and clusters of the earlier runs.
+        incremental = self.clustered_datasets.exists()
+        self.restart_dedup(incremental)
+
+        if incremental:
+            new_datasets = self.job.datasets.exclude(pk__in=self.clustered_datasets.all())
+            seq_iter = SeqIterator(list(new_datasets), self.job.amplicon)
+            with self.id2name.open(mode="rb") as id2name_file:
+                with gzip.open(id2name_file, "rb") as id2name_file_gz:
+                    id2name = pickle.load(id2name_file_gz)
+        else:
+            new_datasets = self.job.datasets.all()
+            seq_iter = self.get_seq_iterator()
+            id2name = {}
+
+        # Read ids continue after the reads of earlier runs, progress is
+        # reported for the reads of this run.
         seqs = {}
-        n = 0
+        n = self.total_size
+        first_read = n
 
         self.job.refresh_from_db()
         if self.job.deleted:
@@ -119,121 +198,223 @@ class ScataScataMethod(ScataMethod):
         self.job.status = "Deduplicating 0/{}".format(len(seq_iter))
         self.job.save()
 
-        # Don't duplicate chunk set if already saved.
-
         chunks = list(ScataSequenceChunk.objects.filter(job=self.job).order_by("-length"))
         tasks = []
+        chunk_size = 4000
+
+        # Genotypes before this run have ids below first_new. Earlier
+        # genotypes that get new reads are touched.
+        first_new = sum(len(chunk) for chunk in chunks) if incremental else 0
+        touched = []
+
+        # Dereplicate all reads globally, so each genotype ends up in
+        # exactly one chunk.
+        derep = Dereplicator()
+        for ids, batch in seq_iter.iter_batches(10000):
+            self.job.refresh_from_db()
+            if self.job.deleted:
+                print("Job {} deleted".format(self.pk))
+                return
+            self.job.status = "Deduplicating {}/{}".format(n - first_read, len(seq_iter))
+            self.job.save()
+            print("Deduplicating {}/{}".format(n - first_read, len(seq_iter)))
 
-        if len(chunks) == 0:
-            for seq in seq_iter:
+            for name, seq in zip(ids, batch):
                 n += 1
-                if n % 10000 == 0:
-                    self.job.refresh_from_db()
-                    if self.job.deleted:
-                        print("Job {} deleted".format(self.pk))
-                        return
-                    self.job.status = "Deduplicating {}/{}".format(n, len(seq_iter))
-                    self.job.save()
-                    print("Deduplicating {}/{}".format(n, len(seq_iter)))
                 self.total_size += 1
                 id = "{}".format(n)
-                l = len(seq[1])
-                id2name[id] = seq[0]
-                chunk = seqs.get(l, ScataSequenceChunk.new_chunk(self.job, l))
-                try:
-                    chunk.add_sequence(id, seq[1])
-                except ChunkFullException:
-                    chunk.save()
-                    self.num_genotypes += chunk.num_uniques
-                    chunk = ScataSequenceChunk.new_chunk(self.job, l)
-                    chunk.add_sequence(id, seq[1])
+                id2name[id] = name
+                derep.add(id, seq)
+
+        self.job.status = "Chunking genotypes"
+        self.job.save()
+
+        # Reads with the sequence of an earlier genotype are added to
+        # it, new genotypes go in new chunks after the earlier ones.
+        existing = {}
+        if incremental:
+            index = GenotypeIndex(chunks)
+            for chunk in chunks:
+                for i, record in enumerate(chunk.get_uniseqs()):
+                    existing[str(record.seq)] = (chunk, index.offsets[chunk.pk] + i)
+        touched_chunks = {}
+        existing_uniques = 0
+
+        for seq, seq_ids in derep.uniques():
+            if seq in existing:
+                chunk, genotype = existing[seq]
+                chunk.add_reads(seq, seq_ids)
+                touched_chunks[chunk.pk] = chunk
+                touched.append(genotype)
+                existing_uniques += 1
+                continue
 
+            l = len(seq)
+            chunk = seqs.get(l)
+            if chunk is None or chunk.num_uniques >= chunk_size:
+                if chunk is not None:
+                    chunk.save()
+                chunk = ScataSequenceChunk.new_chunk(self.job, l, chunk_size)
                 seqs[l] = chunk
+            chunk.add_unique(seq, seq_ids)
+            self.num_genotypes += 1
 
-            for seq in seqs.values():
-                self.num_genotypes += seq.num_uniques
-                seq.save()
+        for seq in seqs.values():
+            seq.save()
+        for chunk in touched_chunks.values():
+            chunk.file.delete(save=False)
+            chunk.save()
 
-        self.job.status = "Starting clustering"
-        self.job.save()
+        self.num_duplicates += derep.duplicates + existing_uniques
+        print("Dereplicated {} reads into {} genotypes, {} duplicates".format(
+            derep.total, derep.num_uniques - existing_uniques,
+            derep.duplicates + existing_uniques))
 
-        # In cases whith non-zero gap-penalty, clustering can be optimised by
-        # only clustering sequences length difference less than
-        # gap penalty * sequence length of the longer sequence. We use
-        # global alignment, so length difference will always require a gap.
+        with BytesIO() as id2name_file:
+            with gzip.open(id2name_file, "wb") as gz:
+                pickle.dump(id2name, gz)
+            id2name_file.seek(0)
+            name = "j{}/id2name".format(self.pk)
+            self.id2name = File(id2name_file, name=name)
+            self.save()
 
-        # TODO implement the above. This is a plain all against all
-        # implementation.
+        # Genotypes new in this run or with new reads, for the merge
+        with BytesIO() as new_file:
+            with gzip.open(new_file, "wb") as gz:
+                pickle.dump((first_new, touched), gz)
+            new_file.seek(0)
+            name = "j{}/newgenotypes".format(self.pk)
+            self.new_genotypes = File(new_file, name=name)
+            self.save()
 
-        task_group = "scata_cluster_{}".format(self.job.pk)
-        tasks = []
+        self.align(incremental, first_new)
+
+    # Checkpoint of the state before dedup(), restored when dedup() runs
+    # again after an interruption: chunks made since are removed, and
+    # reads added to earlier chunks dropped. Subclusters made since (by
+    # align() before the stage changed) are removed too, as the genotype
+    # ids they use change with the chunks. A run that is not incremental
+    # starts from scratch.
+
+    def restart_dedup(self, incremental):
+        if self.stage == "dedup":
+            self.total_size = self.checkpoint["total_size"]
+            self.num_genotypes = self.checkpoint["num_genotypes"]
+            self.num_duplicates = self.checkpoint["num_duplicates"]
+            for chunk in ScataSequenceChunk.objects.filter(job=self.job):
+                if chunk.pk > self.checkpoint["chunk_pk"]:
+                    chunk.file.delete(save=False)
+                    chunk.delete()
+                else:
+                    chunk.drop_reads_after(self.total_size)
+            for subcluster in ScataScataSubCluster.objects.filter(job=self.job,
+                                                                  pk__gt=self.checkpoint["subcluster_pk"]):
+                subcluster.file.delete(save=False)
+                subcluster.delete()
+            self.save()
+            return
 
-        # Collect set of chunk groups of similar sequence counts
-        chunks = list(ScataSequenceChunk.objects.filter(job=self.job).order_by("-length"))
-        group_size = 4000
-        chunk_groups = []
-        group = []
-        c = 0
-        while True:
-            try:
-                chunk = chunks.pop(0)
-                c += len(chunk)
-                group.append(chunk)
-            except IndexError:
-                chunk_groups.append(group)
-                break
-            if c > group_size:
-                chunk_groups.append(group)
-                group = []
-                c = 0
-
-
-        task_num = 0
-        for q in range(len(chunk_groups)):
-            for t in range(q, len(chunk_groups)):
-                long = chunk_groups[q][-1].length
-                short = chunk_groups[t][0].length
-                length_diff = long - short
-                gap_score = length_diff * self.extend_pen + self.open_pen
-
-                # No need to compare if distance due to length
-                # difference is more than accepted distane.
-
-                if float(gap_score) / float(long) > self.distance:
-                    break
-
-                task_num += 1
-                tasks.append(q2.async_task(ScataScataMethod.cluster_chunk,
-                                           self.job.pk, task_num,
-                                           [a.pk for a in chunk_groups[q]],
-                                           [a.pk for a in chunk_groups[t]],
-                                           group=task_group,
-                                           task_name="cluster_chunk self job={} {} {}". \
-                                           format(self.job.pk,
-                                                  len(chunk_groups[q]),
-                                                  len(chunk_groups[t]))
-                                           ))
-
-        # Count groups while waiting.
-        while True:
-            success_count = q2.count_group(task_group)
-            fail_count = q2.count_group(task_group, failures=True)
-            total_count = success_count + fail_count
+        if not incremental:
+            for chunk in ScataSequenceChunk.objects.filter(job=self.job):
+                chunk.file.delete(save=False)
+                chunk.delete()
+            for subcluster in ScataScataSubCluster.objects.filter(job=self.job):
+                subcluster.file.delete(save=False)
+                subcluster.delete()
+            ScataCluster.objects.filter(job=self.job).delete()
+            ScataTag.objects.filter(job=self.job).delete()
+            self.total_size = 0
+            self.num_genotypes = 0
+            self.num_duplicates = 0
+
+        self.checkpoint = {"total_size": self.total_size,
+                           "num_genotypes": self.num_genotypes,
+                           "num_duplicates": self.num_duplicates,
+                           "chunk_pk": ScataSequenceChunk.objects.filter(job=self.job).
+                           aggregate(models.Max("pk"))["pk__max"] or 0,
+                           "subcluster_pk": ScataScataSubCluster.objects.filter(job=self.job).
+                           aggregate(models.Max("pk"))["pk__max"] or 0}
+        self.stage = "dedup"
+        self.save()
 
-            self.job.refresh_from_db()
-            if self.job.deleted:
-                print("Job {} deleted".format(self.pk))
-                return
-            self.job.status = "Clustering {}/{}".format(total_count,
-                                              len(tasks))
-            self.job.save()
+    # Find the candidate pairs of genotypes and start the cluster_chunk
+    # tasks. Pairs of genotypes before first_new are left out of an
+    # incremental run.
+
+    def align(self, incremental, first_new):
+        self.job.status = "Indexing genotypes"
+        self.job.save()
+
+        # Only compare genotypes that share enough k-mers to be within
+        # the clustering distance (see kmerindex.py and scheduler.py).
+
+        chunks = list(ScataSequenceChunk.objects.filter(job=self.job))
+        kmer_index = KmerIndex(chunks)
+        a, b = kmer_index.candidates(min_identity(self.distance), self.min_alignment)
+        if incremental:
+            # Pairs of earlier genotypes are already compared, a < b
+            keep = b >= first_new
+            a = a[keep]
+            b = b[keep]
+
+        # Pairs aligned before (by this or another job) are evaluated from
+        # the alignment cache, only the rest are scheduled.
+        use_cache = settings.ALIGNMENT_CACHE_SIZE > 0
+        edges_a = []
+        edges_b = []
+        if use_cache:
+            hashes = ScataScataAlignment.digest_hashes(
+                [sequence_digest(str(record.seq))
+                 for chunk in sorted(chunks, key=lambda c: c.pk)
+                 for record in chunk.get_uniseqs()])
+            indices, entries = ScataScataAlignment.lookup(self, hashes, a, b)
+            aligned = np.zeros(len(a), dtype=bool)
+            for p, entry in zip(indices.tolist(), entries):
+                hit = entry.result(min_identity(self.distance), self.min_alignment)
+                if hit is False:
+                    continue
+                aligned[p] = True
+                if hit is not None and self.accept_hit(hit):
+                    edges_a.append(a[p])
+                    edges_b.append(b[p])
+            print("{} of {} candidate pairs found in the alignment cache".format(
+                aligned.sum(), len(a)))
+            a = a[~aligned]
+            b = b[~aligned]
+
+        scheduled, singletons = schedule(len(kmer_index), a, b, Conf.WORKERS)
+        singletons = singletons[singletons >= first_new]
+        print("Scheduled {} tasks, {} candidate pairs ({:.1f}% of all against all)".format(
+            len(scheduled), len(a),
+            100.0 * len(a) / max(1, len(kmer_index) * (len(kmer_index) - 1) // 2)))
+        if use_cache:
+            pairs = task_pairs(scheduled, len(kmer_index), a, b)
+        else:
+            pairs = [None] * len(scheduled)
+        del kmer_index
+
+        # Genotypes without candidates are singletons, cached hits are
+        # added with them.
+        if len(singletons) > 0 or len(edges_a) > 0:
+            edges_a = np.concatenate([singletons, np.array(edges_a, dtype=np.int64)])
+            edges_b = np.concatenate([singletons, np.array(edges_b, dtype=np.int64)])
+            ScataScataSubCluster.make_subcluster(*components(edges_a, edges_b), self.job)
+
+        self.job.status = "Starting clustering"
+        self.job.save()
+
+        self.start_stage("align", [(query, target, task_pair) for (query, target, cost), task_pair
+                                   in zip(scheduled, pairs)])
+        self.run_tasks("align")
 
+    # Merge the subclusters of the cluster_chunk tasks into clusters, and
+    # start the summary tasks.
 
-            if total_count == len(tasks):
-                break
-            sleep(2)
+    def merge(self):
         # Delete results objects, they are not used
-        q2.delete_group(task_group)
+        q2.delete_group("scata_cluster_{}".format(self.job.pk))
+        if settings.ALIGNMENT_CACHE_SIZE > 0:
+            ScataScataAlignment.evict(settings.ALIGNMENT_CACHE_SIZE)
 
         self.job.refresh_from_db()
         if self.job.deleted:
@@ -242,83 +423,95 @@ class ScataScataMethod(ScataMethod):
         self.job.status = "Clustering done, starting merge."
         self.job.save()
 
+        incremental = self.clustered_datasets.exists()
+        if incremental:
+            new_datasets = self.job.datasets.exclude(pk__in=self.clustered_datasets.all())
+        else:
+            new_datasets = self.job.datasets.all()
+        with self.id2name.open(mode="rb") as id2name_file:
+            with gzip.open(id2name_file, "rb") as id2name_file_gz:
+                id2name = pickle.load(id2name_file_gz)
+        with self.new_genotypes.open(mode="rb") as new_file:
+            with gzip.open(new_file, "rb") as new_file_gz:
+                first_new, touched = pickle.load(new_file_gz)
+
         subclusters = ScataScataSubCluster.objects.filter(job=self.job, level=0)
 
         if len(subclusters) == 0:
+            self.stage = ""
+            self.save()
             self.job.status = "No clusters formed."
             self.job.save()
+            self.job.complete()
             return
 
-        clusters = [ ]
+        # Merge subclusters into global clusters. Every subcluster is fed
+        # in as edges between genotypes, genotypes seen in no subcluster
+        # are left out.
+
+        index = GenotypeIndex(ScataSequenceChunk.objects.filter(job=self.job))
+        merged = UnionFind(len(index))
+        seen = np.zeros(len(index), dtype=bool)
 
         pre_merge_count = 0
         for subcluster in subclusters:
-            for sc in subcluster.get():
-                is_added = False
-                to_delete = [ ]
-                pre_merge_count += 1
-                for (i,c) in enumerate(clusters):
-                    if sc & c:
-                        if not is_added:
-                            clusters[i] |= sc
-                            is_added = i
-                        else:
-                            clusters[is_added] |= sc
-                            clusters[is_added] |= clusters[i]
-                            to_delete.append(i)
-                if is_added: # Delete any merged items if needed.
-                    for i in reversed(to_delete):
-                        del clusters[i]
-                else:
-                    clusters.append(sc)
-
-        pre_clusters = [ ]
-        print("Clusters: {}".format(len(clusters)))
-
-        while len(pre_clusters) != len(clusters):
-            print("merge {} {}".format(len(pre_clusters), len(clusters)))
-            pre_clusters = clusters
-            clusters = [ ]
-            for sc in pre_clusters:
-                is_added = False
-                to_delete = []
-                pre_merge_count += 1
-                for (i, c) in enumerate(clusters):
-                    if sc & c:
-                        if not is_added:
-                            clusters[i] |= sc
-                            is_added = i
-                        else:
-                            clusters[is_added] |= sc
-                            clusters[is_added] |= clusters[i]
-                            to_delete.append(i)
-                if is_added:  # Delete any merged items if needed.
-                    for i in reversed(to_delete):
-                        del clusters[i]
-                else:
-                    clusters.append(sc)
-            print("merged {} {}".format(len(pre_clusters), len(clusters)))
-
-        print("{} pre-clusters merged into {} clusters.\n{} genotypes".format(pre_merge_count,len(clusters),
+            a, b, count = subcluster.edges()
+            merged.union(a, b)
+            seen[b] = True
+            pre_merge_count += count
+
+        merged_components = merged.components(seen)
+
+        if incremental:
+            # Only clusters with new or touched genotypes are summarised
+            # again, appended after the earlier clusters. The earlier
+            # clusters they replace are left as empty sets, so the others
+            # keep their index (and name).
+            with self.pre_clusters.open(mode="rb") as cluster_file:
+                with gzip.open(cluster_file, "rb") as cluster_file_gz:
+                    clusters = pickle.load(cluster_file_gz)
+            first_cluster = len(clusters)
+
+            affected = np.zeros(len(index), dtype=bool)
+            affected[first_new:] = True
+            affected[np.array(touched, dtype=np.int64)] = True
+            old_cluster = np.full(first_new, -1, dtype=np.int64)
+            for c, cluster_set in enumerate(clusters):
+                old_cluster[index.ids(list(cluster_set))] = c
+
+            replaced = set()
+            changed = []
+            for component in merged_components:
+                if affected[component].any():
+                    replaced.update(old_cluster[component[component < first_new]].tolist())
+                    changed.append({index.name(i) for i in component})
+            replaced.discard(-1)
+
+            self.remove_clusters(replaced)
+            for c in replaced:
+                clusters[c] = set()
+            changed.sort(key=lambda a: len(a), reverse=True)
+            clusters.extend(changed)
+        else:
+            first_cluster = 0
+            clusters = [{index.name(i) for i in c} for c in merged_components]
+
+        print("{} pre-clusters merged into {} clusters.\n{} genotypes".format(pre_merge_count,
+                                                                             len(clusters) - first_cluster,
                                                                              self.num_genotypes))
 
         # Sort and save pre clusters by size to make available
         # to subtasks
 
-        clusters.sort(key=lambda a: len(a), reverse=True)
-
-        # with open("foo_{}.txt".format(self.job.pk), "w") as f:
-        #     for i, c in enumerate(clusters):
-        #         print("\n".join(["{};{}".format(i, a) for a in c]), file=f)
-
+        clusters[first_cluster:] = sorted(clusters[first_cluster:], key=lambda a: len(a),
+                                          reverse=True)
 
         with BytesIO() as cluster_file:
             with gzip.open(cluster_file, "wb") as gz:
                 pickle.dump(clusters, gz)
             cluster_file.seek(0)
             name = "j{}/preclusters".format(self.pk)
-            self.pre_clusters = File(cluster_file, name=name)
-            self.save()
+            self.pre_clusters.save(name, File(cluster_file, name=name), save=False)
 
 
 
@@ -331,14 +524,17 @@ class ScataScataMethod(ScataMethod):
 
 
         tags = {}
+        if incremental:
+            with self.tags.open(mode="rb") as tags_file:
+                with gzip.open(tags_file, "rb") as tags_file_gz:
+                    tags = pickle.load(tags_file_gz)
+
         # Summarise cluster and save in the Orm model structure
-        for ds in self.job.datasets.all():
+        for ds in new_datasets:
             ds_tags = open_tags(ds)
             for tag, tag_data in ds_tags.items():
-                obj = ScataTag()
-                obj.job = self.job
-                obj.name = ds.short_name + "_" + tag
-                obj.save()
+                obj, created = ScataTag.objects.get_or_create(job=self.job,
+                                                              name=ds.short_name + "_" + tag)
 
                 tags[ ds.short_name + "_" + tag] = { 'object': obj.pk,
                                                'seq_ids': tag_data['seq_ids']}
@@ -349,80 +545,230 @@ class ScataScataMethod(ScataMethod):
                 pickle.dump(tags, gz)
             tag_file.seek(0)
             name = "j{}/tags".format(self.pk)
-            self.tags = File(tag_file, name=name)
-            self.save()
+            self.tags.save(name, File(tag_file, name=name), save=False)
+
+        # Read tags and cluster membership as arrays for the summary
+        # tasks (see clusterstore.py). A read gets the first tag that has
+        # its name.
+        name_tag = {}
+        for t, tag_data in reversed(list(enumerate(tags.values()))):
+            for seq_name in tag_data['seq_ids']:
+                name_tag[seq_name] = t
+        read_tag = np.full(self.total_size + 1, -1, dtype=np.int32)
+        for id, name in id2name.items():
+            read_tag[int(id)] = name_tag.get(name, -1)
+        del name_tag
+
+        genotype_reads = []
+        for chunk in sorted(ScataSequenceChunk.objects.filter(job=self.job), key=lambda c: c.pk):
+            genotype_reads.extend([int(id) for id in ids] for ids in chunk.get_seq_ids())
+        genotype_sizes = np.array([len(ids) for ids in genotype_reads], dtype=np.int64)
+        cluster_genotypes = [index.ids(list(cluster_set)) for cluster_set in clusters]
+
+        with BytesIO() as store_file:
+            write_clusterstore(store_file, read_tag,
+                               [tag_data['object'] for tag_data in tags.values()],
+                               genotype_reads,
+                               cluster_genotypes,
+                               [id2name.get(str(id), "") for id in range(self.total_size + 1)])
+            store_file.seek(0)
+            name = "j{}/clusterstore".format(self.pk)
+            self.cluster_store.save(name, File(store_file, name=name), save=False)
+        del read_tag, genotype_reads
+
+        # Summary work scales by the number of reads of a cluster, and
+        # cluster sizes are heavy tailed. The clusters of this run are
+        # split into one task per worker with about the same number of
+        # reads in each (see scheduler.py).
+
+        # The outputs of the merge are saved with the start of the next
+        # stage, so an interrupted merge runs again from the same inputs.
+        costs = [genotype_sizes[genotypes].sum() for genotypes in cluster_genotypes[first_cluster:]]
+        self.start_stage("summarise", [part + first_cluster
+                                       for part in partition(costs, Conf.WORKERS)])
+        self.run_tasks("summarise")
+
+    def finalise(self):
+        # Delete results objects, they are not used
+        q2.delete_group("scata_summarise_{}".format(self.job.pk))
+
+        # Clusters of earlier incremental runs are renamed if there are now
+        # enough clusters for a wider index (see cluster_name()).
+        count = len(ClusterStore.open(self.cluster_store))
+        renamed = []
+        for cluster in ScataCluster.objects.filter(job=self.job).only("pk", "name"):
+            name = self.cluster_name(self.job.pk, int(cluster.name.rsplit("_", 1)[1]), count)
+            if name != cluster.name:
+                cluster.name = name
+                renamed.append(cluster)
+        ScataCluster.objects.bulk_update(renamed, ["name"], batch_size=1000)
 
-        with BytesIO() as id2name_file:
-            with gzip.open(id2name_file, "wb") as gz:
-                pickle.dump(id2name, gz)
-            id2name_file.seek(0)
-            name = "j{}/id2name".format(self.pk)
-            self.id2name = File(id2name_file, name=name)
+        # Summarise global metrics
+        clusters = ScataCluster.objects.filter(job=self.job)
+        self.num_clusters = clusters.filter(size__gt=1).count()
+        self.num_singletons = clusters.filter(size__lte=1).count()
+
+        # The clustered datasets and the end of the run are saved together,
+        # so a retry never sees a finished run without them.
+        with transaction.atomic():
+            self.clustered_datasets.set(self.job.datasets.all())
+            self.stage = ""
             self.save()
+            ScataScataTask.objects.filter(job=self.job).delete()
+        self.job.complete()
+
+    # Stages with tasks run them as django-q tasks, from a plan of the
+    # arguments of each task saved when the stage starts. A task is
+    # recorded (ScataScataTask) when it finishes, by the task itself or by
+    # its hook (task_done()), and the last one starts the next stage, so
+    # no worker waits for a task group.
+
+    next_stages = {"align": "merge", "summarise": "finalise"}
+    stage_status = {"align": "Clustering", "summarise": "Summarising"}
+
+    def start_stage(self, stage, plan):
+        ScataScataTask.objects.filter(job=self.job, stage=stage).delete()
+        with BytesIO() as plan_file:
+            with gzip.open(plan_file, "wb") as gz:
+                pickle.dump(plan, gz)
+            plan_file.seek(0)
+            name = "j{}/{}".format(self.pk, stage)
+            self.stage_plan.save(name, File(plan_file, name=name), save=False)
+        self.stage = stage
+        self.stage_tasks = len(plan)
+        self.save()
 
-        # Summary work scales by cluster size, so the first
-        # clusters in the list are usually much larger than the ones
-        # further down the list. To spread work evenly among workers,
-        # we interleave the clusters among the workers. (div/mod interleave)
+    # Enqueue the tasks of stage that have not finished. Failed tasks are
+    # run again.
 
-        job_size = 100 # 100 tasks per job
+    def run_tasks(self, stage):
+        with self.stage_plan.open(mode="rb") as plan_file:
+            with gzip.open(plan_file, "rb") as gz:
+                plan = pickle.load(gz)
 
-        num_clusters = len(clusters)
-        num_jobs = int((num_clusters - (num_clusters % job_size)) / job_size)
+        ScataScataTask.objects.filter(job=self.job, stage=stage, success=False).delete()
+        done = set(ScataScataTask.objects.filter(job=self.job, stage=stage).
+                   values_list("task_num", flat=True))
 
+        self.job.status = "Starting {}".format(self.stage_status[stage].lower())
+        self.job.save()
 
-        summary_tasks = []
-        task_group = "scata_cluster_{}".format(self.job.pk)
+        for task_num, args in enumerate(plan, start=1):
+            if task_num in done:
+                continue
+            if stage == "align":
+                query, target, pairs = args
+                q2.async_task(ScataScataMethod.cluster_chunk,
+                              self.job.pk, task_num,
+                              query, target, pairs,
+                              group="scata_cluster_{}".format(self.job.pk),
+                              hook="scata2.methods.scata.models.cluster_chunk_done",
+                              task_name="cluster_chunk self job={} {} {}". \
+                              format(self.job.pk,
+                                     len(query),
+                                     len(target))
+                              )
+            else:
+                q2.async_task(ScataScataMethod.summarise_cluster,
+                              self.job.pk, task_num, args,
+                              group="scata_summarise_{}".format(self.job.pk),
+                              hook="scata2.methods.scata.models.summarise_cluster_done",
+                              task_name="summarise_cluster job={}, clusters={}".format(
+                                  self.job.pk, len(args)))
+        if len(done) >= len(plan):
+            self.end_stage(stage)
+
+    # Start the stage after stage, unless already started
+
+    def end_stage(self, stage):
+        next_stage = self.next_stages[stage]
+        if ScataScataMethod.objects.filter(pk=self.pk, stage=stage).update(stage=next_stage) == 0:
+            return
+        q2.async_task(ScataScataMethod.run_stage, self.job.pk, next_stage,
+                      task_name="{} job={}".format(next_stage, self.job.pk))
 
+    @classmethod
+    def run_stage(cls, job_pk, stage):
+        getattr(cls.objects.get(job=job_pk), stage)()
 
-        for c in range(num_jobs):
-            summary_tasks.append(q2.async_task(ScataScataMethod.summarise_cluster,
-                                               self.job.pk, c, num_jobs,
-                                                group=task_group,
-                                               task_name="summarise_cluster job={}, offset={}".format(self.job.pk, c)))
+    # Record a finished (or failed) task of stage
 
-        # Count groups while waiting.
-        while True:
-            success_count = q2.count_group(task_group)
-            fail_count = q2.count_group(task_group, failures=True)
-            total_count = success_count + fail_count
+    @classmethod
+    def task_done(cls, job_pk, stage, task_num, success=True):
+        ScataScataTask.objects.get_or_create(job_id=job_pk, stage=stage, task_num=task_num,
+                                             defaults={"success": success})
+        cls_instance = cls.objects.get(job=job_pk)
+        if cls_instance.stage != stage or cls_instance.job.deleted:
+            return
+        # A failed task stops the run in this stage until the job is run
+        # again, see run_tasks()
+        tasks = ScataScataTask.objects.filter(job=job_pk, stage=stage)
+        done = tasks.filter(success=True).count()
+        failed = tasks.filter(success=False).count()
+        if failed > 0 and done + failed >= cls_instance.stage_tasks:
+            cls_instance.job.status = "{} failed in {} of {} tasks".format(
+                cls.stage_status[stage], failed, cls_instance.stage_tasks)
+        else:
+            cls_instance.job.status = "{} {}/{}".format(cls.stage_status[stage], done,
+                                                        cls_instance.stage_tasks)
+        cls_instance.job.save(update_fields=["status"])
+        if done >= cls_instance.stage_tasks:
+            cls_instance.end_stage(stage)
+
+    # Remove the ScataCluster objects of pre cluster indices, and their
+    # reads from the tag totals.
+
+    def remove_clusters(self, indices):
+        for cluster in ScataCluster.objects.filter(job=self.job):
+            if int(cluster.name.rsplit("_", 1)[1]) not in indices:
+                continue
+            with transaction.atomic():
+                for tag_cluster in ScataTagCluster.objects.filter(cluster=cluster).select_related("tag"):
+                    tag_cluster.tag.size -= tag_cluster.size
+                    tag_cluster.tag.num_clusters -= 1
+                    tag_cluster.tag.save()
+                cluster.delete()
 
-            self.job.refresh_from_db()
-            if self.job.deleted:
-                print("Job {} deleted".format(self.pk))
-                return
-            self.job.status = "Summarising {}/{}".format(total_count,
-                                                         len(summary_tasks))
-            self.job.save()
+    # Read names of a ScataCluster or a ScataTagCluster of the job, from
+    # the cluster store.
 
-            if total_count == len(summary_tasks):
-                break
-            sleep(2)
-        # Delete results objects, they are not used
-        q2.delete_group(task_group)
+    def cluster_reads(self, cluster):
+        store = ClusterStore.open(self.cluster_store)
+        c = int(cluster.name.rsplit("_", 1)[1])
+        return [store.read_name(id) for id in store.cluster_reads(c).tolist()]
 
-        # Summarise global metrics
-        self.num_clusters = 0
-        self.num_singletons = 0
-        cluster_num=0
-        for cluster in ScataCluster.objects.filter(job=self.job).order_by("-size"):
-            cluster_num += 1
+    def tag_cluster_reads(self, tag_cluster):
+        store = ClusterStore.open(self.cluster_store)
+        c = int(tag_cluster.cluster.name.rsplit("_", 1)[1])
+        reads = store.tag_cluster_reads(c, store.tag_index(tag_cluster.tag_id))
+        return [store.read_name(id) for id in reads.tolist()]
 
-            cluster.cluster_id = "{}_{}".format(self.job.pk, cluster_num)
-            cluster.save()
+    # True if an aligner hit is within the clustering distance and
+    # alignment coverage
 
-            if cluster.size > 1:
-                self.num_clusters += 1
-            else:
-                self.num_singletons += 1
+    def accept_hit(self, hit):
+        # Check alignment coverage
+        if min(hit["tcov"], hit["qcov"]) < self.min_alignment:
+            return False
 
-        self.save()
-        self.job.status = "Ready"
-        self.job.save()
+        # Divergent sites
+        distance = (hit["pairs"] - hit["pv"]) * self.mismatch_pen
+
+        # Gaps
+        distance += hit["opens"] * self.open_pen
+        distance += hit["exts"] * self.extend_pen
+
+        distance = distance / float(max(hit["qihi"] - hit["qilo"], hit["tihi"] - hit["tilo"]) + 1)
+
+        # Check if within clusterin distance
+        return distance <= self.distance
+
+    # query and target are genotype ids, pairs the candidate pairs of the
+    # task as arrays (a, b) when the alignment cache is used.
 
     @classmethod
     def cluster_chunk(cls, job_pk, task_num,
-                      query, target):
+                      query, target, pairs=None):
         cls_instance = cls.objects.get(job=job_pk)
 
         # Instance can be cached.
@@ -432,137 +778,73 @@ class ScataScataMethod(ScataMethod):
             print("cluster_chunk(): Job {} deleted".format(cls_instance.job.pk))
             return
 
-        target_file = os.path.join(settings.SCRATCH_DIR,
-                                   "t_{}_{}.fasta".format(job_pk, task_num))
-        query_file = os.path.join(settings.SCRATCH_DIR,
-                                   "q_{}_{}.fasta".format(job_pk, task_num))
-        query = ScataSequenceChunk.objects.in_bulk(query)
-        target = ScataSequenceChunk.objects.in_bulk(target)
-
-        query_records = [r for q in query.values() for r in q.get_uniseqs()]
-        target_records = [r for t in target.values() for r in t.get_uniseqs()]
-
-        SeqIO.write(target_records, target_file, "fasta")
-        SeqIO.write(query_records, query_file, "fasta")
-
-        vsearch_fields = { "query": str,
-                           "target": str,
-                           "id0": float,
-                           "qilo": lambda a: int(a) - 1,
-                           "qihi": lambda a: int(a) - 1,
-                           "tilo": lambda a: int(a) - 1,
-                           "tihi": lambda a: int(a) - 1,
-                           "ql": int,
-                           "tl": int,
-                           "tcov": lambda a: float(a) / 100.0,
-                           "qcov": lambda a: float(a) / 100.0,
-                           "mism": int,
-                           "opens": int,
-                           "exts": int,
-                           "pairs": int,
-                           "pv": int,
-                           "alnlen": int, }
-
-        process = subprocess.Popen([settings.VSEARCH_COMMAND,
-                                    "--mismatch", "{}".format(cls_instance.mismatch_pen * -1),
-                                    "--gapopen", "{}I/{}E".format(cls_instance.open_pen,
-                                                                  cls_instance.open_pen * cls_instance.endgap_pen),
-                                    "--gapext", "{}I/{}E".format(cls_instance.extend_pen,
-                                                                  cls_instance.extend_pen * cls_instance.endgap_pen),
-                                    "--strand", "plus",
-                                    "--threads", "1",
-                                    "--maxaccepts", "0",
-                                    "--maxrejects", "100",
-                                    "--usearch_global", query_file,
-                                    "--db", target_file,
-                                    "--userout", "-",
-                                    "--id", "{}".format(1.0 - float(cls_instance.distance) - 0.01),
-                                    "--userfields", "+".join(vsearch_fields.keys()),
-                                    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-
-
-        vsearch_result, vsearch_errors = process.communicate()
-
-        if process.returncode != 0:
-            raise RuntimeError("VSEARCH_COMMAND exited with return code {}\n\nCommand output:\n\n{}".format(process.returncode, vsearch_errors))
-
-        try:
-            os.remove(target_file)
-            os.remove(query_file)
-        except OSError:
-            pass
-
-        clusters = { }
-        potential_singletons = set()
-
-        for line in vsearch_result.splitlines():
-            hit = {a[0]: vsearch_fields[a[0]](a[1]) for a in zip(vsearch_fields.keys(), line.split("\t"))}
+        # Already done by an earlier run of the stage
+        if ScataScataTask.objects.filter(job=job_pk, stage="align", task_num=task_num).exists():
+            return
 
+        # query and target are genotype ids, see unionfind.py
+        index = GenotypeIndex(ScataSequenceChunk.objects.filter(job=cls_instance.job).
+                              only("pk", "num_uniques"))
+        query_records = genotype_records(index, query)
+        target_records = genotype_records(index, target)
+
+        # Accepted hits are collected as edges between genotype ids and
+        # joined with union-find. Every query gets an edge to itself, so
+        # genotypes without hits are reported as singletons.
+        edges_a = list(query)
+        edges_b = list(query)
+
+        # Hits are processed as the aligner reports them
+        aligner = cls_instance.get_aligner()
+        found = {}
+        for hit in aligner.hits(query_records, target_records):
             # Ignore self
             if hit["query"] == hit["target"]:
-                potential_singletons.add(hit["query"])
                 continue
 
-            # Check alignment coverage
-            if min(hit["tcov"], hit["qcov"]) < cls_instance.min_alignment:
-                continue
-
-            # Divergent sites
-            distance = (hit["pairs"] - hit["pv"]) * cls_instance.mismatch_pen
-
-            # Gaps
-            distance += hit["opens"] * cls_instance.open_pen
-            distance += hit["exts"] * cls_instance.extend_pen
+            query_id = index.id(hit["query"])
+            target_id = index.id(hit["target"])
+            found[(query_id, target_id)] = hit
 
-            distance = distance / float(max(hit["qihi"] - hit["qilo"], hit["tihi"] - hit["tilo"]) + 1)
-
-            # Check if within clusterin distance
-            if distance > cls_instance.distance:
+            if not cls_instance.accept_hit(hit):
                 continue
 
-            # Case 1, both query and target in cluster, this joins
-            # two already existing clusters.
-            if hit["query"] in clusters and hit["target"] in clusters:
-                cq = clusters[hit["query"]]
-                ct = clusters[hit["target"]]
-
-                if cq == ct:
-                    continue # Same cluster, both already in
-
-                # Merge clusters and set new cluster for all members
-                nc = cq | ct
-                for id in nc:
-                    clusters[id] = nc
-
-            elif hit["query"] in clusters:
-                clusters[hit["query"]].add(hit["target"])
-                clusters[hit["target"]] = clusters[hit["query"]]
-
-            elif hit["target"] in clusters:
-                clusters[hit["target"]].add(hit["query"])
-                clusters[hit["query"]] = clusters[hit["target"]]
-
-            else:
-                clusters[hit["query"]] = { hit["target"], hit["query"] }
-                clusters[hit["target"]] = clusters[hit["query"]]
-
-        potential_singletons = potential_singletons - clusters.keys()
-
-        # Merge to unique list of clusters
-        unique_clusters = []
-        for cluster in clusters.values():
-            if cluster not in unique_clusters:
-                unique_clusters.append(cluster)
-
-        unique_clusters = unique_clusters + [ { s } for s in potential_singletons ]
-
-        if len(unique_clusters) > 0:
-            ScataScataSubCluster.make_subcluster(unique_clusters, cls_instance.job)
+            edges_a.append(query_id)
+            edges_b.append(target_id)
+
+        ScataScataSubCluster.make_subcluster(*components(edges_a, edges_b),
+                                             cls_instance.job)
+
+        # Results of the candidate pairs of the task go to the alignment
+        # cache, pairs without a hit as None. A pair without a hit is only
+        # known not to match if the aligner is exhaustive.
+        if pairs is not None:
+            digests = {index.id(record.id): sequence_digest(str(record.seq))
+                       for record in query_records + target_records}
+            ids = np.array(sorted(digests), dtype=np.int64)
+            hashes = ScataScataAlignment.digest_hashes([digests[id] for id in ids.tolist()])
+            keep = []
+            hits = []
+            for p, (x, y) in enumerate(zip(*(p.tolist() for p in pairs))):
+                hit = found.get((x, y), found.get((y, x)))
+                if hit is None and not aligner.exhaustive:
+                    continue
+                keep.append(p)
+                hits.append(hit)
+            keep = np.array(keep, dtype=np.int64)
+            ScataScataAlignment.store(cls_instance,
+                                      hashes[np.searchsorted(ids, pairs[0][keep])],
+                                      hashes[np.searchsorted(ids, pairs[1][keep])],
+                                      hits, min_identity(cls_instance.distance),
+                                      cls_instance.min_alignment)
+
+        # Subclusters of a task that is run again are the same, so an
+        # interruption before this point does no harm to the merge.
+        ScataScataTask.objects.get_or_create(job_id=job_pk, stage="align", task_num=task_num)
 
 
     @classmethod
-    def summarise_cluster(cls, job_pk, start, offset):
+    def summarise_cluster(cls, job_pk, task_num, cluster_indices):
 
         cls_instance = cls.objects.get(job=job_pk)
 
@@ -570,91 +852,84 @@ class ScataScataMethod(ScataMethod):
             print("cluster_chunk(): Job {} deleted".format(cls_instance.job.pk))
             return
 
-        # Load data
+        store = ClusterStore.open(cls_instance.cluster_store)
 
-        clusters = None
-        id2name = None
-        tags = None
+        # Clusters and tag clusters are inserted in batches, and tag totals
+        # added once at the end, all in one transaction with the record of
+        # the task, so the clusters are created once even if the task is
+        # run again.
+        batch_size = 1000
+        tag_size = np.zeros(len(store.tag_pks), dtype=np.int64)
+        tag_num_clusters = np.zeros(len(store.tag_pks), dtype=np.int64)
 
-        with cls_instance.pre_clusters.open(mode="rb") as cluster_file:
-            with gzip.open(cluster_file, "rb") as cluster_file_gz:
-                clusters = pickle.load(cluster_file_gz)
-
-        with cls_instance.id2name.open(mode="rb") as id2name_file:
-            with gzip.open(id2name_file, "rb") as id2name_file_gz:
-                id2name = pickle.load(id2name_file_gz)
-
-        with cls_instance.tags.open(mode="rb") as tags_file:
-            with gzip.open(tags_file, "rb") as tags_file_gz:
-                tags = pickle.load(tags_file_gz)
-
-
-
-        open_chunks = {}
-
-        # Local helper function
-        def get_tag(seq_id):
-            for t, d in tags.items():
-                if seq_id in d['seq_ids']:
-                    return (t, d['object'])
-            raise KeyError("Sequence id {} not found in tags".format(seq_id))
-
-        # Create format string with 0-padding of the id that fits the largest cluster ID
-        id_format = "{}_{:0>" + str(len(str(len(clusters)))) + "}"
-
-        for c in range(start, len(clusters), offset):
-            cluster_set = clusters[c]
-            open_tag_clusters = {}
-            open_tag_objects = {}
-
-            # This is where each cluster is expanded/summarised
-
-            cluster = ScataCluster()
-            cluster.job = cls_instance.job
-            cluster.name = id_format.format(cluster.job.pk, c)
-            cluster.num_genotypes = len(cluster_set)
-            cluster.size = 0
-            cluster.num_clusters = 0
+        # The record is inserted first, a transaction starting with a read
+        # can not wait for the write lock of SQLite.
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    ScataScataTask.objects.create(job_id=job_pk, stage="summarise",
+                                                  task_num=task_num)
+            except IntegrityError:
+                return
+            clusters = []
+            counts = []
+            for c in cluster_indices.tolist():
+                # This is where each cluster is expanded/summarised
 
+                sizes = store.genotype_sizes(c)
+                tag_counts = store.tag_counts(c)
 
+                cluster = ScataCluster()
+                cluster.job = cls_instance.job
+                cluster.name = cls.cluster_name(cluster.job.pk, c, len(store))
+                cluster.num_genotypes = len(sizes)
+                cluster.size = int(sizes.sum())
+                cluster.num_singletons = int((sizes == 1).sum())
+                cluster.num_clusters = 0
+                clusters.append(cluster)
+                counts.append(tag_counts)
 
-            for seq_id in cluster_set:
-                chunk_id, id = [int(a) for a in seq_id.split("_")]
+                tag_size += tag_counts
+                tag_num_clusters += tag_counts > 0
 
-                if chunk_id not in open_chunks:
-                    open_chunks[chunk_id] = ScataSequenceChunk.objects.get(pk=chunk_id)
+                if len(clusters) >= batch_size:
+                    cls.create_clusters(clusters, counts, store.tag_pks)
+                    clusters = []
+                    counts = []
 
-                seq_names = [id2name[a] for  a in open_chunks[chunk_id].get_seq_by_id(id)]
+            cls.create_clusters(clusters, counts, store.tag_pks)
 
-                cluster.size += len(seq_names)
-                if len(seq_names) == 1:
-                    cluster.num_singletons += 1
+            for t in np.flatnonzero(tag_num_clusters):
+                ScataTag.objects.filter(pk=int(store.tag_pks[t])). \
+                    update(size=F("size") + int(tag_size[t]),
+                           num_clusters=F("num_clusters") + int(tag_num_clusters[t]))
 
-                for seq_name in seq_names:
-                    tag, tag_obj_pk = get_tag(seq_name)
+    # Name of cluster c of count clusters, the id is 0-padded to fit the
+    # largest cluster id.
 
-                    if tag_obj_pk not in open_tag_objects:
-                        open_tag_objects[tag_obj_pk] = ScataTag.objects.get(pk=tag_obj_pk)
+    @staticmethod
+    def cluster_name(job_pk, c, count):
+        return "{}_{:0>{}}".format(job_pk, c, len(str(count)))
 
-                    if tag not in open_tag_clusters:
-                        tag_cluster = ScataTagCluster()
-                        tag_cluster.cluster = cluster
-                        tag_cluster.tag = open_tag_objects[tag_obj_pk]
-                        open_tag_clusters[tag] = tag_cluster
-                        open_tag_objects[tag_obj_pk].num_clusters += 1
+    # Insert clusters and a tag cluster for each non zero count of their
+    # tag counts (by tag index, see clusterstore.py).
 
-                    open_tag_clusters[tag].size += 1
-                    open_tag_clusters[tag].seq_list.append(seq_name)
-                    open_tag_objects[tag_obj_pk].size += 1
+    @staticmethod
+    def create_clusters(clusters, counts, tag_pks):
+        ScataCluster.objects.bulk_create(clusters)
+        tag_clusters = []
+        for cluster, tag_counts in zip(clusters, counts):
+            for t in np.flatnonzero(tag_counts):
+                tag_clusters.append(ScataTagCluster(cluster=cluster, tag_id=int(tag_pks[t]),
+                                                    size=int(tag_counts[t])))
+        ScataTagCluster.objects.bulk_create(tag_clusters, batch_size=1000)
 
-            cluster.save()
-            for tc in open_tag_clusters.values():
-                tc.save()
-            for t in open_tag_objects.values():
-                t.save()
 
 
 
+# Clusters found by one cluster_chunk task, as two arrays with the
+# integer genotype id (see unionfind.py) of each member and the id of
+# the root of its cluster.
 
 class ScataScataSubCluster(models.Model):
     job = models.ForeignKey("scata2.ScataJob", on_delete=models.CASCADE)
@@ -662,12 +937,11 @@ class ScataScataSubCluster(models.Model):
                             storage=get_work_storage)
     level = models.PositiveIntegerField(default=0)
 
-    clusters = []
-
     @classmethod
-    def make_subcluster(cls, clusters, job, level=0):
+    def make_subcluster(cls, members, roots, job, level=0):
         cls_instance = cls()
-        cls_instance.clusters = clusters
+        cls_instance.members = members
+        cls_instance.roots = roots
         cls_instance.job = job
         cls_instance.level = level
         cls_instance.save()
@@ -676,18 +950,208 @@ class ScataScataSubCluster(models.Model):
         super().save(**kwargs) # Create db object to get pk
         with BytesIO() as seq_file:
             with gzip.open(seq_file, "wb") as gz:
-                pickle.dump(self.clusters, gz)
+                pickle.dump((self.members, self.roots), gz)
             seq_file.seek(0)
             name = "j{}/l{}c{}".format(self.job.pk, self.level, self.pk)
             self.file = File(seq_file, name=name)
             super().save(**kwargs)
 
     def get(self):
-        if len(self.clusters) == 0:
-            with self.file.open(mode="rb") as f:
-                with gzip.open(f, mode="rb") as gz:
-                    self.clusters = pickle.load(gz)
-        return self.clusters
+        with self.file.open(mode="rb") as f:
+            with gzip.open(f, mode="rb") as gz:
+                return pickle.load(gz)
+
+    # Subclusters as edge arrays (root, member), and the number of
+    # subclusters.
+
+    def edges(self):
+        members, roots = self.get()
+        return roots, members, len(np.unique(roots))
+
+# Alignment results of genotype pairs, kept between jobs so a job re-run
+# with another distance or min_alignment only aligns pairs not seen
+# before. Entries are keyed by the aligner and the penalties (scoring) and
+# the digests of the two sequences (see pair_keys()). A pair aligned
+# without a hit is stored with hit False and the thresholds it was
+# searched with, and is only valid for runs with the same or stricter
+# thresholds. The least recently used entries are evicted when there are
+# more than ALIGNMENT_CACHE_SIZE.
+
+# splitmix64 finalizer, mixing the bits of an uint64 array
+
+def mix64(z):
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
+
+
+class ScataScataAlignment(models.Model):
+    scoring = models.BigIntegerField()
+    first = models.BigIntegerField()
+    second = models.BigIntegerField()
+    checksum = models.BigIntegerField()
+    hit = models.BooleanField(default=False)
+    min_identity = models.FloatField(default=0.0)
+    min_alignment = models.FloatField(default=0.0)
+    qilo = models.IntegerField(default=0)
+    qihi = models.IntegerField(default=0)
+    tilo = models.IntegerField(default=0)
+    tihi = models.IntegerField(default=0)
+    qcov = models.FloatField(default=0.0)
+    tcov = models.FloatField(default=0.0)
+    pairs = models.IntegerField(default=0)
+    pv = models.IntegerField(default=0)
+    opens = models.IntegerField(default=0)
+    exts = models.IntegerField(default=0)
+    last_used = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["scoring", "first", "second"],
+                                               name="unique_scata_alignment")]
+
+    hit_fields = ["qilo", "qihi", "tilo", "tihi", "qcov", "tcov", "pairs", "pv", "opens", "exts"]
+    batch_size = 500
+
+    # Sequence digests (see derep.py) as an (n, 2) uint64 array
+
+    @staticmethod
+    def digest_hashes(digests):
+        return np.frombuffer(b"".join(digests), dtype="<u8").reshape(-1, 2)
+
+    # Keys of the pairs of sequences with digest hashes x and y, as
+    # (scoring, first, second, checksum). first and second are the first
+    # halves of the digests, ordered so the key is the same for both orders
+    # of a pair. The second halves go into the checksum. Hit fields are
+    # stored for either order, only the order independent values are used.
+
+    @staticmethod
+    def pair_keys(method, x, y):
+        scoring = "{}:{}:{}:{}:{}".format(method.aligner, method.mismatch_pen, method.open_pen,
+                                          method.extend_pen, method.endgap_pen)
+        scoring = np.frombuffer(hashlib.blake2b(scoring.encode(), digest_size=16).digest(),
+                                dtype="<u8")
+        swap = (x[:, 0] > y[:, 0])[:, None]
+        first = np.where(swap, y, x)
+        second = np.where(swap, x, y)
+        checksum = mix64(mix64(first[:, 1] ^ scoring[1]) + second[:, 1])
+        return (int(scoring[:1].view(np.int64)[0]), first[:, 0].view(np.int64),
+                second[:, 0].view(np.int64), checksum.view(np.int64))
+
+    # Entries of the pairs (a, b) of genotype ids, with hashes the digest
+    # hashes of all genotypes. Entries are fetched and marked as used a
+    # block of genotypes at a time, by the first genotype of the pair, and
+    # matched to the pairs by genotype id. Returns the indices of the pairs
+    # found and their entries.
+
+    @classmethod
+    def lookup(cls, method, hashes, a, b):
+        scoring, first, second, checksum = cls.pair_keys(method, hashes[a], hashes[b])
+        if not cls.objects.filter(scoring=scoring).exists():
+            return np.zeros(0, dtype=np.int64), []
+
+        n = len(hashes)
+        genotype_hashes = hashes[:, 0].view(np.int64)
+        by_hash = np.argsort(genotype_hashes)
+        sorted_hashes = genotype_hashes[by_hash]
+
+        # Genotype id of each hash, -1 for genotypes not in the job
+        def genotype_ids(values):
+            pos = np.minimum(np.searchsorted(sorted_hashes, values), n - 1)
+            return np.where(sorted_hashes[pos] == values, by_hash[pos], -1)
+
+        codes = genotype_ids(first) * n + genotype_ids(second)
+        by_code = np.argsort(codes)
+        sorted_codes = codes[by_code]
+
+        indices = []
+        found = []
+        now = timezone.now()
+        genotypes = np.unique(first)
+        for s in range(0, len(genotypes), cls.batch_size):
+            block = cls.objects.filter(scoring=scoring,
+                                       first__in=genotypes[s:s + cls.batch_size].tolist())
+            entries = list(block)
+            if not entries:
+                continue
+            block.update(last_used=now)
+
+            entry_first = genotype_ids(np.array([e.first for e in entries], dtype=np.int64))
+            entry_second = genotype_ids(np.array([e.second for e in entries], dtype=np.int64))
+            entry_codes = entry_first * n + entry_second
+            pos = np.minimum(np.searchsorted(sorted_codes, entry_codes), len(codes) - 1)
+            pair = by_code[pos]
+            match = (entry_first >= 0) & (entry_second >= 0) & (sorted_codes[pos] == entry_codes) & \
+                (checksum[pair] == np.array([e.checksum for e in entries], dtype=np.int64))
+            for e in np.flatnonzero(match).tolist():
+                indices.append(pair[e])
+                found.append(entries[e])
+        return np.array(indices, dtype=np.int64), found
+
+    # Store hits (dictionaries as from the aligners) or None for pairs
+    # without a hit, of the pairs of sequences with digest hashes x and y.
+
+    @classmethod
+    def store(cls, method, x, y, hits, min_identity, min_alignment):
+        scoring, first, second, checksum = cls.pair_keys(method, x, y)
+        now = timezone.now()
+        entries = []
+        for f, s, c, hit in zip(first.tolist(), second.tolist(), checksum.tolist(), hits):
+            entry = cls(scoring=scoring, first=f, second=s, checksum=c, hit=hit is not None,
+                        min_identity=min_identity, min_alignment=min_alignment, last_used=now)
+            if hit is not None:
+                for field in cls.hit_fields:
+                    setattr(entry, field, hit[field])
+            entries.append(entry)
+        cls.objects.bulk_create(entries, batch_size=cls.batch_size, update_conflicts=True,
+                                unique_fields=["scoring", "first", "second"],
+                                update_fields=["checksum", "hit", "min_identity", "min_alignment",
+                                               "last_used"] + cls.hit_fields)
+
+    @classmethod
+    def evict(cls, max_size):
+        excess = cls.objects.count() - max_size
+        if excess <= 0:
+            return
+        old = list(cls.objects.order_by("last_used").values_list("pk", flat=True)[:excess])
+        for s in range(0, len(old), cls.batch_size):
+            cls.objects.filter(pk__in=old[s:s + cls.batch_size]).delete()
+
+    # The stored result for thresholds min_identity and min_alignment:
+    # the hit, None for no hit, or False if the pair has to be aligned again.
+
+    def result(self, min_identity, min_alignment):
+        if not self.hit:
+            if min_identity >= self.min_identity and min_alignment >= self.min_alignment:
+                return None
+            return False
+        if self.pv < min_identity * (self.pairs + self.opens + self.exts):
+            return None
+        return {field: getattr(self, field) for field in self.hit_fields}
+
+
+# Finished tasks of a pipeline stage of a job, see
+# ScataScataMethod.task_done()
+
+class ScataScataTask(models.Model):
+    job = models.ForeignKey("scata2.ScataJob", on_delete=models.CASCADE)
+    stage = models.CharField(max_length=20)
+    task_num = models.IntegerField()
+    success = models.BooleanField(default=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["job", "stage", "task_num"],
+                                               name="unique_scata_task")]
+
+
+# django-q hooks of the stage tasks, args start with (job_pk, task_num)
+
+def cluster_chunk_done(task):
+    ScataScataMethod.task_done(task.args[0], "align", task.args[1], task.success)
+
+
+def summarise_cluster_done(task):
+    ScataScataMethod.task_done(task.args[0], "summarise", task.args[1], task.success)
+
 
 class ScataScataMethodForm(ModelForm):
 
@@ -695,6 +1159,6 @@ class ScataScataMethodForm(ModelForm):
         model = ScataScataMethod
         fields = ["distance", "min_alignment", "mismatch_pen",
                   "open_pen", "extend_pen", "endgap_pen", "max_homopolymer",
-                  "downsample", "lowfreq"]
+                  "downsample", "lowfreq", "aligner"]
 
 
@@ -0,0 +1,107 @@
+import heapq
+
+import numpy as np
+
+from scata2.methods.scata.unionfind import UnionFind
+
+
+# Scheduling of cluster_chunk tasks from the candidate pairs of the job
+# k-mer index (see kmerindex.py).
+#
+# Only genotypes connected by candidate pairs can end up in the same
+# cluster, so tasks are made from the connected components of the
+# candidate graph. The work of a task is estimated by its candidate pairs,
+# as only those pass the k-mer filter of the aligner. Tasks get about
+# len(a) / (4 * workers) pairs each, so tasks finishing at different times
+# still keep all workers busy. Components with fewer pairs are packed
+# together into tasks comparing all their genotypes against each other,
+# with at most block_size genotypes in a task. Larger components are split
+# into query blocks, each compared to the candidates of its queries only.
+# Genotypes without candidates are singletons and need no task.
+
+
+# Indices of the pairs (a, b) with their first genotype in genotypes.
+# sorted_a is a[order], order sorting a.
+
+def owned_pairs(sorted_a, order, genotypes):
+    starts = np.searchsorted(sorted_a, genotypes)
+    lengths = np.searchsorted(sorted_a, genotypes, side="right") - starts
+    offsets = np.cumsum(lengths) - lengths
+    return order[np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())]
+
+
+# Returns a list of (query ids, target ids, candidate pairs) tasks,
+# largest first, and the singleton ids.
+
+def schedule(n, a, b, workers, block_size=4000, min_pairs=1000):
+    graph = UnionFind(n)
+    graph.union(a, b)
+    in_pair = np.zeros(n, dtype=bool)
+    in_pair[a] = True
+    in_pair[b] = True
+    singletons = np.flatnonzero(~in_pair)
+
+    budget = max(min_pairs, -(-len(a) // (4 * workers)))
+
+    # Each pair is compared in the task of its first genotype
+    owned = np.bincount(a, minlength=n)
+    order = np.argsort(a, kind="stable")
+    sorted_a = a[order]
+
+    tasks = []
+    packed = []
+    packed_genotypes = 0
+    packed_pairs = 0
+    for component in graph.components(in_pair):
+        cumulative = np.cumsum(owned[component])
+        pairs = int(cumulative[-1])
+        if pairs > budget:
+            block = np.maximum(cumulative - 1, 0) // budget
+            for query in np.split(component, np.flatnonzero(np.diff(block)) + 1):
+                target = np.unique(b[owned_pairs(sorted_a, order, query)])
+                tasks.append((query, target, int(owned[query].sum())))
+            continue
+
+        if packed and (packed_pairs + pairs > budget or
+                       packed_genotypes + len(component) > block_size):
+            tasks.append((np.concatenate(packed), np.concatenate(packed), packed_pairs))
+            packed = []
+            packed_genotypes = 0
+            packed_pairs = 0
+        packed.append(component)
+        packed_genotypes += len(component)
+        packed_pairs += pairs
+
+    if packed:
+        tasks.append((np.concatenate(packed), np.concatenate(packed), packed_pairs))
+
+    tasks.sort(key=lambda t: t[2], reverse=True)
+    return tasks, singletons
+
+
+# Candidate pairs of each task as arrays (a, b). Every genotype is a query
+# of at most one task, and a pair belongs to the task of its first genotype.
+
+def task_pairs(tasks, n, a, b):
+    owner = np.full(n, -1, dtype=np.int64)
+    for i, (query, target, cost) in enumerate(tasks):
+        owner[query] = i
+    pair_owner = owner[a]
+    return [(a[pair_owner == i], b[pair_owner == i]) for i in range(len(tasks))]
+
+
+# Split items with costs into at most n parts of about equal total cost,
+# by greedy longest processing time: the most costly remaining item goes
+# to the part with the lowest total. Returns the item indices of each
+# non empty part.
+
+def partition(costs, n):
+    costs = np.asarray(costs, dtype=np.int64)
+    n = max(1, min(n, len(costs)))
+    parts = [[] for _ in range(n)]
+    heap = [(0, p) for p in range(n)]
+    for i in np.argsort(-costs, kind="stable").tolist():
+        load, p = heapq.heappop(heap)
+        parts[p].append(i)
+        heapq.heappush(heap, (load + int(costs[i]), p))
+    return [np.array(part, dtype=np.int64) for part in parts if part]
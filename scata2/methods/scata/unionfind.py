@@ -0,0 +1,120 @@
+import numpy as np
+from numba import njit
+
+
+# Disjoint set (union-find) over integer genotype ids, used to merge the
+# subclusters from the cluster_chunk tasks into global clusters. Parent
+# and rank are kept in NumPy arrays and edges are merged in numba, with
+# path compression and union by rank.
+
+@njit
+def find_root(parent, x):
+    root = x
+    while parent[root] != root:
+        root = parent[root]
+    while parent[x] != root:
+        next_x = parent[x]
+        parent[x] = root
+        x = next_x
+    return root
+
+
+@njit
+def union_edges(parent, rank, a, b):
+    for i in range(len(a)):
+        ra = find_root(parent, a[i])
+        rb = find_root(parent, b[i])
+        if ra == rb:
+            continue
+        if rank[ra] < rank[rb]:
+            ra, rb = rb, ra
+        parent[rb] = ra
+        if rank[ra] == rank[rb]:
+            rank[ra] += 1
+
+
+@njit
+def find_roots(parent):
+    roots = np.empty(len(parent), dtype=parent.dtype)
+    for i in range(len(parent)):
+        roots[i] = find_root(parent, i)
+    return roots
+
+
+class UnionFind:
+
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+        self.rank = np.zeros(n, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.parent)
+
+    # Join the sets of a[i] and b[i] for all i
+
+    def union(self, a, b):
+        union_edges(self.parent, self.rank,
+                    np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64))
+
+    def find(self, x):
+        return int(find_root(self.parent, x))
+
+    # Sets as arrays of members, largest first. If mask is given only
+    # members where mask is True are included.
+
+    def components(self, mask=None):
+        roots = find_roots(self.parent)
+        members = np.arange(len(roots))
+        if mask is not None:
+            roots = roots[mask]
+            members = members[mask]
+        order = np.argsort(roots, kind="stable")
+        roots = roots[order]
+        members = members[order]
+        bounds = np.flatnonzero(np.diff(roots)) + 1
+        sets = np.split(members, bounds) if len(members) else []
+        sets.sort(key=len, reverse=True)
+        return sets
+
+
+# Connected components of a list of edges between genotype ids, as arrays
+# with each genotype and the root of its component. Only genotypes in
+# some edge are included.
+
+def components(a, b):
+    ids, local = np.unique(np.concatenate((np.asarray(a, dtype=np.int64),
+                                           np.asarray(b, dtype=np.int64))),
+                           return_inverse=True)
+    merged = UnionFind(len(ids))
+    merged.union(local[:len(a)], local[len(a):])
+    return ids, ids[find_roots(merged.parent)]
+
+
+# Mapping between genotype ids ("<chunk pk>_<index in chunk>") and
+# integers. Each chunk gets a range of integers, offset by the genotypes
+# of the chunks before it.
+
+class GenotypeIndex:
+
+    def __init__(self, chunks):
+        chunks = sorted(chunks, key=lambda c: c.pk)
+        self.pks = np.array([c.pk for c in chunks], dtype=np.int64)
+        self.sizes = np.array([c.num_uniques for c in chunks], dtype=np.int64)
+        self.bases = np.zeros(len(chunks), dtype=np.int64)
+        np.cumsum(self.sizes[:-1], out=self.bases[1:])
+        self.offsets = dict(zip(self.pks.tolist(), self.bases.tolist()))
+
+    def __len__(self):
+        return int(self.sizes.sum())
+
+    def id(self, name):
+        chunk, index = name.split("_")
+        return self.offsets[int(chunk)] + int(index)
+
+    def ids(self, names):
+        return np.fromiter((self.id(name) for name in names), dtype=np.int64,
+                           count=len(names))
+
+    def name(self, id):
+        k = int(np.searchsorted(self.bases, id, side="right")) - 1
+        return "{}_{}".format(self.pks[k], id - self.bases[k])
@@ -0,0 +1,93 @@
+import os
+import subprocess
+import tempfile
+import threading
+
+from Bio import SeqIO
+from django.conf import settings
+from django_q.brokers import get_broker
+from django_q.conf import Conf
+
+
+# Running vsearch --usearch_global without scratch files.
+#
+# Queries are written to vsearch through stdin and the target database
+# through a named pipe, each from its own thread, and the userout is read
+# from stdout line by line while vsearch runs. Only the pipe itself is
+# created in SCRATCH_DIR.
+
+
+# Threads for a vsearch process. VSEARCH_MAX_THREADS is shared between
+# the workers that are expected to be busy: all of them when tasks are
+# queued, and only this one when the queue is empty.
+
+def vsearch_threads():
+    queued = get_broker().queue_size() or 0
+    busy = max(1, min(Conf.WORKERS, queued + 1))
+    return max(1, settings.VSEARCH_MAX_THREADS // busy)
+
+
+def write_records(open_stream, records):
+    try:
+        with open_stream() as f:
+            SeqIO.write(records, f, "fasta")
+    except BrokenPipeError:
+        # vsearch exited, the error is reported from its return code
+        pass
+
+
+# Yield the userout lines of vsearch --usearch_global. options are the
+# vsearch arguments apart from the input and output files and threads.
+
+def usearch_global(query_records, target_records, options, threads=1):
+    os.makedirs(settings.SCRATCH_DIR, exist_ok=True)
+    pipe_dir = tempfile.mkdtemp(prefix="vsearch_", dir=settings.SCRATCH_DIR)
+    db_pipe = os.path.join(pipe_dir, "db.fasta")
+    os.mkfifo(db_pipe)
+
+    process = subprocess.Popen([settings.VSEARCH_COMMAND] + options +
+                               ["--threads", "{}".format(threads),
+                                "--usearch_global", "-",
+                                "--db", db_pipe,
+                                "--userout", "-"],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, text=True)
+
+    errors = []
+    db_writer = threading.Thread(target=write_records,
+                                 args=(lambda: open(db_pipe, "w"), target_records))
+    query_writer = threading.Thread(target=write_records,
+                                    args=(lambda: process.stdin, query_records))
+    error_reader = threading.Thread(target=lambda: errors.append(process.stderr.read()))
+    threads = [db_writer, query_writer, error_reader]
+    for t in threads:
+        t.start()
+
+    try:
+        for line in process.stdout:
+            yield line.rstrip("\n")
+        process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+        # If vsearch exited before opening the database pipe, the writer is
+        # still blocked in open(). Open the read end to release it.
+        while db_writer.is_alive():
+            os.close(os.open(db_pipe, os.O_RDONLY | os.O_NONBLOCK))
+            db_writer.join(timeout=0.1)
+        for t in threads:
+            t.join()
+        process.stdout.close()
+        process.stderr.close()
+
+        try:
+            os.remove(db_pipe)
+            os.rmdir(pipe_dir)
+        except OSError:
+            pass
+
+    if process.returncode != 0:
+        raise RuntimeError("VSEARCH_COMMAND exited with return code {}\n\nCommand output:\n\n{}".
+                           format(process.returncode, "".join(errors)))
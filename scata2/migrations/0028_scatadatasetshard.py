@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:38
+
+import django.db.models.deletion
+import scata2.storages
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0027_rename_cluster_id_scatacluster_name_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScataDatasetShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num', models.IntegerField(default=0)),
+                ('file1', models.FileField(storage=scata2.storages.get_work_storage, upload_to='data/shards')),
+                ('file2', models.FileField(blank=True, null=True, storage=scata2.storages.get_work_storage, upload_to='data/shards')),
+                ('result', models.FileField(blank=True, null=True, storage=scata2.storages.get_work_storage, upload_to='data/shards')),
+                ('total_reads', models.IntegerField(default=0)),
+                ('good_reads', models.IntegerField(default=0)),
+                ('done', models.BooleanField(default=False)),
+                ('error', models.CharField(default='', max_length=100)),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='scata2.scatadataset')),
+            ],
+        ),
+    ]
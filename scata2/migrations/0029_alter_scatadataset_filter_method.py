@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0028_scatadatasetshard'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='scatadataset',
+            name='filter_method',
+            field=models.CharField(choices=[('fsq', 'Full sequence, quality screen'), ('fs', 'Full sequence, NO quality filtering'), ('hqr', 'Extract High Quality Region'), ('ampq', 'Amplicon quality'), ('amp', 'Only amplicon extraction')], default='ampq', max_length=6, verbose_name='Filtering type'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:48
+
+import scata2.storages
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0029_alter_scatadataset_filter_method'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scatadataset',
+            name='seqstore',
+            field=models.FileField(blank=True, editable=False, null=True, storage=scata2.storages.get_work_storage, upload_to='data/seqstore', verbose_name='Sequence store'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0030_scatadataset_seqstore'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scatascatamethod',
+            name='num_duplicates',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Number of duplicate reads collapsed'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0031_scatascatamethod_num_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scatascatamethod',
+            name='aligner',
+            field=models.CharField(choices=[('vsearch', 'vsearch'), ('banded', 'Built in banded aligner (no vsearch)')], default='vsearch', max_length=10, verbose_name='Aligner'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0032_scatascatamethod_aligner'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scatascatamethod',
+            name='clustered_datasets',
+            field=models.ManyToManyField(blank=True, editable=False, related_name='+', to='scata2.scatadataset'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0033_scatascatamethod_clustered_datasets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScataScataAlignment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('hit', models.BooleanField(default=False)),
+                ('min_identity', models.FloatField(default=0.0)),
+                ('min_alignment', models.FloatField(default=0.0)),
+                ('qilo', models.IntegerField(default=0)),
+                ('qihi', models.IntegerField(default=0)),
+                ('tilo', models.IntegerField(default=0)),
+                ('tihi', models.IntegerField(default=0)),
+                ('qcov', models.FloatField(default=0.0)),
+                ('tcov', models.FloatField(default=0.0)),
+                ('pairs', models.IntegerField(default=0)),
+                ('pv', models.IntegerField(default=0)),
+                ('opens', models.IntegerField(default=0)),
+                ('exts', models.IntegerField(default=0)),
+                ('last_used', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
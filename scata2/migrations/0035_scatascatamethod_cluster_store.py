@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:13
+
+import scata2.storages
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0034_scatascataalignment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scatascatamethod',
+            name='cluster_store',
+            field=models.FileField(blank=True, null=True, storage=scata2.storages.get_work_storage, upload_to='scata/methods/scata/clusterstore/', verbose_name='Cluster store'),
+        ),
+    ]
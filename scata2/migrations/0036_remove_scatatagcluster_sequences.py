@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:18
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0035_scatascatamethod_cluster_store'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='scatatagcluster',
+            name='sequences',
+        ),
+    ]
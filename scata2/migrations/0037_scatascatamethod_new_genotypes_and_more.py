@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:24
+
+import django.db.models.deletion
+import scata2.storages
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0036_remove_scatatagcluster_sequences'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scatascatamethod',
+            name='new_genotypes',
+            field=models.FileField(blank=True, null=True, storage=scata2.storages.get_work_storage, upload_to='scata/methods/scata/newgenotypes/', verbose_name='New genotypes'),
+        ),
+        migrations.AddField(
+            model_name='scatascatamethod',
+            name='stage',
+            field=models.CharField(default='', editable=False, max_length=20, verbose_name='Stage'),
+        ),
+        migrations.AddField(
+            model_name='scatascatamethod',
+            name='stage_tasks',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Tasks of the stage'),
+        ),
+        migrations.CreateModel(
+            name='ScataScataTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=20)),
+                ('task_num', models.IntegerField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='scata2.scatajob')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('job', 'stage', 'task_num'), name='unique_scata_task')],
+            },
+        ),
+    ]
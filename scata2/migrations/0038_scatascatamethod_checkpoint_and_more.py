@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:32
+
+import scata2.storages
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0037_scatascatamethod_new_genotypes_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scatascatamethod',
+            name='checkpoint',
+            field=models.JSONField(default=dict, editable=False, verbose_name='Checkpoint'),
+        ),
+        migrations.AddField(
+            model_name='scatascatamethod',
+            name='stage_plan',
+            field=models.FileField(blank=True, null=True, storage=scata2.storages.get_work_storage, upload_to='scata/methods/scata/plan/', verbose_name='Stage plan'),
+        ),
+        migrations.AddField(
+            model_name='scatascatatask',
+            name='success',
+            field=models.BooleanField(default=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scata2', '0038_scatascatamethod_checkpoint_and_more'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='scatadatasetshard',
+            name='file1',
+        ),
+        migrations.RemoveField(
+            model_name='scatadatasetshard',
+            name='file2',
+        ),
+        migrations.AddField(
+            model_name='scatadatasetshard',
+            name='end1',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='scatadatasetshard',
+            name='end2',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='scatadatasetshard',
+            name='process_time',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='scatadatasetshard',
+            name='start1',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='scatadatasetshard',
+            name='start2',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
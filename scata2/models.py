@@ -1,3 +1,6 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
 from django.db import models
 from django.urls import reverse
 from django.contrib.auth.models import User
@@ -265,7 +268,7 @@ class ScataDataset(ScataModel):
                          choices={
                             "fsq": "Full sequence, quality screen",
                             "fs":  "Full sequence, NO quality filtering",
-                            # "hqr":"Extract High Quality Region",
+                            "hqr": "Extract High Quality Region",
                             "ampq": "Amplicon quality",
                             "amp":  "Only amplicon extraction"})
     file_types = \
@@ -316,6 +319,13 @@ class ScataDataset(ScataModel):
                                  upload_to="data/seqs",
                                  storage=get_work_storage)
 
+    # Columnar sequence store (see backend/seqstore.py). Replaces tags and
+    # sequences, which are only kept for datasets filtered before it.
+    seqstore = models.FileField("Sequence store", null=True, blank=True,
+                                editable=False,
+                                upload_to="data/seqstore",
+                                storage=get_work_storage)
+
     def __str__(self):
         if self.is_valid and self.validated:
             status = ""
@@ -345,6 +355,26 @@ class ScataErrorType(models.Model):
     count = models.IntegerField()
 
 
+# Part of a dataset being filtered in parallel. Each shard is a
+# record-aligned range of the dataset files, as byte offsets in the
+# uncompressed files, and, when done, the filtering result for that range.
+
+class ScataDatasetShard(models.Model):
+    dataset = models.ForeignKey(ScataDataset, on_delete=models.CASCADE)
+    num = models.IntegerField(default=0)
+    start1 = models.BigIntegerField(default=0)
+    end1 = models.BigIntegerField(default=0)
+    start2 = models.BigIntegerField(default=0)
+    end2 = models.BigIntegerField(default=0)
+    result = models.FileField(upload_to="data/shards", null=True, blank=True,
+                              storage=get_work_storage)
+    total_reads = models.IntegerField(default=0)
+    good_reads = models.IntegerField(default=0)
+    process_time = models.FloatField(default=0.0)
+    done = models.BooleanField(default=False)
+    error = models.CharField(default="", max_length=100)
+
+
 class ScataTagStat(models.Model):
     dataset = models.ForeignKey(ScataDataset, on_delete=models.CASCADE)
     tag = models.CharField(max_length=200)
@@ -399,6 +429,14 @@ class ScataJob(ScataModel):
     def get_absolute_url(self):
         return reverse("job-list")
 
+    # Mark the job as done, when its method has finished
+
+    def complete(self):
+        self.completed = True
+        self.completed_date = datetime.now(ZoneInfo("Europe/Stockholm"))
+        self.status = "Completed"
+        self.save()
+
     def __str__(self):
         return "{u} {name} ({status})".format(u=self.get_owner(),
                                      status=self.status,
@@ -33,6 +33,7 @@ urlpatterns = [
     path("jobs/<int:pk>/detail/csv/<facet>/<filename>", views.JobDetailFacetCSVView.as_view(),
          name="job-detail-csv"),
     path("jobs/<int:pk>/delete/", views.JobDeleteView.as_view(), name="job-delete"),
+    path("jobs/<int:pk>/add_datasets/", views.JobAddDatasetsView.as_view(), name="job-add-datasets"),
     path("files/", views.FileListView.as_view(), name="file-list"),
     path("files/add/", views.FileCreateView.as_view(), name="file-add"),
     path("files/<int:pk>/delete/", views.FileDeleteView.as_view(), name="file-delete"),
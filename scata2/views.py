@@ -7,7 +7,7 @@ from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.views.generic import ListView, DetailView
-from django.views.generic.edit import CreateView, DeleteView
+from django.views.generic.edit import CreateView, DeleteView, UpdateView
 from django.db.models import Q
 from django.core.exceptions import SuspiciousOperation
 from scata2.models import ScataFile, ScataPrimer, ScataTagSet, ScataAmplicon, \
@@ -373,6 +373,49 @@ class JobCreateView(FilteredCreateView):
         return HttpResponseRedirect(self.get_success_url())
 
 
+# Add datasets to a finished job. The job is clustered again
+# incrementally, only comparing the new genotypes (see the method's
+# cluster()). Datasets can not be removed.
+
+class JobAddDatasetsView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
+    model = ScataJob
+    fields = ["datasets"]
+    template_name = "scata2/scatajob_add_datasets.html"
+
+    def get_method_object(self):
+        job = self.get_object()
+        return clustering_methods[job.method]['model'].objects.get(job=job.pk)
+
+    def test_func(self):
+        o = self.get_object()
+        method_object = self.get_method_object()
+        return (o.owner == self.request.user and not o.deleted and o.completed and
+                method_object.incremental and method_object.clustered_datasets.exists())
+
+    def get_form(self, *args, **kwargs):
+        form = super().get_form(*args, **kwargs)
+        user = self.request.user
+        # Only datasets that passed filtering have sequences to add, and
+        # their reads must be of the same amplicon as the clustered ones
+        form.fields["datasets"].queryset = form.fields["datasets"].queryset.\
+            filter(Q(owner=user, deleted=False) | Q(public=True, deleted=False)).\
+            filter(validated=True, is_valid=True,
+                   amplicon__in=self.object.datasets.values("amplicon"))
+        return form
+
+    def form_valid(self, form):
+        datasets = set(self.object.datasets.all()) | set(form.cleaned_data["datasets"])
+        self.object.datasets.set(datasets)
+        self.object.completed = False
+        self.object.status = "Pending"
+        self.object.save()
+
+        q2.async_task(run_job, self.object.pk,
+                      task_name="job pk={id}".format(id=self.object.pk))
+
+        return HttpResponseRedirect(reverse_lazy("job-list"))
+
+
 class JobDetailView(OwnedDetailView):
     model = ScataJob
 
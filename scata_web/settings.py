@@ -179,6 +179,28 @@ STORAGES = {
 SCRATCH_DIR = os.path.join(BASE_DIR, "scata_scratch")
 VSEARCH_COMMAND = "/opt/homebrew/bin/vsearch"
 
+# Datasets are split into shards of this many reads, which are filtered
+# in parallel by the django-q workers. 0 to filter in a single task.
+
+DATASET_SHARD_SIZE = 500000
+
+# Memory (bytes) used by the global dereplication of a clustering job
+# before it spills to SCRATCH_DIR.
+
+DEREP_MAX_MEMORY = 1024 * 1024 * 1024
+
+# Maximum number of threads of a vsearch process. Divided between the
+# django-q workers that are busy, so tasks at the end of a job (when the
+# queue is short) get more threads.
+
+VSEARCH_MAX_THREADS = os.cpu_count()
+
+# Maximum number of pairwise alignment results kept between jobs (see
+# ScataScataAlignment), the least recently used are evicted. 0 disables
+# the cache.
+
+ALIGNMENT_CACHE_SIZE = 10000000
+
 # django-q2 settings
 Q_CLUSTER = {
     'name': 'scata2',